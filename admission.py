@@ -0,0 +1,120 @@
+"""
+東吳大學資料系 2025 LINEBOT
+Webhook 入口的流量管制：依 Gemini 延遲自動調整可同時處理的事件數，超過上限的新事件直接回覆「忙碌中」
+"""
+
+import logging
+import threading
+import time
+
+from metrics import Counters, LatencyStats
+
+logger = logging.getLogger(__name__)
+
+
+class _Baseline:
+    """單一模型的延遲：短期與長期的指數移動平均。"""
+
+    def __init__(self, seconds):
+        self.short = seconds
+        self.long = seconds
+        self.samples = 0
+
+
+class AdmissionController:
+    """追蹤處理中（in_flight）與排隊中（queued）的事件數，超過上限時拒絕新事件。
+
+    事件在 webhook 執行緒中直接處理時（同步模式），處理中的事件達 limit 就拒絕；
+    事件先放進佇列時（ASYNC_WEBHOOK），兩者合計達 limit + max_queue 才拒絕。
+
+    limit 以 AIMD 調整，依據只有 Gemini 呼叫本身的延遲（observe() 由 HedgedModels 回報），
+    不含本地回覆、只排入工作的媒體事件等不呼叫 Gemini 的事件。各模型分別維護短期與長期（EWMA）平均：
+    短期平均超過長期基準的 tolerance 倍時乘以 backoff，否則每次呼叫增加 1/limit。
+    Gemini 整體變慢時 limit 會下降，長期基準慢慢跟上新的延遲水準後再逐步回升。
+    enabled 為 False 時只統計、不拒絕。
+    """
+
+    def __init__(self, enabled=True, initial_limit=8, min_limit=2, max_limit=32, max_queue=16,
+                 tolerance=2.0, backoff=0.9, min_samples=10, short_alpha=0.2, long_alpha=0.01):
+        self.enabled = enabled
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.min_samples = min_samples
+        self.short_alpha = short_alpha
+        self.long_alpha = long_alpha
+        self.in_flight = 0
+        self.queued = 0
+        self._baselines = {}
+        self._lock = threading.Lock()
+        self.latency = LatencyStats()
+        self.counters = Counters("admitted", "shed", "completed", "decreases")
+
+    def admit(self, queueing=False):
+        """決定是否接受新事件；接受後事件計為排隊中，直到 run() 開始處理。queueing 表示事件會先進佇列等待。"""
+        capacity = int(self.limit) + (self.max_queue if queueing else 0)
+        with self._lock:
+            if self.enabled and self.in_flight + self.queued >= capacity:
+                self.counters.incr("shed")
+                return False
+            self.queued += 1
+        self.counters.incr("admitted")
+        return True
+
+    def run(self, func, event):
+        """處理一個已經 admit() 的事件。"""
+        with self._lock:
+            self.queued -= 1
+            self.in_flight += 1
+        started = time.monotonic()
+        try:
+            return func(event)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self.counters.incr("completed")
+            self.latency.record(time.monotonic() - started)
+
+    def observe(self, model, elapsed):
+        """記錄一次 Gemini 呼叫的延遲並調整 limit。"""
+        with self._lock:
+            baseline = self._baselines.get(model)
+            if baseline is None:
+                baseline = self._baselines[model] = _Baseline(elapsed)
+            baseline.short += self.short_alpha * (elapsed - baseline.short)
+            baseline.long += self.long_alpha * (elapsed - baseline.long)
+            baseline.samples += 1
+            if baseline.samples < self.min_samples:
+                return
+            if baseline.short > baseline.long * self.tolerance:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                decreased = True
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                decreased = False
+        if decreased:
+            self.counters.incr("decreases")
+
+    def stats(self):
+        counters = self.counters.snapshot()
+        offered = counters["admitted"] + counters["shed"]
+        with self._lock:
+            in_flight, queued, limit = self.in_flight, self.queued, self.limit
+            gemini = {
+                model: {"short_ms": round(b.short * 1000, 1), "baseline_ms": round(b.long * 1000, 1), "samples": b.samples}
+                for model, b in self._baselines.items()
+            }
+        return {
+            "enabled": self.enabled,
+            "limit": round(limit, 2),
+            "max_queue": self.max_queue,
+            "in_flight": in_flight,
+            "queued": queued,
+            "shed_rate": round(counters["shed"] / offered, 3) if offered else 0.0,
+            **counters,
+            "event_latency": self.latency.snapshot(),
+            "gemini_latency": gemini,
+        }
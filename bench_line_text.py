@@ -0,0 +1,62 @@
+"""
+東吳大學資料系 2025 LINEBOT
+比較 line_text.render() 與原本 markdown + BeautifulSoup 轉純文字的速度
+
+執行方式：python bench_line_text.py [重複次數]
+"""
+
+import sys
+import timeit
+
+import markdown
+from bs4 import BeautifulSoup
+
+from line_text import render
+
+SAMPLE = """# 東京5天4夜行程
+
+以下是為您規劃的**東京動漫美食之旅**（3/1至3/5），預算約 *NT$30,000*：
+
+### 第一天（3/1）
+- **早上**：抵達成田機場，搭乘 `Skyliner` 前往上野
+- **下午**：淺草寺、仲見世通り，品嚐人形燒
+- **晚上**：[東京晴空塔](https://www.tokyo-skytree.jp/) 夜景
+
+### 第二天（3/2）
+- **早上**：秋葉原動漫街巡禮
+  - 推薦：Animate、Radio會館
+- **下午**：神田明神，午餐吃咖哩
+- **晚上**：築地場外市場壽司
+
+## 預算分配
+1. 住宿：NT$12,000
+2. 交通：NT$5,000
+3. 餐飲：NT$8,000
+4. 門票與購物：NT$5,000
+
+| 項目 | 金額 |
+|---|---|
+| 住宿 | 12,000 |
+| 交通 | 5,000 |
+
+> 小提醒：三月為賞櫻季，住宿請**提早預訂**！
+"""
+
+
+def markdown_pipeline(text):
+    html_msg = markdown.markdown(text)
+    soup = BeautifulSoup(html_msg, "html.parser")
+    return soup.get_text()
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for name, func in (("markdown + BeautifulSoup", markdown_pipeline), ("line_text.render", render)):
+        seconds = min(timeit.repeat(lambda: func(SAMPLE), number=number, repeat=3))
+        print(f"{name:<26} {seconds / number * 1e6:8.1f} µs/次")
+    print()
+    print(render(SAMPLE))
+
+
+if __name__ == "__main__":
+    main()
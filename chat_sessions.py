@@ -0,0 +1,200 @@
+"""
+東吳大學資料系 2025 LINEBOT
+每位使用者各自的 Gemini 對話（取代全體共用的單一 chat），含 LRU/閒置逾時回收與歷史長度上限
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from google.genai import types
+
+from metrics import Counters
+
+logger = logging.getLogger(__name__)
+
+SHARED_SESSION_KEY = "_shared"
+
+
+class ChatSession:
+    """單一使用者的對話歷史；lock 確保同一使用者的訊息依序送出，users 為正在使用（含等待 lock）的呼叫數。"""
+
+    def __init__(self, user_id, history=None):
+        self.user_id = user_id
+        self.history = list(history or [])
+        self.lock = threading.Lock()
+        self.users = 0
+        self.last_used = time.monotonic()
+
+
+class SessionManager:
+    """依 user_id 延遲建立對話，限制同時存活的對話數與每段對話保留的輪數。
+
+    有 store 時，對話歷史在送出前才從資料庫載入，重啟或換 worker 都能接續。
+    """
+
+    def __init__(self, client, model, config, max_sessions=500, max_turns=10, idle_ttl=1800, store=None):
+        self.client = client
+        self.model = model
+        self.config = config
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.idle_ttl = idle_ttl
+        self.store = store
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = Counters("created", "evicted_lru", "evicted_idle")
+
+    def get(self, user_id, hold=False):
+        """hold=True 時把對話標記為使用中（由 _locked() 使用並負責減回）；使用中的對話不會被回收。"""
+        key = user_id or SHARED_SESSION_KEY
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            session = self._sessions.get(key)
+            if session is None:
+                session = ChatSession(key)
+                self._sessions[key] = session
+                self.counters.incr("created")
+                if len(self._sessions) > self.max_sessions:
+                    self._evict_lru()
+            else:
+                self._sessions.move_to_end(key)
+            session.last_used = now
+            if hold:
+                session.users += 1
+        return session
+
+    @contextmanager
+    def _locked(self, user_id):
+        """取得使用者的對話並上鎖；回收時若把使用中的對話丟掉，下一則訊息會建立新的 lock，同一使用者就可能同時有兩個呼叫。"""
+        session = self.get(user_id, hold=True)
+        try:
+            with session.lock:
+                yield session
+        finally:
+            with self._lock:
+                session.users -= 1
+
+    def send(self, user_id, message, config=None, remember=True):
+        """送出訊息並回傳 Gemini 原始 response；成功時才把這一輪寫進歷史。
+
+        config 可暫時換掉預設設定（例如要求 JSON 輸出）；remember=False 時只參考歷史、不寫入。
+        """
+        user_content = types.Content(role="user", parts=[types.Part(text=message)])
+        if not remember:
+            # 不寫入歷史的呼叫只在讀取歷史時上鎖，可與同一使用者的其他呼叫並行
+            with self._locked(user_id) as session:
+                history = self._refresh(session)
+            return self._generate(history + [user_content], config)
+        with self._locked(user_id) as session:
+            response = self._generate(self._refresh(session) + [user_content], config)
+            reply_text = getattr(response, "text", None)
+            if reply_text:
+                self._append(session, message, reply_text)
+        return response
+
+    def _refresh(self, session):
+        if self.store is not None:
+            # 其他 gunicorn worker 也可能寫入過這位使用者的對話，每次都以資料庫為準
+            session.history = self._load_history(session.user_id)
+        return list(session.history)
+
+    def _generate(self, contents, config):
+        return self.client.models.generate_content(
+            model=self.model,
+            contents=contents,
+            config=config or self.config,
+        )
+
+    def send_stream(self, user_id, message, config=None):
+        """串流版本的 send()，逐段產生文字；整段回覆結束後才寫進歷史。"""
+        with self._locked(user_id) as session:
+            user_content = types.Content(role="user", parts=[types.Part(text=message)])
+            parts = []
+            for chunk in self.client.models.generate_content_stream(
+                model=self.model,
+                contents=self._refresh(session) + [user_content],
+                config=config or self.config,
+            ):
+                text = getattr(chunk, "text", None)
+                if text:
+                    parts.append(text)
+                    yield text
+            if parts:
+                self._append(session, message, "".join(parts))
+
+    def history_digest(self, user_id):
+        """目前對話歷史的雜湊；回應快取的 key 要包含它，否則依上下文的追問（例如「五天」）會拿到別人對話的答案。"""
+        with self._locked(user_id) as session:
+            history = self._refresh(session)
+        digest = hashlib.sha256()
+        for content in history:
+            digest.update(content.role.encode("utf-8") + b"\0")
+            for part in content.parts:
+                digest.update((part.text or "").encode("utf-8") + b"\0")
+        return digest.hexdigest()
+
+    def record(self, user_id, message, reply_text):
+        """把不是經由 send() 取得的回覆（例如快取命中）補記到使用者的對話歷史。"""
+        with self._locked(user_id) as session:
+            self._refresh(session)
+            self._append(session, message, reply_text)
+
+    def _append(self, session, message, reply_text):
+        session.history.append(types.Content(role="user", parts=[types.Part(text=message)]))
+        session.history.append(types.Content(role="model", parts=[types.Part(text=reply_text)]))
+        self._trim(session)
+        if self.store is not None:
+            self.store.append_turn(session.user_id, "user", message)
+            self.store.append_turn(session.user_id, "model", reply_text)
+        session.last_used = time.monotonic()
+
+    def reset(self, user_id):
+        with self._lock:
+            self._sessions.pop(user_id or SHARED_SESSION_KEY, None)
+
+    def _load_history(self, key):
+        turns = self.store.load_turns(key, self.max_turns * 2)
+        # 對話必須從使用者訊息開始
+        while turns and turns[0][0] != "user":
+            turns.pop(0)
+        return [types.Content(role=role, parts=[types.Part(text=text)]) for role, text in turns]
+
+    def _trim(self, session):
+        # 一輪 = 使用者訊息 + 模型回覆，保留最近 max_turns 輪
+        limit = self.max_turns * 2
+        if len(session.history) > limit:
+            del session.history[:-limit]
+
+    def _evict_lru(self):
+        # 從最久未使用的開始找，跳過使用中的對話；全部都在使用中時暫時超過上限
+        for key, session in self._sessions.items():
+            if not session.users:
+                del self._sessions[key]
+                self.counters.incr("evicted_lru")
+                logger.info(f"[SessionManager] LRU evicted session: {key}")
+                return
+
+    def _evict_idle(self, now):
+        # OrderedDict 依最近使用排序，從最舊的開始檢查，遇到未逾時者即可停止；使用中的對話跳過
+        for key, session in list(self._sessions.items()):
+            if now - session.last_used <= self.idle_ttl:
+                break
+            if session.users:
+                continue
+            del self._sessions[key]
+            self.counters.incr("evicted_idle")
+
+    def stats(self):
+        with self._lock:
+            live = len(self._sessions)
+        return {
+            "live": live,
+            "max_sessions": self.max_sessions,
+            "max_turns": self.max_turns,
+            **self.counters.snapshot(),
+        }
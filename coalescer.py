@@ -0,0 +1,118 @@
+"""
+東吳大學資料系 2025 LINEBOT
+事件合併：同一個 key 在短時間內陸續到達的項目收集成一批，再一次交給 flush 處理（例如同一組多張圖片）
+"""
+
+import logging
+import threading
+import time
+
+from metrics import Counters, LatencyStats
+
+logger = logging.getLogger(__name__)
+
+
+class _Batch:
+    def __init__(self, now):
+        self.items = []
+        self.first_at = now
+        self.expected = None
+        self.timer = None
+
+
+class Coalescer:
+    """flush(key, items) 在以下任一情況觸發：收到 expected（或 max_items）個項目、window 秒內沒有新項目、或距離第一個項目已達 max_wait 秒。
+
+    每收到一個項目 window 就重新計時（debounce），max_wait 保證不會一直等下去。
+    flush 在觸發的執行緒中執行（計時器執行緒，或補齊最後一個項目的 add() 呼叫端），應盡快返回，耗時的工作請另外排入佇列。
+    批次只存在這個行程的記憶體中；多個 gunicorn worker 時，同一組項目可能被拆成幾批。
+    """
+
+    def __init__(self, flush, window=2.0, max_wait=10.0, max_items=None, name="coalescer"):
+        self._flush = flush
+        self.window = window
+        self.max_wait = max_wait
+        self.max_items = max_items
+        self._name = name
+        self._batches = {}
+        self._lock = threading.Lock()
+        self.counters = Counters("items", "batches", "complete", "timed_out", "flush_errors")
+        self.batch_wait = LatencyStats()
+
+    def add(self, key, item, expected=None):
+        """加入一個項目；expected 為這一批預期的總數（例如 imageSet.total），收齊時立即送出。"""
+        now = time.monotonic()
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch is None:
+                batch = self._batches[key] = _Batch(now)
+            elif batch.timer is not None:
+                batch.timer.cancel()
+            batch.items.append(item)
+            if expected:
+                batch.expected = expected
+            self.counters.incr("items")
+            limit = batch.expected or self.max_items
+            if limit and len(batch.items) >= limit:
+                del self._batches[key]
+                complete = True
+            else:
+                delay = min(self.window, batch.first_at + self.max_wait - now)
+                batch.timer = threading.Timer(max(0.0, delay), self._on_timer, args=(key, batch))
+                batch.timer.daemon = True
+                batch.timer.start()
+                complete = False
+        if complete:
+            self.counters.incr("complete")
+            self._emit(key, batch)
+
+    def _on_timer(self, key, batch):
+        with self._lock:
+            # 計時器觸發前可能剛好有新項目加入並換了新的計時器，只處理仍是同一批且未被重新排程的情況
+            if self._batches.get(key) is not batch or batch.timer is not threading.current_thread():
+                return
+            del self._batches[key]
+        self.counters.incr("timed_out")
+        self._emit(key, batch)
+
+    def _emit(self, key, batch):
+        self.counters.incr("batches")
+        self.batch_wait.record(time.monotonic() - batch.first_at)
+        try:
+            self._flush(key, batch.items)
+        except Exception as e:
+            self.counters.incr("flush_errors")
+            logger.error(f"[Coalescer] {self._name}: flush failed for {key}: {e}")
+
+    def flush(self, key):
+        """立即送出 key 等待中的批次（例如之後的訊息不該合併、但要維持先後順序時）。"""
+        with self._lock:
+            batch = self._batches.pop(key, None)
+            if batch is None:
+                return
+            if batch.timer is not None:
+                batch.timer.cancel()
+        self._emit(key, batch)
+
+    def flush_all(self):
+        """立即送出所有等待中的批次（關閉前使用）。"""
+        with self._lock:
+            batches = list(self._batches.items())
+            self._batches.clear()
+        for key, batch in batches:
+            if batch.timer is not None:
+                batch.timer.cancel()
+            self._emit(key, batch)
+
+    def stats(self):
+        counters = self.counters.snapshot()
+        with self._lock:
+            pending = len(self._batches)
+        return {
+            "pending": pending,
+            "window_seconds": self.window,
+            # 平均幾個項目合併成一批；1.0 表示完全沒有合併
+            "merge_ratio": round(counters["items"] / counters["batches"], 2) if counters["batches"] else 0.0,
+            **counters,
+            "batch_wait": self.batch_wait.snapshot(),
+        }
@@ -0,0 +1,225 @@
+"""
+東吳大學資料系 2025 LINEBOT
+SQLite（WAL 模式）對話儲存：重啟後保留每位使用者的對話與搜尋狀態，且可由多個 gunicorn worker 共用
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+
+from metrics import Counters, LatencyStats
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    data BLOB NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_turns_user ON turns (user_id, id);
+CREATE TABLE IF NOT EXISTS user_state (
+    namespace TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    data BLOB NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (namespace, user_id)
+);
+"""
+
+
+def encode(value):
+    """JSON 後再以 zlib 壓縮，行程文字通常可以縮小到三分之一以下。"""
+    raw = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return zlib.compress(raw)
+
+
+def decode(blob):
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+
+class ConversationStore:
+    """寫入先放在記憶體中，由背景執行緒批次提交；讀取時會合併尚未提交的資料。"""
+
+    def __init__(self, path, flush_interval=0.2, batch_size=200, max_turns_per_user=200):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_turns_per_user = max_turns_per_user
+        self._local = threading.local()
+        self._cond = threading.Condition()
+        self._pending_turns = []   # [(user_id, role, blob, created_at)]
+        self._pending_state = {}   # {(namespace, user_id): blob 或 None(刪除)}
+        self._closed = False
+        # 提交期間對話仍留在 _pending_turns，提交完成才移除；讀取與提交互斥，才不會兩邊都讀不到或重複讀到
+        self._flush_lock = threading.Lock()
+        self.counters = Counters("turns_written", "states_written", "flushes", "flush_errors")
+        self.flush_time = LatencyStats()
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        conn.commit()
+
+        self._writer = threading.Thread(target=self._run_writer, name="conversation-store-writer", daemon=True)
+        self._writer.start()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # === 對話紀錄 ===
+    def append_turn(self, user_id, role, text):
+        with self._cond:
+            self._pending_turns.append((user_id, role, encode(text), time.time()))
+            if len(self._pending_turns) >= self.batch_size:
+                self._cond.notify()
+
+    def load_turns(self, user_id, limit):
+        """回傳最近 limit 筆 (role, text)，由舊到新。"""
+        with self._flush_lock:
+            rows = self._conn().execute(
+                "SELECT role, data FROM turns WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (user_id, limit),
+            ).fetchall()
+            with self._cond:
+                pending = [(role, blob) for uid, role, blob, _ in self._pending_turns if uid == user_id]
+        turns = [(role, decode(data)) for role, data in reversed(rows)]
+        turns.extend((role, decode(blob)) for role, blob in pending)
+        return turns[-limit:] if limit else turns
+
+    # === 使用者狀態（搜尋模式等） ===
+    def get_state(self, namespace, user_id, default=None):
+        key = (namespace, user_id)
+        with self._cond:
+            if key in self._pending_state:
+                blob = self._pending_state[key]
+                return default if blob is None else decode(blob)
+        row = self._conn().execute(
+            "SELECT data FROM user_state WHERE namespace = ? AND user_id = ?", key
+        ).fetchone()
+        return default if row is None else decode(row[0])
+
+    def set_state(self, namespace, user_id, value):
+        with self._cond:
+            self._pending_state[(namespace, user_id)] = encode(value)
+
+    def delete_state(self, namespace, user_id):
+        with self._cond:
+            self._pending_state[(namespace, user_id)] = None
+
+    def mapping(self, namespace):
+        return StateMapping(self, namespace)
+
+    # === 批次寫入 ===
+    def _run_writer(self):
+        while True:
+            with self._cond:
+                if not self._closed:
+                    self._cond.wait(self.flush_interval)
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+    def flush(self):
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._cond:
+            turns = list(self._pending_turns)
+            states = dict(self._pending_state)
+        if not turns and not states:
+            return
+        started = time.monotonic()
+        conn = self._conn()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO turns (user_id, role, data, created_at) VALUES (?, ?, ?, ?)", turns
+                )
+                now = time.time()
+                conn.executemany(
+                    "INSERT OR REPLACE INTO user_state (namespace, user_id, data, updated_at) VALUES (?, ?, ?, ?)",
+                    [(ns, uid, blob, now) for (ns, uid), blob in states.items() if blob is not None],
+                )
+                conn.executemany(
+                    "DELETE FROM user_state WHERE namespace = ? AND user_id = ?",
+                    [key for key, blob in states.items() if blob is None],
+                )
+                for user_id in {turn[0] for turn in turns}:
+                    conn.execute(
+                        "DELETE FROM turns WHERE user_id = ? AND id <= ("
+                        " SELECT id FROM turns WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                        (user_id, user_id, self.max_turns_per_user),
+                    )
+        except sqlite3.Error as e:
+            self.counters.incr("flush_errors")
+            logger.error(f"[ConversationStore] flush failed: {e}")
+            # 寫入失敗時資料仍在佇列中，下次再試
+            return
+        with self._cond:
+            # 提交期間新增的對話都接在後面，只移除這次寫入的部分
+            del self._pending_turns[:len(turns)]
+            # 提交期間若同一個 key 又被更新，保留較新的值
+            for key, blob in states.items():
+                if self._pending_state.get(key, blob) is blob:
+                    self._pending_state.pop(key, None)
+        self.counters.incr("flushes")
+        self.counters.incr("turns_written", len(turns))
+        self.counters.incr("states_written", len(states))
+        self.flush_time.record(time.monotonic() - started)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._writer.join(5.0)
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._pending_turns) + len(self._pending_state)
+        return {
+            "path": self.path,
+            "pending_writes": pending,
+            **self.counters.snapshot(),
+            "flush": self.flush_time.snapshot(),
+        }
+
+
+class StateMapping:
+    """以 dict 的介面存取某個 namespace 的使用者狀態；取出的值是複本，修改後需重新指定。"""
+
+    _MISSING = object()
+
+    def __init__(self, store, namespace):
+        self._store = store
+        self._namespace = namespace
+
+    def get(self, user_id, default=None):
+        return self._store.get_state(self._namespace, user_id, default)
+
+    def __getitem__(self, user_id):
+        value = self._store.get_state(self._namespace, user_id, self._MISSING)
+        if value is self._MISSING:
+            raise KeyError(user_id)
+        return value
+
+    def __setitem__(self, user_id, value):
+        self._store.set_state(self._namespace, user_id, value)
+
+    def __delitem__(self, user_id):
+        self._store.delete_state(self._namespace, user_id)
+
+    def __contains__(self, user_id):
+        return self._store.get_state(self._namespace, user_id, self._MISSING) is not self._MISSING
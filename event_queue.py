@@ -0,0 +1,105 @@
+"""
+東吳大學資料系 2025 LINEBOT
+Webhook 事件工作佇列：callback() 驗證簽章後立即回 200，事件交給背景 worker 處理
+"""
+
+import logging
+import queue
+import threading
+import time
+
+from linebot.v3.webhooks import MessageEvent
+
+from metrics import Counters, LatencyStats
+
+logger = logging.getLogger(__name__)
+
+
+def dispatch_event(handler, event):
+    """依照 WebhookHandler.handle() 相同的規則找出已註冊的處理函式並執行單一事件。"""
+    func = None
+    if isinstance(event, MessageEvent):
+        key = f"{type(event).__name__}_{type(event.message).__name__}"
+        func = handler._handlers.get(key)
+    if func is None:
+        func = handler._handlers.get(type(event).__name__)
+    if func is None:
+        func = handler._default
+    if func is None:
+        logger.info(f"[dispatch_event] No handler for {type(event).__name__}")
+        return
+    func(event)
+
+
+class EventQueue:
+    """有上限的記憶體內工作佇列，由固定數量的 worker 執行緒消化。"""
+
+    def __init__(self, process, workers=4, maxsize=100, name="webhook"):
+        self._process = process
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._workers = workers
+        self._name = name
+        self._threads = []
+        self._stopping = threading.Event()
+        self.counters = Counters("enqueued", "processed", "failed", "rejected")
+        self.wait_time = LatencyStats()
+        self.process_time = LatencyStats()
+
+    def start(self):
+        for i in range(self._workers):
+            thread = threading.Thread(
+                target=self._run, name=f"{self._name}-worker-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"[EventQueue] {self._name}: started {self._workers} workers")
+
+    def submit(self, item):
+        """放入佇列；佇列已滿時回傳 False，由呼叫端決定如何處理。"""
+        try:
+            self._queue.put_nowait((time.monotonic(), item))
+        except queue.Full:
+            self.counters.incr("rejected")
+            return False
+        self.counters.incr("enqueued")
+        return True
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def shutdown(self, timeout=10.0):
+        """停止接收新工作，並在 timeout 內盡量處理完佇列中剩餘的事件。"""
+        self._stopping.set()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+    def _run(self):
+        while True:
+            try:
+                enqueued_at, item = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+            started = time.monotonic()
+            self.wait_time.record(started - enqueued_at)
+            try:
+                self._process(item)
+                self.counters.incr("processed")
+            except Exception as e:
+                self.counters.incr("failed")
+                logger.error(f"[EventQueue] {self._name}: error while processing event: {e}")
+            finally:
+                self.process_time.record(time.monotonic() - started)
+                self._queue.task_done()
+
+    def stats(self):
+        return {
+            "depth": self.depth(),
+            "maxsize": self._queue.maxsize,
+            "workers": self._workers,
+            **self.counters.snapshot(),
+            "wait": self.wait_time.snapshot(),
+            "process": self.process_time.snapshot(),
+        }
@@ -1,13 +1,12 @@
 # ===東吳大學資料系 2025 年 LINEBOT ===
+import atexit
 import logging
+import multiprocessing
 import os
 import tempfile
-import uuid
-from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
 
-import markdown
-from bs4 import BeautifulSoup
-from flask import Flask, abort, request, send_from_directory
+from flask import Flask, abort, request
 
 from google import genai
 from google.genai import types
@@ -16,12 +15,8 @@ from google.genai.types import Tool, GenerateContentConfig, GoogleSearch
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
-    ApiClient,
     Configuration,
     ImageMessage,
-    MessagingApi,
-    MessagingApiBlob,
-    ReplyMessageRequest,
     TextMessage,
 )
 from linebot.v3.webhooks import (
@@ -30,30 +25,80 @@ from linebot.v3.webhooks import (
     TextMessageContent,
 )
 
-from PIL import Image
 from linebot.v3.webhooks import VideoMessageContent
-import requests
+
+from gemini_files import GeminiFileUploader
+from grounding import GroundingSelector
+from image_pipeline import ImagePipeline
+from line_client import ContentTooLarge, LineClient
+from line_text import render_messages
+from media_jobs import MediaJobQueue
+from media_store import MediaStore, send_media
+from rate_limiter import (
+    FairRateLimiter,
+    RateLimitExceeded,
+    RateLimitedClient,
+    acting_for,
+    acts_for_sender,
+    current_user,
+    parse_rates,
+)
+from reply_scheduler import ReplyScheduler, event_time, source_id
 
 # === 初始化 Google Gemini ===
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
-client = genai.Client(api_key=GOOGLE_API_KEY)
+# 與 gemini.py 相同的限流設定：GEMINI_RPM 為全域每分鐘上限，GEMINI_MODEL_RPM 為各模型上限（0/未設定表示不限）
+rate_limiter = FairRateLimiter(
+    global_rpm=float(os.getenv("GEMINI_RPM", "0")),
+    model_rpm=parse_rates(os.getenv("GEMINI_MODEL_RPM", "")),
+    burst=int(os.getenv("GEMINI_RATE_BURST", "5")),
+    max_wait=float(os.getenv("GEMINI_RATE_MAX_WAIT", "20")),
+)
+client = RateLimitedClient(genai.Client(api_key=GOOGLE_API_KEY), rate_limiter)
 
 google_search_tool = Tool(
     google_search=GoogleSearch()
 )
 
+chat_config = GenerateContentConfig(
+    system_instruction="你是一個中文的AI助手，關於所有問題，請用繁體中文文言文回答",
+    tools=[google_search_tool],
+    response_modalities=["TEXT"],
+)
+CHAT_MODEL = "gemini-2.5-pro-preview-05-06"
+# chats 不經過 RateLimitedModels，send_message 前由 query() 自行取得額度
 chat = client.chats.create(
-    model="gemini-2.5-pro-preview-05-06",
-    config=GenerateContentConfig(
-        system_instruction="你是一個中文的AI助手，關於所有問題，請用繁體中文文言文回答",
-        tools=[google_search_tool],
-        response_modalities=["TEXT"],
-    )
+    model=CHAT_MODEL,
+    config=chat_config,
 )
+# 只有需要即時資料的提問才帶 Google 搜尋工具
+grounding = GroundingSelector(chat_config, chat_config.model_copy(update={"tools": None}))
 
 # === 初始設定 ===
-static_tmp_path = tempfile.gettempdir()
-os.makedirs(static_tmp_path, exist_ok=True)
+# 上傳與生成的媒體檔以內容雜湊命名存放，超過容量或天數時自動清除
+media_store = MediaStore(
+    os.getenv("MEDIA_DIR", os.path.join(tempfile.gettempdir(), "linebot-media")),
+    max_bytes=int(os.getenv("MEDIA_MAX_MB", "1024")) * 1024 * 1024,
+    max_age=int(os.getenv("MEDIA_MAX_AGE_DAYS", "30")) * 86400,
+)
+# 圖片只解碼一次：縮小後送模型，另存小縮圖給 LINE 聊天室預覽；解碼與壓縮在子行程執行
+MEDIA_CPU_WORKERS = int(os.getenv("MEDIA_CPU_WORKERS", "2"))
+media_cpu_pool = (
+    ProcessPoolExecutor(MEDIA_CPU_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    if MEDIA_CPU_WORKERS > 0
+    else None
+)
+if media_cpu_pool is not None:
+    atexit.register(media_cpu_pool.shutdown)
+image_pipeline = ImagePipeline(
+    model_max_edge=int(os.getenv("IMAGE_MAX_EDGE", "1024")),
+    model_quality=int(os.getenv("IMAGE_QUALITY", "85")),
+    preview_max_edge=int(os.getenv("IMAGE_PREVIEW_EDGE", "240")),
+    executor=media_cpu_pool,
+)
+# 影片分段下載到媒體庫後經 Files API 上傳，記憶體用量不隨影片大小增加
+VIDEO_MAX_BYTES = int(os.getenv("VIDEO_MAX_MB", "200")) * 1024 * 1024
+file_uploader = GeminiFileUploader(client.files, timeout=float(os.getenv("VIDEO_PROCESS_TIMEOUT", "300")))
 base_url = os.getenv("SPACE_HOST")  # e.g., "your-space-name.hf.space"
 
 # === Flask 應用初始化 ===
@@ -70,17 +115,30 @@ channel_access_token = os.environ.get("YOUR_CHANNEL_ACCESS_TOKEN")
 configuration = Configuration(access_token=channel_access_token)
 handler = WebhookHandler(channel_secret)
 
+# reply token 快過期時先回「處理中」，結果改用 push 送出
+line_client = LineClient(configuration, pool_size=int(os.getenv("LINE_POOL_SIZE", "10")))
+atexit.register(line_client.close)
+reply_scheduler = ReplyScheduler(
+    line_client, budget=float(os.getenv("REPLY_TOKEN_BUDGET", "40"))
+)
+
 
 # === AI Query 包裝 ===
 def query(payload):
-    response = chat.send_message(message=payload)
+    _, config = grounding.select(payload)
+    try:
+        rate_limiter.acquire(current_user.get(), CHAT_MODEL)
+    except RateLimitExceeded as e:
+        logging.warning(f"[query] {e}")
+        return "目前使用人數較多，請稍後再試一次。"
+    response = chat.send_message(message=payload, config=config)
     return response.text
 
 
 # === 靜態圖檔路由 ===
 @app.route("/images/<filename>")
 def serve_image(filename):
-    return send_from_directory(static_tmp_path, filename)
+    return send_media(media_store, filename)
 
 
 # === LINE Webhook 接收端點 ===
@@ -106,6 +164,8 @@ def callback():
 
 # === 處理文字訊息 ===
 @handler.add(MessageEvent, message=TextMessageContent)
+@reply_scheduler.watch
+@acts_for_sender
 def handle_text_message(event):
     user_input = event.message.text.strip()
     if user_input.startswith("AI "):
@@ -123,166 +183,144 @@ def handle_text_message(event):
             # 處理回應中的圖片
             for part in response.candidates[0].content.parts:
                 if part.inline_data is not None:
-                    image = Image.open(BytesIO(part.inline_data.data))
-                    filename = f"{uuid.uuid4().hex}.png"
-                    image_path = os.path.join(static_tmp_path, filename)
-                    image.save(image_path)
+                    filename = media_store.put(part.inline_data.data, ".png")
 
                     # 建立圖片的公開 URL
                     image_url = f"https://{base_url}/images/{filename}"
                     app.logger.info(f"Image URL: {image_url}")
 
                     # 回傳圖片給 LINE 使用者
-                    with ApiClient(configuration) as api_client:
-                        line_bot_api = MessagingApi(api_client)
-                        line_bot_api.reply_message(
-                            ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[
-                                    ImageMessage(
-                                        original_content_url=image_url,
-                                        preview_image_url=image_url,
-                                    )
-                                ],
+                    reply_scheduler.reply(
+                        event,
+                        [
+                            ImageMessage(
+                                original_content_url=image_url,
+                                preview_image_url=image_url,
                             )
-                        )
+                        ],
+                    )
 
         except Exception as e:
             app.logger.error(f"Gemini API error: {e}")
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="抱歉，生成圖片時發生錯誤。")],
-                    )
-                )
+            reply_scheduler.reply(event, [TextMessage(text="抱歉，生成圖片時發生錯誤。")])
     else:
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            response = query(event.message.text)
-            html_msg = markdown.markdown(response)
-            soup = BeautifulSoup(html_msg, "html.parser")
-
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=soup.get_text())],
-                )
-            )
+        response = query(event.message.text)
+        reply_scheduler.reply(event, [TextMessage(text=chunk) for chunk in render_messages(response)])
 
 
-# === 處理圖片訊息 ===
-@handler.add(MessageEvent, message=ImageMessageContent)
-def handle_image_message(event):
-    # === 以下是處理圖片回傳部分 === #
-    with ApiClient(configuration) as api_client:
-        blob_api = MessagingApiBlob(api_client)
-        content = blob_api.get_message_content(message_id=event.message.id)
+# === 媒體分析工作 ===
+# webhook 只排入工作；下載、前處理與 Gemini 分析由背景 worker 執行，結果以 reply（token 仍有效時）或 push 送出
+def media_job_payload(event):
+    return {
+        "message_id": event.message.id,
+        "to": source_id(event),
+        "reply_token": event.reply_token,
+        "received_at": event_time(event),
+        "user_id": getattr(event.source, "user_id", None),
+    }
+
 
-    # Step 4：將圖片存到本地端
-    with tempfile.NamedTemporaryFile(
-        dir=static_tmp_path, suffix=".jpg", delete=False
-    ) as tf:
-        tf.write(content)
-        filename = os.path.basename(tf.name)
+def deliver_job_result(job, messages):
+    reply_scheduler.deliver(job["to"], job["reply_token"], job["received_at"], messages)
 
-    image_url = f"https://{base_url}/images/{filename}"
+
+def run_image_job(job):
+    content = line_client.get_message_content(job["message_id"])
+
+    # Step 4：原圖存到媒體庫，另存預覽用的小縮圖
+    prepared = image_pipeline.prepare(content)
+    image_url = f"https://{base_url}/images/{media_store.put(content, prepared.original_ext)}"
+    preview_url = f"https://{base_url}/images/{media_store.put(prepared.preview_bytes, '.jpg')}"
 
     app.logger.info(f"Image URL: {image_url}")
 
     # === 以下是解釋圖片 === #
-    image = Image.open(tf.name)
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        config=types.GenerateContentConfig(
-            system_instruction="你是一個資深的面相命理師，如果有人上手掌的照片，就幫他解釋手相，如果上傳正面臉部的照片，就幫他解釋面相，照片要先去背，如果是一般的照片，就正常說明照片不用算命，請用繁體中文回答",
-            response_modalities=["TEXT"],
-            tools=[google_search_tool],
-        ),
-        contents=[image, "用繁體中文描述這張圖片"],
-    )
+    # 工作排入前的舊資料沒有 user_id，算在共用額度
+    with acting_for(job.get("user_id")):
+        response = client.models.generate_content(
+            model="gemini-2.0-flash",
+            config=types.GenerateContentConfig(
+                system_instruction="你是一個資深的面相命理師，如果有人上手掌的照片，就幫他解釋手相，如果上傳正面臉部的照片，就幫他解釋面相，照片要先去背，如果是一般的照片，就正常說明照片不用算命，請用繁體中文回答",
+                response_modalities=["TEXT"],
+            ),
+            contents=[
+                types.Part.from_bytes(data=prepared.model_bytes, mime_type=prepared.mime_type),
+                "用繁體中文描述這張圖片",
+            ],
+        )
     app.logger.info(response.text)
 
     # === 以下是回傳圖片部分 === #
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[
-                    ImageMessage(
-                        original_content_url=image_url, preview_image_url=image_url
-                    ),
-                    TextMessage(text=response.text),
-                ],
-            )
-        )
+    deliver_job_result(
+        job,
+        [
+            ImageMessage(
+                original_content_url=image_url, preview_image_url=preview_url
+            ),
+            TextMessage(text=response.text),
+        ],
+    )
 
-# === 處理影片訊息 ===
 
-@handler.add(MessageEvent, message=VideoMessageContent)
-def handle_video_message(event):
-    # 下載影片內容
-    with ApiClient(configuration) as api_client:
-        blob_api = MessagingApiBlob(api_client)
-        video_data = blob_api.get_message_content(message_id=event.message.id)
-
-    # 儲存影片到本地
-    if video_data is None:
-        err_msg = "抱歉，無法取得影片內容。"
-        app.logger.error(err_msg)
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=err_msg)]
-                )
-            )
+def run_video_job(job):
+    # 分段下載到媒體庫，不把整部影片讀進記憶體；超過上限不重試，直接告知使用者
+    try:
+        with media_store.incoming(".mp4") as video:
+            line_client.download_message_content(job["message_id"], video, max_bytes=VIDEO_MAX_BYTES)
+    except ContentTooLarge:
+        deliver_job_result(job, [TextMessage(text=f"抱歉，影片超過 {VIDEO_MAX_BYTES // (1024 * 1024)} MB，無法處理。")])
         return
 
-    with tempfile.NamedTemporaryFile(
-        dir=static_tmp_path, suffix=".mp4", delete=False
-    ) as tf:
-        tf.write(video_data)
-        filename = os.path.basename(tf.name)
-
-    video_url = f"https://{base_url}/images/{filename}"
-    app.logger.info(f"Video URL: {video_url}")
-
-    # 影片說明
-    try:
-        video_response = requests.get(video_url)
-        video_response.raise_for_status()
-        video_data = video_response.content
+    video_url = f"https://{base_url}/images/{video.filename}"
+    app.logger.info(f"Video URL: {video_url} ({video.size} bytes)")
 
+    # 影片說明：由磁碟上傳到 Files API，contents 只帶檔案參照
+    with acting_for(job.get("user_id")), file_uploader.upload(video.path, "video/mp4") as video_file:
         response = client.models.generate_content(
             model="gemini-2.5-flash-preview-05-20",
             config=types.GenerateContentConfig(
                 system_instruction="你是一個專業的影片解說員，請用繁體中文簡要說明這段影片的內容。",
                 response_modalities=["TEXT"],
-                tools=[google_search_tool],
             ),
-            contents=[{"mime_type": "video/mp4", "data": video_data}, "用繁體中文描述這段影片"],
+            contents=[video_file, "用繁體中文描述這段影片"],
         )
-        description = response.text
-    except Exception as e:
-        app.logger.error(f"Gemini API error (video): {e}")
-        description = "抱歉，無法解釋這段影片內容。"
-    except Exception as e:
-        app.logger.error(f"Gemini API error (video): {e}")
-        description = "抱歉，無法解釋這段影片內容。"
 
     # 回傳影片連結與說明
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[
-                    TextMessage(text=f"影片連結：{video_url}"),
-                    TextMessage(text=description),
-                ],
-            )
-        )
\ No newline at end of file
+    deliver_job_result(
+        job,
+        [
+            TextMessage(text=f"影片連結：{video_url}"),
+            TextMessage(text=response.text),
+        ],
+    )
+
+
+def media_job_failed(kind, job, error):
+    text = "抱歉，無法解釋這段影片內容。" if kind == "video" else "抱歉，無法解釋這張圖片。"
+    deliver_job_result(job, [TextMessage(text=text)])
+
+
+media_jobs = MediaJobQueue(
+    os.getenv("MEDIA_JOB_DB", os.path.join(tempfile.gettempdir(), "linebot-media-jobs.db")),
+    {"image": run_image_job, "video": run_video_job},
+    on_failure=media_job_failed,
+    workers=int(os.getenv("MEDIA_JOB_WORKERS", "4")),
+    max_attempts=int(os.getenv("MEDIA_JOB_MAX_ATTEMPTS", "3")),
+    backoff=float(os.getenv("MEDIA_JOB_BACKOFF", "5")),
+)
+media_jobs.start()
+atexit.register(media_jobs.shutdown)
+
+
+# === 處理圖片與影片訊息 ===
+# 只顯示「輸入中」動畫並排入工作（不會用掉 reply token），webhook 立即回應
+@handler.add(MessageEvent, message=ImageMessageContent)
+def handle_image_message(event):
+    reply_scheduler.show_loading(event)
+    media_jobs.enqueue("image", media_job_payload(event), dedupe_key=event.message.id)
+
+
+@handler.add(MessageEvent, message=VideoMessageContent)
+def handle_video_message(event):
+    reply_scheduler.show_loading(event)
+    media_jobs.enqueue("video", media_job_payload(event), dedupe_key=event.message.id)
@@ -1,13 +1,17 @@
 # ===東吳大學資料系 2025 年 LINEBOT ===
+import atexit
+import json
 import logging
+import multiprocessing
 import os
+import re
+import sqlite3
 import tempfile
+import time
 import uuid
-from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 
-import markdown
-from bs4 import BeautifulSoup
-from flask import Flask, abort, request, send_from_directory
+from flask import Flask, abort, request
 
 from google import genai
 from google.genai import types
@@ -16,12 +20,8 @@ from google.genai.types import Tool, GenerateContentConfig, GoogleSearch
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
-    ApiClient,
     Configuration,
     ImageMessage,
-    MessagingApi,
-    MessagingApiBlob,
-    ReplyMessageRequest,
     TextMessage,
 )
 from linebot.v3.webhooks import (
@@ -31,22 +31,71 @@ from linebot.v3.webhooks import (
     TextMessageContent,
 )
 
-from PIL import Image
 from linebot.v3.webhooks import VideoMessageContent
 
+from admission import AdmissionController
+from chat_sessions import SessionManager
+from coalescer import Coalescer
+from conversation_store import ConversationStore
+from event_queue import EventQueue, dispatch_event
+from grounding import GroundingSelector
+from hedging import HedgedClient, parse_fallbacks
+from history_index import HistoryIndex, is_itinerary
+from itinerary import render_detail, render_summary
+from line_client import ContentTooLarge, LineClient
+from line_text import render, split_messages
+from gemini_files import GeminiFileUploader
+from image_pipeline import ImagePipeline
+from intent_router import EMOJI_ONLY, Intent, IntentRouter
+from media_cache import MediaResponseCache
+from media_jobs import MediaJobQueue
+from media_store import MediaStore, send_media
+from metrics import Counters, LatencyStats
+from prefetch import DetailPrefetcher
+from rate_limiter import (
+    FairRateLimiter,
+    RateLimitExceeded,
+    RateLimitedClient,
+    acting_for,
+    acts_for_sender,
+    parse_rates,
+)
+from reply_scheduler import ReplyScheduler, event_time, source_id
+from response_cache import ResponseCache, config_fingerprint
+from streaming import iter_blocks
+
 # === 初始化 Google Gemini ===
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
-client = genai.Client(api_key=GOOGLE_API_KEY)
+# 所有 Gemini 呼叫共用的限流：GEMINI_RPM 為全域每分鐘上限，GEMINI_MODEL_RPM 為各模型上限（0/未設定表示不限）
+rate_limiter = FairRateLimiter(
+    global_rpm=float(os.getenv("GEMINI_RPM", "0")),
+    model_rpm=parse_rates(os.getenv("GEMINI_MODEL_RPM", "")),
+    burst=int(os.getenv("GEMINI_RATE_BURST", "5")),
+    max_wait=float(os.getenv("GEMINI_RATE_MAX_WAIT", "20")),
+)
+# HEDGE_REQUESTS=1：主要模型慢於近期延遲百分位數時，向備援模型再送一次請求，取先完成者
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "0") == "1"
+# 限流在避險之下：避險請求與失敗重送都是實際送出的呼叫，各自扣實際使用模型的額度
+hedged_client = HedgedClient(
+    RateLimitedClient(genai.Client(api_key=GOOGLE_API_KEY), rate_limiter),
+    fallbacks=parse_fallbacks(os.getenv("HEDGE_MODELS", "")),
+    enabled=HEDGE_REQUESTS,
+    percentile=float(os.getenv("HEDGE_PERCENTILE", "95")),
+    min_delay=float(os.getenv("HEDGE_MIN_DELAY", "1")),
+    max_delay=float(os.getenv("HEDGE_MAX_DELAY", "15")),
+    budget=float(os.getenv("HEDGE_BUDGET", "0.1")),
+)
+atexit.register(hedged_client.models.shutdown)
+client = hedged_client
 
 google_search_tool = Tool(
     google_search=GoogleSearch()
 )
 
-chat = client.chats.create(
-    model="gemini-2.0-flash",
-    config=GenerateContentConfig(
-        # 修改為旅遊規劃專家
-        system_instruction="""
+# 每位使用者各自一段對話，避免所有人的歷史累積在同一個 chat 裡
+chat_config = GenerateContentConfig(
+    # 修改為旅遊規劃專家
+    system_instruction="""
 你是LINE平台上的旅遊機器人「旅遊小管家 小花」，目標是成為用戶的旅遊達人，協助探索、規劃旅程、解答問題。核心功能：
 
 1. 依興趣（美食、文化、戶外）、預算(預設台幣)、地點，推薦景點、餐廳。
@@ -110,14 +159,125 @@ chat = client.chats.create(
 
 希望我有為您打造一個經濟又有趣的台南之旅！
 """,
-        tools=[google_search_tool],
-        response_modalities=["TEXT"],
-    )
+    tools=[google_search_tool],
+    response_modalities=["TEXT"],
+)
+
+# === Google 搜尋 ===
+# 只有需要即時資料（天氣、價格、日期、營業時間等）的提問才帶搜尋工具；行程規劃、閒聊直接回答，省下搜尋的延遲與費用
+# SEARCH_GROUNDING=auto 依提問判斷，always / never 固定帶或不帶
+chat_config_offline = chat_config.model_copy(update={"tools": None})
+grounding = GroundingSelector(chat_config, chat_config_offline, mode=os.getenv("SEARCH_GROUNDING", "auto"))
+
+# === 對話儲存 ===
+# Hugging Face Space 開啟 Persistent Storage 時會掛載 /data，重啟後資料仍在
+default_db_dir = "/data" if os.path.isdir("/data") else tempfile.gettempdir()
+store = ConversationStore(
+    os.getenv("CONVERSATION_DB", os.path.join(default_db_dir, "conversations.db")),
+    flush_interval=float(os.getenv("CONVERSATION_FLUSH_INTERVAL", "0.2")),
 )
+atexit.register(store.close)
+
+sessions = SessionManager(
+    client,
+    model="gemini-2.0-flash",
+    config=chat_config,
+    max_sessions=int(os.getenv("SESSION_MAX_USERS", "500")),
+    max_turns=int(os.getenv("SESSION_MAX_TURNS", "10")),
+    idle_ttl=int(os.getenv("SESSION_IDLE_TTL", "1800")),
+    store=store,
+)
+
+# === 回應快取 ===
+# RESPONSE_CACHE=1：對話歷史相同時，相同的提問直接回傳快取，並合併同時進行的相同呼叫
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "256")),
+    ttl=int(os.getenv("RESPONSE_CACHE_TTL", "3600")),
+)
+# 帶 Google 搜尋的回答（天氣、價格、營業時間等）很快就會過時，只保留較短的時間；0 表示不快取
+RESPONSE_CACHE_GROUNDED_TTL = int(os.getenv("RESPONSE_CACHE_GROUNDED_TTL", "300"))
+chat_fingerprints = {grounded: config_fingerprint(sessions.model, config) for grounded, config in grounding.configs.items()}
+
+# === 本地意圖 ===
+# 選單指令的別名換成標準指令；問候、感謝、使用說明、純貼圖式的訊息直接以固定文字回覆，不呼叫 Gemini
+# 「好」「ok」這類簡短回應可能是在回答小花的提問，刻意不列入
+INTENT_ROUTER = os.getenv("INTENT_ROUTER", "1") == "1"
+HELP_TEXT = (
+    "我是旅遊小管家小花 🌸 可以幫您：\n"
+    "1. 規劃行程：直接告訴我地點、天數、預算和喜好\n"
+    "2. 查詢景點、美食、交通等旅遊資訊\n"
+    "3. 看圖片或影片：傳給我就會幫您說明\n"
+    "4. 瀏覽歷史紀錄：按下選單的「我要瀏覽歷史紀錄」\n"
+    "5. 重新開始：按下選單的「我要新增規劃」"
+)
+intent_router = IntentRouter([
+    Intent("browse_history", command="我要瀏覽歷史紀錄",
+           phrases=("我要瀏覽歷史紀錄", "瀏覽歷史紀錄", "歷史紀錄", "歷史記錄", "查看歷史紀錄", "查詢歷史紀錄")),
+    Intent("end_search", command="結束搜尋",
+           phrases=("結束搜尋", "結束查詢", "離開搜尋", "退出搜尋", "停止搜尋")),
+    Intent("new_plan", command="我要新增規劃",
+           phrases=("我要新增規劃", "新增規劃", "新增行程", "重新規劃", "我要規劃行程")),
+    Intent("greeting", reply="嗨！我是旅遊小管家小花 🌸 想去哪裡玩呢？告訴我地點、天數和預算，我馬上幫您規劃行程！",
+           patterns=(r"(你好|您好|哈囉|哈嘍|嗨|安安|hi|hello|hey|早安|午安|晚安)+ ?(啊|呀|喔|唷)?( ?(小花|小管家))?",)),
+    Intent("thanks", reply="不客氣！祝您旅途愉快，有需要隨時找小花喔 😊",
+           phrases=("3q", "thx", "thanks", "thank you", "thank you very much"),
+           patterns=(r"(謝謝|感謝|謝啦|多謝|感恩)+(你|您|小花)?(的幫忙|幫忙)?( ?(小花|啦|喔))?",)),
+    Intent("help", reply=HELP_TEXT,
+           phrases=("help", "幫助", "說明", "使用說明", "怎麼用", "如何使用", "功能", "選單", "你會做什麼", "你可以做什麼")),
+    Intent("sticker", reply="😊 想去哪裡玩呢？直接告訴小花吧！",
+           patterns=(EMOJI_ONLY, r"(哈|呵|嘻|ㄏ|笑)+")),
+])
+
+# 圖片／影片說明不含個人對話內容，轉傳的相同（或幾乎相同）內容直接回傳上次的說明
+# 說明圖片、看手相面相只需要畫面本身，不帶 Google 搜尋工具
+IMAGE_MODEL = "gemini-2.0-flash"
+image_config = types.GenerateContentConfig(
+    system_instruction="你是一個資深的面相命理師，如果有人上手掌的照片，就幫他解釋手相，如果上傳正面臉部的照片，就幫他解釋面相，照片要先去背，如果是一般的照片，就正常說明照片不用算命，請用繁體中文回答",
+    response_modalities=["TEXT"],
+)
+VIDEO_MODEL = "gemini-2.5-flash-preview-05-20"
+video_config = types.GenerateContentConfig(
+    system_instruction="你是一個專業的影片解說員，請用繁體中文簡要說明這段影片的內容。",
+    response_modalities=["TEXT"],
+)
+MEDIA_CACHE = os.getenv("MEDIA_CACHE", "1") == "1"
+media_cache = MediaResponseCache(
+    max_entries=int(os.getenv("MEDIA_CACHE_SIZE", "512")),
+    ttl=int(os.getenv("MEDIA_CACHE_TTL", "86400")),
+    threshold=int(os.getenv("MEDIA_CACHE_THRESHOLD", "0")),
+    color_threshold=float(os.getenv("MEDIA_CACHE_COLOR_THRESHOLD", "12")),
+)
+image_fingerprint = config_fingerprint(IMAGE_MODEL, image_config)
+video_fingerprint = config_fingerprint(VIDEO_MODEL, video_config)
 
 # === 初始設定 ===
-static_tmp_path = tempfile.gettempdir()
-os.makedirs(static_tmp_path, exist_ok=True)
+# 使用者上傳的圖片與影片以內容雜湊命名存放，超過容量或天數時自動清除
+media_store = MediaStore(
+    os.getenv("MEDIA_DIR", os.path.join(default_db_dir, "media")),
+    max_bytes=int(os.getenv("MEDIA_MAX_MB", "1024")) * 1024 * 1024,
+    max_age=int(os.getenv("MEDIA_MAX_AGE_DAYS", "30")) * 86400,
+)
+# 圖片只解碼一次：縮小後送 Gemini，另存小縮圖給 LINE 聊天室預覽
+# 解碼與壓縮是 CPU 工作，交給子行程就不會和 webhook 執行緒搶 GIL；Gemini 呼叫仍在執行緒中等待
+# 用 spawn 而不是 fork：這個行程已有許多執行緒，fork 出的子行程可能繼承被鎖住的鎖
+MEDIA_CPU_WORKERS = int(os.getenv("MEDIA_CPU_WORKERS", "2"))
+media_cpu_pool = (
+    ProcessPoolExecutor(MEDIA_CPU_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    if MEDIA_CPU_WORKERS > 0
+    else None
+)
+if media_cpu_pool is not None:
+    atexit.register(media_cpu_pool.shutdown)
+image_pipeline = ImagePipeline(
+    model_max_edge=int(os.getenv("IMAGE_MAX_EDGE", "1024")),
+    model_quality=int(os.getenv("IMAGE_QUALITY", "85")),
+    preview_max_edge=int(os.getenv("IMAGE_PREVIEW_EDGE", "240")),
+    executor=media_cpu_pool,
+)
+# 影片分段下載到媒體庫後經 Files API 上傳，記憶體用量不隨影片大小增加
+VIDEO_MAX_BYTES = int(os.getenv("VIDEO_MAX_MB", "200")) * 1024 * 1024
+file_uploader = GeminiFileUploader(client.files, timeout=float(os.getenv("VIDEO_PROCESS_TIMEOUT", "300")))
 base_url = os.getenv("SPACE_HOST")  # e.g., "your-space-name.hf.space"
 
 # === Flask 應用初始化 ===
@@ -134,32 +294,290 @@ channel_access_token = os.environ.get("YOUR_CHANNEL_ACCESS_TOKEN")
 configuration = Configuration(access_token=channel_access_token)
 handler = WebhookHandler(channel_secret)
 
+# 每個 worker 共用一個保持連線的 LINE API 用戶端
+line_client = LineClient(configuration, pool_size=int(os.getenv("LINE_POOL_SIZE", "10")))
+atexit.register(line_client.close)
+
+# === 回覆排程 ===
+# reply token 只在短時間內有效；超過預算秒數仍未回覆時，先回「處理中」，結果改用 push 送出
+reply_scheduler = ReplyScheduler(
+    line_client, budget=float(os.getenv("REPLY_TOKEN_BUDGET", "40"))
+)
+
+# === 流量管制 ===
+# ADMISSION_CONTROL=1：處理中（與佇列中）的事件超過上限時，新訊息直接回覆「忙碌中」，不再呼叫 Gemini
+admission = AdmissionController(
+    enabled=os.getenv("ADMISSION_CONTROL", "0") == "1",
+    initial_limit=int(os.getenv("ADMISSION_INITIAL_LIMIT", "8")),
+    min_limit=int(os.getenv("ADMISSION_MIN_LIMIT", "2")),
+    max_limit=int(os.getenv("ADMISSION_MAX_LIMIT", "32")),
+    max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", "16")),
+)
+# 只以 Gemini 呼叫本身的延遲調整上限
+hedged_client.models.observers.append(admission.observe)
+BUSY_TEXT = "小花現在忙不過來，請稍後再傳一次訊息喔！"
+
+
+def process_event(event):
+    admission.run(lambda e: dispatch_event(handler, e), event)
+
+
+def shed_event(event):
+    """拒絕的事件只回一則固定訊息；非訊息事件（加好友等）不需回覆。"""
+    if not isinstance(event, MessageEvent):
+        return
+    try:
+        reply_scheduler.reply(event, [TextMessage(text=BUSY_TEXT)])
+    except Exception as e:
+        app.logger.error(f"[shed_event] Failed to send busy reply: {e}")
+
+
+# === Webhook 處理模式 ===
+# ASYNC_WEBHOOK=1：簽章驗證後立即回 200，事件放進有上限的佇列，由背景 worker 呼叫 Gemini
+ASYNC_WEBHOOK = os.getenv("ASYNC_WEBHOOK", "0") == "1"
+event_queue = EventQueue(
+    process=process_event,
+    workers=int(os.getenv("WEBHOOK_WORKERS", "4")),
+    maxsize=int(os.getenv("WEBHOOK_QUEUE_SIZE", "100")),
+)
+if ASYNC_WEBHOOK:
+    event_queue.start()
+    atexit.register(event_queue.shutdown)
+
 
 # === AI Query 包裝 ===
-def query(payload):
-    logging.info(f"[query] Gemini input: {payload}")
+def text_messages(text):
+    """切成符合 LINE 字數與則數限制的 TextMessage。"""
+    return [TextMessage(text=chunk) for chunk in split_messages(text)]
+
+
+def ask_gemini(payload, user_id=None, grounded=True):
+    """送到使用者自己的對話，回傳文字；沒有內容時回傳 None。grounded 決定是否帶 Google 搜尋工具。"""
+    started = time.monotonic()
+    response = sessions.send(user_id, payload, config=grounding.configs[grounded])
+    grounding.record(grounded, time.monotonic() - started)
+    logging.info(f"[query] Gemini raw response: {response}")
+    # 防呆：response 可能不是物件或沒有 .text
+    if hasattr(response, "text"):
+        logging.info(f"[query] Gemini response.text: {response.text}")
+        return response.text
+    elif isinstance(response, str):
+        logging.info(f"[query] Gemini response(str): {response}")
+        return response
+    return None
+
+
+def query(payload, user_id=None, use_cache=False):
+    """use_cache 時快取 key 包含使用者目前的對話歷史，只有歷史相同（通常是新對話的第一句）才會命中。"""
+    logging.info(f"[query] Gemini input ({user_id}): {payload}")
+    grounded = grounding.needs_search(payload)
     try:
-        response = chat.send_message(message=payload)
-        logging.info(f"[query] Gemini raw response: {response}")
-        # 防呆：response 可能不是物件或沒有 .text
-        if hasattr(response, "text"):
-            logging.info(f"[query] Gemini response.text: {response.text}")
-            return response.text
-        elif isinstance(response, str):
-            logging.info(f"[query] Gemini response(str): {response}")
-            return response
+        if use_cache and RESPONSE_CACHE:
+            computed = False
+
+            def compute():
+                nonlocal computed
+                computed = True
+                return ask_gemini(payload, user_id, grounded)
+
+            history = sessions.history_digest(user_id)
+            key = response_cache.make_key(payload, f"{chat_fingerprints[grounded]}:{history}")
+            ttl = RESPONSE_CACHE_GROUNDED_TTL if grounded else None
+            text = response_cache.get_or_compute(key, compute, ttl=ttl)
+            if text and not computed:
+                # 快取命中或共用他人的呼叫結果，仍要記進這位使用者的對話
+                sessions.record(user_id, payload, text)
         else:
+            text = ask_gemini(payload, user_id, grounded)
+        if text is None:
             logging.warning("[query] Gemini response is empty or unknown format.")
             return "抱歉，AI 沒有回應內容。"
+        return text
+    except RateLimitExceeded as e:
+        logging.warning(f"[query] {e}")
+        return "目前使用人數較多，請稍後再試一次。"
     except Exception as e:
         logging.error(f"[query] Gemini API error in query(): {e}")
         return "抱歉，AI 回應時發生錯誤。"
 
 
+# === 串流回覆 ===
+# STREAM_REPLY=1：第一個完整段落先用 reply token 回覆，其餘段落以 push 依序補送
+STREAM_REPLY = os.getenv("STREAM_REPLY", "0") == "1"
+STREAM_MIN_BLOCK_CHARS = int(os.getenv("STREAM_MIN_BLOCK_CHARS", "20"))
+# 累積到這個字數才送一次 push，避免每段都用掉一則 push 額度
+STREAM_PUSH_CHARS = int(os.getenv("STREAM_PUSH_CHARS", "800"))
+stream_first_message = LatencyStats()
+stream_total = LatencyStats()
+
+
+def stream_reply(event, user_id, payload):
+    """串流呼叫 Gemini 並分段送出，回傳完整的回覆文字（失敗時回傳 None）。"""
+    started = time.monotonic()
+    sent = []
+    pending = []
+    # 串流的耗時包含送出訊息的時間，不計入 grounding 的延遲統計
+    config = grounding.configs[grounding.needs_search(payload)]
+    try:
+        for block in iter_blocks(sessions.send_stream(user_id, payload, config), STREAM_MIN_BLOCK_CHARS):
+            text = render(block)
+            if not sent:
+                reply_scheduler.reply(event, text_messages(text))
+                stream_first_message.record(time.monotonic() - started)
+            else:
+                pending.append(text)
+                if sum(len(t) for t in pending) >= STREAM_PUSH_CHARS:
+                    reply_scheduler.push(event, text_messages("\n\n".join(pending)))
+                    pending = []
+            sent.append(text)
+        if pending:
+            reply_scheduler.push(event, text_messages("\n\n".join(pending)))
+        if not sent:
+            reply_scheduler.reply(event, [TextMessage(text="抱歉，AI 沒有回應內容。")])
+            return None
+    except Exception as e:
+        app.logger.error(f"[stream_reply] Error while streaming: {e}")
+        if pending:
+            # 中途失敗前已收到、還沒送出的段落先送出，使用者不會漏看
+            try:
+                reply_scheduler.push(event, text_messages("\n\n".join(pending)))
+            except Exception as push_error:
+                app.logger.error(f"[stream_reply] Failed to push pending blocks: {push_error}")
+        # 已經用掉 reply token 時，reply() 會自動改用 push
+        reply_scheduler.reply(event, [TextMessage(text="抱歉，AI 回應時發生錯誤。")])
+        return None
+    stream_total.record(time.monotonic() - started)
+    logging.info(f"[stream_reply] Sent {len(sent)} block(s)")
+    return "\n\n".join(sent)
+
+
+# === 歷史紀錄查詢 ===
+# 行程產生時就寫入本地全文索引，查詢關鍵字不必呼叫 Gemini
+history_index = HistoryIndex(store.path)
+HISTORY_SEARCH_LIMIT = int(os.getenv("HISTORY_SEARCH_LIMIT", "10"))
+# 本地索引查不到時（例如建立索引前的舊對話），是否改請 Gemini 從對話記憶中回想
+HISTORY_LLM_FALLBACK = os.getenv("HISTORY_LLM_FALLBACK", "1") == "1"
+# 回想時要求 Gemini 直接輸出符合 schema 的 JSON（結構化輸出不能與 Google 搜尋工具併用）
+history_recall_config = GenerateContentConfig(
+    system_instruction=chat_config.system_instruction,
+    response_mime_type="application/json",
+    response_schema=types.Schema(
+        type=types.Type.ARRAY,
+        items=types.Schema(
+            type=types.Type.OBJECT,
+            properties={
+                "date": types.Schema(type=types.Type.STRING),
+                "title": types.Schema(type=types.Type.STRING),
+                "morning": types.Schema(type=types.Type.STRING),
+                "afternoon": types.Schema(type=types.Type.STRING),
+                "evening": types.Schema(type=types.Type.STRING),
+            },
+            required=["date", "title", "morning", "afternoon", "evening"],
+        ),
+    ),
+)
+history_recall_counters = Counters("requests", "parsed", "empty", "parse_failures")
+
+
+def index_itinerary(user_id, text):
+    try:
+        history_index.add(user_id, text)
+    except sqlite3.Error as e:
+        logging.error(f"[index_itinerary] Failed to index itinerary: {e}")
+
+
+def search_local_history(user_id, keyword):
+    # 只存 doc_id 與摘要，完整內容在使用者選擇時才由索引取出
+    results = []
+    for i, hit in enumerate(history_index.search(user_id, keyword, limit=HISTORY_SEARCH_LIMIT)):
+        summary = f"a{i+1}. {hit['date']}-{hit['title']}"
+        slots = render_summary(hit["record"]) if hit["record"] else ""
+        if slots:
+            summary = f"{summary}\n{slots}"
+        results.append({"summary": summary, "full": "", "doc_id": hit["id"]})
+    logging.info(f"[search_local_history] {len(results)} hit(s) for: {keyword}")
+    return results
+
+
+def load_itinerary_detail(user_id, item):
+    """由本地索引組出完整行程；不是來自本地索引的搜尋結果回傳空字串。"""
+    if not item.get("doc_id"):
+        return ""
+    doc = history_index.get(user_id, item["doc_id"])
+    if doc is None:
+        return ""
+    return render_detail(doc["record"], doc["text"])
+
+
+def recall_history_from_llm(user_id, keyword):
+    """請 Gemini 依對話記憶以 JSON 列出相關行程，回傳 (results, 查無結果或失敗時的說明文字)。"""
+    prompt = (
+        f"請根據你與我的所有對話記憶，查詢與「{keyword}」相關的所有旅遊行程紀錄，"
+        "只列出與該關鍵字有關的紀錄。每筆紀錄請提供日期、行程標題，"
+        "以及第一天早上、下午、晚上的簡要說明（各一句話）。"
+        "沒有相關紀錄時回傳空陣列。請以繁體中文填寫。"
+    )
+    history_recall_counters.incr("requests")
+    # 只參考對話記憶，這一輪 JSON 問答不寫進歷史
+    response = sessions.send(user_id, prompt, config=history_recall_config, remember=False)
+    raw = getattr(response, "text", None) or ""
+    logging.info(f"[recall_history_from_llm] Gemini JSON response: {raw}")
+    try:
+        entries = json.loads(raw)
+        if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+            raise ValueError("expected a JSON array of objects")
+    except ValueError as e:
+        history_recall_counters.incr("parse_failures")
+        logging.warning(f"[recall_history_from_llm] Failed to parse JSON: {e}")
+        return [], "抱歉，暫時無法整理您的歷史紀錄，請稍後再試。"
+
+    results = []
+    for i, entry in enumerate(entries):
+        date = str(entry.get("date", "")).strip()
+        title = str(entry.get("title", "")).strip() or "旅遊行程"
+        # 借用結構化行程的格式產生摘要，與本地索引的結果一致
+        record = {
+            "destination": "", "dates": date, "budget": [],
+            "days": [{slot: str(entry.get(slot, "")).strip() for slot in ("morning", "afternoon", "evening")}],
+        }
+        summary = f"a{i+1}. {date}-{title}" if date else f"a{i+1}. {title}"
+        slots = render_summary(record)
+        if slots:
+            summary = f"{summary}\n{slots}"
+        results.append({"summary": summary, "full": "", "doc_id": None})
+    history_recall_counters.incr("parsed" if results else "empty")
+    return results, f"查無與「{keyword}」相關的旅遊行程紀錄，請換個關鍵字試試。"
+
+
+def fetch_recalled_detail(user_id, item):
+    """請 Gemini 依摘要從對話記憶還原完整行程；只參考歷史，不寫入。"""
+    summary_no_num = re.sub(r"^a\d+\.\s*", "", item["summary"])
+    prompt = (
+        f"請根據你與我的所有對話記憶，針對以下摘要內容，"
+        f"詳細列出該旅遊行程的完整內容，請分早上、下午、晚上，"
+        f"並以繁體中文回覆：\n{summary_no_num}"
+    )
+    # 預先載入在背景執行緒執行，要自行標明是替哪位使用者呼叫
+    with acting_for(user_id):
+        response = sessions.send(user_id, prompt, remember=False)
+    return render(getattr(response, "text", None) or "")
+
+
+# Gemini 回想出的搜尋結果沒有本地全文，列出摘要後就在背景預先抓前幾筆的完整內容
+detail_prefetcher = DetailPrefetcher(
+    fetch_recalled_detail,
+    max_workers=int(os.getenv("PREFETCH_WORKERS", "2")),
+    top_n=int(os.getenv("PREFETCH_TOP_N", "3")),
+)
+atexit.register(detail_prefetcher.shutdown)
+# 使用者選擇時，若該筆仍在預先載入中，最多等幾秒（通常比重新詢問快）
+PREFETCH_WAIT = float(os.getenv("PREFETCH_WAIT", "20"))
+
+
 # === 靜態圖檔路由 ===
 @app.route("/images/<filename>")
 def serve_image(filename):
-    return send_from_directory(static_tmp_path, filename)
+    return send_media(media_store, filename)
 
 
 # === LINE Webhook 接收端點 ===
@@ -176,8 +594,20 @@ def callback():
     app.logger.info(f"[callback] Signature: {signature}")
 
     try:
-        handler.handle(body, signature)
-        app.logger.info("[callback] Handler.handle() success")
+        # parse() 會先驗證簽章，失敗時同樣拋出 InvalidSignatureError
+        events = handler.parser.parse(body, signature)
+        for event in events:
+            # 同步模式下事件就在 webhook 執行緒處理，不另外允許排隊
+            if not admission.admit(queueing=ASYNC_WEBHOOK):
+                app.logger.warning("[callback] Overloaded, shedding event")
+                shed_event(event)
+            elif not ASYNC_WEBHOOK:
+                process_event(event)
+            elif not event_queue.submit(event):
+                # 佇列已滿時退回同步處理，避免事件遺失
+                app.logger.warning("[callback] Event queue full, handling event inline")
+                process_event(event)
+        app.logger.info(f"[callback] Handled {len(events)} event(s)")
     except InvalidSignatureError:
         app.logger.warning("[callback] Invalid signature. Please check channel credentials.")
         abort(400)
@@ -188,362 +618,467 @@ def callback():
     return "OK"
 
 
+# === 效能指標 ===
+@app.route("/metrics")
+def metrics():
+    return {
+        "webhook_queue": event_queue.stats(),
+        "admission": admission.stats(),
+        "chat_sessions": sessions.stats(),
+        "conversation_store": store.stats(),
+        "history_index": history_index.stats(),
+        "history_recall": history_recall_counters.snapshot(),
+        "detail_prefetch": detail_prefetcher.stats(),
+        "response_cache": response_cache.stats(),
+        "search_grounding": grounding.stats(),
+        "media_cache": media_cache.stats(),
+        "reply_scheduler": reply_scheduler.stats(),
+        "line_client": line_client.stats(),
+        "media_store": media_store.stats(),
+        "media_jobs": media_jobs.stats(),
+        "image_sets": image_sets.stats(),
+        "text_batches": text_batches.stats(),
+        "intent_router": intent_router.stats(),
+        "image_pipeline": image_pipeline.stats(),
+        "gemini_files": file_uploader.stats(),
+        "gemini_hedging": hedged_client.models.stats(),
+        "gemini_rate_limit": rate_limiter.stats(),
+        "stream_reply": {
+            "first_message": stream_first_message.snapshot(),
+            "total": stream_total.snapshot(),
+        },
+    }
+
+
+# 以下狀態都存放在 SQLite，重啟後保留且各 worker 共用
+# 注意：取出的 list/dict 是複本，修改後要重新指定回去才會寫入
+
 # 用戶歷史查詢記錄（user_id: List[Tuple[地點, 建議]]）
-user_history = {}
+user_history = store.mapping("history")
 
 # 新增：用戶搜尋模式狀態（user_id: bool）
-user_search_mode = {}
+user_search_mode = store.mapping("search_mode")
 
 # 新增：用戶搜尋結果暫存（user_id: List[dict]）
-user_search_results = {}
+user_search_results = store.mapping("search_results")
 
 # 新增：用戶搜尋步驟狀態（user_id: str, value: "wait_keyword" | "wait_select"）
-user_search_step = {}
+user_search_step = store.mapping("search_step")
 
 # === 處理文字訊息 ===
 @handler.add(MessageEvent, message=TextMessageContent)
+@reply_scheduler.watch
+@acts_for_sender
 def handle_text_message(event):
     user_input = event.message.text.strip()
     user_id = event.source.user_id if hasattr(event.source, "user_id") else None
     logging.info(f"[handle_text_message] user_id: {user_id}, user_input: {user_input}")
 
+    in_search = bool(user_id and user_search_mode.get(user_id, False))
+    # 搜尋模式下的輸入都是關鍵字或選項，只比對指令別名，不做本地回覆
+    intent = intent_router.match(user_input, commands_only=in_search) if INTENT_ROUTER else None
+    if intent is not None and intent.command:
+        user_input = intent.command
+
+    # 指令、本地回覆與搜尋模式的訊息不合併；先送出這位使用者還在等待合併的訊息，維持先後順序
+    if TEXT_COALESCE and user_id and (intent is not None or in_search):
+        finish_text_batch(user_id)
+
+    if intent is not None and intent.reply:
+        logging.info(f"[handle_text_message] Local reply for intent: {intent.name}")
+        reply_scheduler.reply(event, [TextMessage(text=intent.reply)])
+        return
+
     # 進入歷史紀錄搜尋模式
     if user_input == "我要瀏覽歷史紀錄":
         if user_id:
             # 只在進入歷史紀錄查詢時清除所有紀錄與狀態
+            detail_prefetcher.cancel(user_id)
             user_search_results[user_id] = []
             user_search_step[user_id] = "wait_keyword"
             user_search_mode[user_id] = True
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            ask_msg = (
-                "請直接輸入您想查詢的國家地點或關鍵字（多次查詢皆可），"
-                "記得按下「結束搜尋」選單按紐來結束搜尋模式。"
-            )
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=ask_msg)],
-                )
-            )
+        ask_msg = (
+            "請直接輸入您想查詢的國家地點或關鍵字（多次查詢皆可），"
+            "記得按下「結束搜尋」選單按紐來結束搜尋模式。"
+        )
+        reply_scheduler.reply(event, [TextMessage(text=ask_msg)])
         return
 
     # 結束歷史紀錄搜尋模式
     if user_input == "結束搜尋":
+        if user_id:
+            detail_prefetcher.cancel(user_id)
         if user_id and user_id in user_search_mode:
             user_search_mode[user_id] = False
             if user_id in user_search_results:
                 del user_search_results[user_id]
             if user_id in user_search_step:
                 del user_search_step[user_id]
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            msg = "已結束歷史紀錄查詢，請繼續使用其他功能。"
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=msg)],
-                )
-            )
+        msg = "已結束歷史紀錄查詢，請繼續使用其他功能。"
+        reply_scheduler.reply(event, [TextMessage(text=msg)])
         return
 
     # 搜尋模式下，所有輸入都交給 Gemini 查詢記憶
-    if user_id and user_search_mode.get(user_id, False):
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            try:
-                step = user_search_step.get(user_id, "wait_keyword")
-                # 只允許查詢一次關鍵字，之後只能選擇紀錄
-                if step == "wait_select" and user_id in user_search_results and user_search_results[user_id]:
-                    if user_input.lower().startswith("a") and user_input[1:].isdigit():
-                        idx = int(user_input[1:]) - 1
-                        results = user_search_results[user_id]
-                        if 0 <= idx < len(results):
-                            if results[idx]["full"]:
-                                detail = results[idx]["full"]
-                                reply_text = f"這是您第a{idx+1}個規劃的完整內容：\n{detail}"
-                            else:
-                                summary = results[idx]["summary"]
-                                import re
-                                summary_no_num = re.sub(r"^a\d+\.\s*", "", summary)
-                                prompt = (
-                                    f"請根據你與我的所有對話記憶，針對以下摘要內容，"
-                                    f"詳細列出該旅遊行程的完整內容，請分早上、下午、晚上，"
-                                    f"並以繁體中文回覆：\n{summary_no_num}"
-                                )
-                                detail = query(prompt)
-                                user_search_results[user_id][idx]["full"] = detail
-                                reply_text = f"這是您第a{idx+1}個規劃的完整內容：\n{detail}"
-                            line_bot_api.reply_message(
-                                ReplyMessageRequest(
-                                    reply_token=event.reply_token,
-                                    messages=[TextMessage(text=reply_text)],
-                                )
-                            )
-                        else:
-                            line_bot_api.reply_message(
-                                ReplyMessageRequest(
-                                    reply_token=event.reply_token,
-                                    messages=[TextMessage(text="查無此編號，請重新輸入。")],
-                                )
-                            )
-                        return
-                    elif user_input == "全部顯示":
-                        details = "\n\n".join(
-                            f"a{i+1}.\n{item['full'] or item['summary']}" for i, item in enumerate(user_search_results[user_id])
-                        )
-                        line_bot_api.reply_message(
-                            ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[TextMessage(text=details)],
-                            )
-                        )
-                        return
-                    else:
-                        line_bot_api.reply_message(
-                            ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[TextMessage(text="請輸入想查看的編號（例如：a1），或輸入「全部顯示」。")],
-                            )
-                        )
-                        return
-                if step == "wait_keyword":
-                    # 只允許查詢一次關鍵字
-                    prompt = (
-                        f"請根據你與我的所有對話記憶，查詢與「{user_input}」相關的所有旅遊行程紀錄，"
-                        "只顯示與該關鍵字有關的紀錄。\n"
-                        "如果有多筆，請依下列格式摘要列出，內容請簡短：\n"
-                        "a1. 🗓️ [日期] - [行程標題]\n"
-                        "   - 早上：[簡要說明]\n"
-                        "   - 下午：[簡要說明]\n"
-                        "   - 晚上：[簡要說明]\n"
-                        "a2. ...\n"
-                        "請勿給完整內容，只給每筆紀錄的簡短摘要，並在每筆前加上代號（a1、a2、a3...）。\n"
-                        "最後請附註：請輸入想查看的代號（例如：a1），來查看完整內容。\n"
-                        "如果只有一筆，請直接顯示完整內容，並請分早上、下午、晚上。\n"
-                        "如果沒有相關紀錄，請明確說明。\n"
-                        "請以繁體中文回覆。"
-                    )
-                    response = query(prompt)
-                    logging.info(f"[search_mode] Gemini summary response: {response}")
-                    html_msg = markdown.markdown(response)
-                    soup = BeautifulSoup(html_msg, "html.parser")
-                    text = '\n'.join([line.strip() for line in soup.get_text(separator="\n").splitlines() if line.strip()])
-                    import re
-                    results = []
-                    # 解析 a1. a2. a3. ...
-                    if "請輸入想查看的代號" in text and re.search(r"a\d+\.\s", text):
-                        matches = re.findall(r"a(\d+)\.\s(.*?)(?=\na\d+\.\s|\Z)", text, re.DOTALL)
-                        for idx, (num, content) in enumerate(matches):
-                            date_place_match = re.search(r"🗓️\s*([^\s-]+(?:-[^\s-]+)*)\s*-\s*(.+)", content)
-                            if date_place_match:
-                                date_str = date_place_match.group(1).strip()
-                                place_str = date_place_match.group(2).strip()
-                                first_line = f"a{idx+1}. {date_str}-{place_str}"
-                                rest = content.split('\n', 1)[1].strip() if '\n' in content else ""
-                                summary = f"{first_line}\n{rest}" if rest else first_line
-                            else:
-                                summary = f"a{idx+1}. {content.strip()}"
-                            results.append({"summary": summary, "full": content.strip()})
-                        user_search_results[user_id] = results
-                        user_search_step[user_id] = "wait_select"
-                        summary_text = ""
-                        for i, item in enumerate(results):
-                            lines = item["summary"].split('\n', 1)
-                            summary_text += f"[a{i+1}] {lines[0]}\n"
-                            if len(lines) > 1:
-                                summary_text += f"{lines[1]}\n"
-                            summary_text += "\n"
-                        summary_text = summary_text.strip() + "\n\n請輸入想查看的代號（例如：a1），來查看完整內容。"
-                        line_bot_api.reply_message(
-                            ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[TextMessage(text=summary_text)],
+    if in_search:
+        try:
+            step = user_search_step.get(user_id, "wait_keyword")
+            # 只允許查詢一次關鍵字，之後只能選擇紀錄
+            if step == "wait_select" and user_id in user_search_results and user_search_results[user_id]:
+                if user_input.lower().startswith("a") and user_input[1:].isdigit():
+                    idx = int(user_input[1:]) - 1
+                    results = user_search_results[user_id]
+                    if 0 <= idx < len(results):
+                        # 本地索引的行程直接由結構化資料組出，不必再問 Gemini
+                        detail = results[idx]["full"] or load_itinerary_detail(user_id, results[idx])
+                        if not detail:
+                            # Gemini 回想的結果：先看背景是否已預先載入，沒有才同步詢問
+                            detail = (
+                                detail_prefetcher.get(user_id, results[idx], timeout=PREFETCH_WAIT)
+                                or fetch_recalled_detail(user_id, results[idx])
                             )
-                        )
+                            if detail:
+                                results[idx]["full"] = detail
+                                user_search_results[user_id] = results
+                        reply_text = f"這是您第a{idx+1}個規劃的完整內容：\n{detail or '抱歉，AI 沒有回應內容。'}"
+                        reply_scheduler.reply(event, text_messages(reply_text))
                     else:
-                        user_search_results[user_id] = []
-                        user_search_step[user_id] = "wait_keyword"
-                        line_bot_api.reply_message(
-                            ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[TextMessage(text=text)],
-                            )
+                        reply_scheduler.reply(event, [TextMessage(text="查無此編號，請重新輸入。")])
+                    return
+                elif user_input == "全部顯示":
+                    sections = []
+                    for i, item in enumerate(user_search_results[user_id]):
+                        detail = (
+                            item["full"]
+                            or load_itinerary_detail(user_id, item)
+                            or detail_prefetcher.get(user_id, item, timeout=PREFETCH_WAIT)
+                            or item["summary"]
                         )
-                    logging.info("[search_mode] reply_message_with_http_info sent")
+                        sections.append(f"a{i+1}.\n{detail}")
+                    reply_scheduler.reply(event, text_messages("\n\n".join(sections)))
                     return
-            except Exception as e:
-                app.logger.error(f"[search_mode] Error in search mode (Gemini memory): {e}")
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="抱歉，AI 查詢記憶時發生錯誤。")],
+                else:
+                    reply_scheduler.reply(
+                        event, [TextMessage(text="請輸入想查看的編號（例如：a1），或輸入「全部顯示」。")]
                     )
-                )
+                    return
+            if step == "wait_keyword":
+                # 只允許查詢一次關鍵字；先查本地索引，查不到才請 Gemini 回想
+                results = search_local_history(user_id, user_input)
+                text = f"查無與「{user_input}」相關的旅遊行程紀錄，請換個關鍵字試試。"
+                if not results and HISTORY_LLM_FALLBACK:
+                    results, text = recall_history_from_llm(user_id, user_input)
+                if results:
+                    user_search_results[user_id] = results
+                    user_search_step[user_id] = "wait_select"
+                    summary_text = ""
+                    for i, item in enumerate(results):
+                        lines = item["summary"].split('\n', 1)
+                        summary_text += f"[a{i+1}] {lines[0]}\n"
+                        if len(lines) > 1:
+                            summary_text += f"{lines[1]}\n"
+                        summary_text += "\n"
+                    summary_text = summary_text.strip() + "\n\n請輸入想查看的代號（例如：a1），來查看完整內容。"
+                    reply_scheduler.reply(event, text_messages(summary_text))
+                    # 列表送出後，在背景先抓使用者最可能選的幾筆完整內容
+                    detail_prefetcher.start(user_id, results)
+                else:
+                    user_search_results[user_id] = []
+                    user_search_step[user_id] = "wait_keyword"
+                    reply_scheduler.reply(event, [TextMessage(text=text)])
+                logging.info("[search_mode] reply sent")
+                return
+        except Exception as e:
+            app.logger.error(f"[search_mode] Error in search mode (Gemini memory): {e}")
+            reply_scheduler.reply(event, [TextMessage(text="抱歉，AI 查詢記憶時發生錯誤。")])
         return
-   
-    # 若用戶在搜尋模式下選擇摘要後，查詢完整內容
-    if user_id and user_id in user_search_results and user_search_results[user_id]:
-        pass
 
     if user_input == "我要新增規劃":
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            plan_msg = (
-                "請告訴我以下資訊:\n"
-                "\n"
-                "1.旅遊國家地點:\n"
-                "2.日期:\n"
-                "3.人數:\n"
-                "4.旅行預算:\n"
-                "5.住宿類型選擇:\n"
-                "6.交通方式:\n"
-                "7.想去的景點或餐廳:\n"
-                "\n"
-                "請幫我複製此對話框的訊息來回覆問題！"
-            )
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=plan_msg)],
-                )
-            )
+        plan_msg = (
+            "請告訴我以下資訊:\n"
+            "\n"
+            "1.旅遊國家地點:\n"
+            "2.日期:\n"
+            "3.人數:\n"
+            "4.旅行預算:\n"
+            "5.住宿類型選擇:\n"
+            "6.交通方式:\n"
+            "7.想去的景點或餐廳:\n"
+            "\n"
+            "請幫我複製此對話框的訊息來回覆問題！"
+        )
+        reply_scheduler.reply(event, [TextMessage(text=plan_msg)])
         return
 
-    else:
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            try:
-                logging.info(f"[handle_text_message] Querying Gemini with: {event.message.text}")
-                response = query(event.message.text)
-                logging.info(f"[handle_text_message] Gemini response: {response}")
-                html_msg = markdown.markdown(response)
-                soup = BeautifulSoup(html_msg, "html.parser")
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=soup.get_text())],
-                    )
-                )
-                logging.info("[handle_text_message] reply_message_with_http_info sent")
-            except Exception as e:
-                app.logger.error(f"[handle_text_message] Error in handle_text_message: {e}")
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="抱歉，AI 回應時發生錯誤。")],
-                    )
-                )
+    if TEXT_COALESCE and user_id:
+        # 只顯示「輸入中」動畫（不用掉 reply token），合併後由最後一則訊息的 reply token 回覆
+        reply_scheduler.show_loading(event)
+        text_batches.add(user_id, event)
+        return
 
-# === 處理圖片訊息 ===
-@handler.add(MessageEvent, message=ImageMessageContent)
-def handle_image_message(event):
-    # === 以下是處理圖片回傳部分 === #
-    with ApiClient(configuration) as api_client:
-        blob_api = MessagingApiBlob(api_client)
-        content = blob_api.get_message_content(message_id=event.message.id)
-
-    # Step 4：將圖片存到本地端
-    with tempfile.NamedTemporaryFile(
-        dir=static_tmp_path, suffix=".jpg", delete=False
-    ) as tf:
-        tf.write(content)
-        filename = os.path.basename(tf.name)
-
-    image_url = f"https://{base_url}/images/{filename}"
-
-    app.logger.info(f"Image URL: {image_url}")
-
-    # === 以下是解釋圖片 === #
-    image = Image.open(tf.name)
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        config=types.GenerateContentConfig(
-            system_instruction="你是一個資深的面相命理師，如果有人上手掌的照片，就幫他解釋手相，如果上傳正面臉部的照片，就幫他解釋面相，照片要先去背，如果是一般的照片，就正常說明照片不用算命，請用繁體中文回答",
-            response_modalities=["TEXT"],
-            tools=[google_search_tool],
-        ),
-        contents=[image, "用繁體中文描述這張圖片"],
-    )
-    app.logger.info(response.text)
+    answer_chat(event, user_id, event.message.text)
 
-    # === 以下是回傳圖片部分 === #
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[
-                    ImageMessage(
-                        original_content_url=image_url, preview_image_url=image_url
-                    ),
-                    TextMessage(text=response.text),
-                ],
-            )
-        )
 
-# === 處理影片訊息 ===
+def answer_chat(event, user_id, text):
+    """一般對話：串流或一次回覆；回覆送出後才建立行程索引，不影響回應時間。"""
+    if STREAM_REPLY and user_id:
+        reply_text = stream_reply(event, user_id, text)
+        if reply_text and is_itinerary(reply_text):
+            index_itinerary(user_id, reply_text)
+        return
 
-@handler.add(MessageEvent, message=VideoMessageContent)
-def handle_video_message(event):
-    # 下載影片內容
-    with ApiClient(configuration) as api_client:
-        blob_api = MessagingApiBlob(api_client)
-        video_data = blob_api.get_message_content(message_id=event.message.id)
-
-    # 儲存影片到本地
-    if video_data is None:
-        err_msg = "抱歉，無法取得影片內容。"
-        app.logger.error(err_msg)
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=err_msg)]
-                )
-            )
+    try:
+        logging.info(f"[answer_chat] Querying Gemini with: {text}")
+        response = query(text, user_id, use_cache=True)
+        logging.info(f"[answer_chat] Gemini response: {response}")
+        reply_text = render(response)
+        reply_scheduler.reply(event, text_messages(reply_text))
+        logging.info("[answer_chat] reply sent")
+        if user_id and is_itinerary(reply_text):
+            index_itinerary(user_id, reply_text)
+    except Exception as e:
+        app.logger.error(f"[answer_chat] Error in answer_chat: {e}")
+        reply_scheduler.reply(event, [TextMessage(text="抱歉，AI 回應時發生錯誤。")])
+
+
+# === 連續訊息合併 ===
+# TEXT_COALESCE=1：同一位使用者在 TEXT_COALESCE_WINDOW 秒內連續傳的訊息（例如「我想去東京」「五天」「預算三萬」）
+# 合併成一個提問，只呼叫一次 Gemini
+TEXT_COALESCE = os.getenv("TEXT_COALESCE", "0") == "1"
+text_batch_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("WEBHOOK_WORKERS", "4")), thread_name_prefix="text-batch"
+)
+atexit.register(text_batch_pool.shutdown)
+# 每位使用者最近一次送出、尚未完成的合併提問
+text_batch_futures = {}
+
+
+@reply_scheduler.watch
+@acts_for_sender
+def answer_text_batch(event, text):
+    answer_chat(event, event.source.user_id, text)
+
+
+def submit_text_batch(user_id, events):
+    """Coalescer 的 flush：計時器執行緒只負責排入，Gemini 呼叫在 text_batch_pool 執行。
+
+    合併後的提問同樣經過流量管制：排隊與執行中的數量計入 admission，超過上限時回覆「忙碌中」。
+    """
+    merged = "\n".join(event.message.text.strip() for event in events)
+    logging.info(f"[submit_text_batch] Merged {len(events)} message(s) from {user_id}")
+    if not admission.admit(queueing=True):
+        logging.warning(f"[submit_text_batch] Shedding merged prompt from {user_id}")
+        shed_event(events[-1])
         return
+    future = text_batch_pool.submit(admission.run, lambda event: answer_text_batch(event, merged), events[-1])
+    text_batch_futures[user_id] = future
+    future.add_done_callback(lambda done: text_batch_futures.pop(user_id, None) if text_batch_futures.get(user_id) is done else None)
+
+
+def finish_text_batch(user_id):
+    """送出這位使用者等待合併的訊息，並等到它（或計時器已送出、仍在執行的那一批）回覆完成，之後的回覆才不會跑到前面。
+
+    最多等 TEXT_COALESCE_FINISH_TIMEOUT 秒，Gemini 很慢時不會一直佔住 webhook 執行緒（此時先後順序不保證）。
+    """
+    text_batches.flush(user_id)
+    future = text_batch_futures.get(user_id)
+    if future is not None:
+        done, _ = wait([future], timeout=TEXT_COALESCE_FINISH_TIMEOUT)
+        if not done:
+            logging.warning(f"[finish_text_batch] Merged prompt from {user_id} still running, not waiting any longer")
+
+
+TEXT_COALESCE_WINDOW = float(os.getenv("TEXT_COALESCE_WINDOW", "2.5"))
+TEXT_COALESCE_FINISH_TIMEOUT = float(os.getenv("TEXT_COALESCE_FINISH_TIMEOUT", "15"))
+text_batches = Coalescer(
+    submit_text_batch,
+    window=TEXT_COALESCE_WINDOW,
+    max_wait=TEXT_COALESCE_WINDOW * 3,
+    max_items=int(os.getenv("TEXT_COALESCE_MAX", "5")),
+    name="text",
+)
+atexit.register(text_batches.flush_all)
+
+# === 媒體分析工作 ===
+# webhook 只排入工作；下載、前處理與 Gemini 分析由背景 worker 執行，結果以 reply（token 仍有效時）或 push 送出
+def media_job_payload(event):
+    return {
+        "message_id": event.message.id,
+        "user_id": getattr(event.source, "user_id", None),
+        "to": source_id(event),
+        "reply_token": event.reply_token,
+        "received_at": event_time(event),
+    }
+
+
+def deliver_job_result(job, messages):
+    reply_scheduler.deliver(job["to"], job["reply_token"], job["received_at"], messages)
+
+
+def run_image_job(job):
+    with acting_for(job["user_id"]):
+        content = line_client.get_message_content(job["message_id"])
+
+        # 原圖存到媒體庫（相同圖片只存一份），另存預覽用的小縮圖；解碼與壓縮在行程池執行
+        prepared = image_pipeline.prepare(content)
+        image_url = f"https://{base_url}/images/{media_store.put(content, prepared.original_ext)}"
+        preview_url = f"https://{base_url}/images/{media_store.put(prepared.preview_bytes, '.jpg')}"
+        app.logger.info(f"Image URL: {image_url}")
+
+        # === 以下是解釋圖片 === #
+        # 相近但不相同的圖片只比對同一位使用者傳過的，不會拿到別人圖片的說明
+        signature = (prepared.content_hash, prepared.dhash, prepared.colors)
+        description = media_cache.get_image(*signature, image_fingerprint, job["user_id"]) if MEDIA_CACHE else None
+        if description is None:
+            # 送出縮小後的 JPEG，上傳量與模型處理的圖片 token 都比原圖少
+            response = client.models.generate_content(
+                model=IMAGE_MODEL,
+                config=image_config,
+                contents=[
+                    types.Part.from_bytes(data=prepared.model_bytes, mime_type=prepared.mime_type),
+                    "用繁體中文描述這張圖片",
+                ],
+            )
+            description = response.text
+            if MEDIA_CACHE and description:
+                media_cache.put_image(*signature, image_fingerprint, job["user_id"], description)
+        app.logger.info(description)
 
-    with tempfile.NamedTemporaryFile(
-        dir=static_tmp_path, suffix=".mp4", delete=False
-    ) as tf:
-        tf.write(video_data)
-        filename = os.path.basename(tf.name)
+    # === 以下是回傳圖片部分 === #
+    deliver_job_result(
+        job,
+        [
+            ImageMessage(original_content_url=image_url, preview_image_url=preview_url),
+            *text_messages(render(description)),
+        ],
+    )
 
-    video_url = f"https://{base_url}/images/{filename}"
-    app.logger.info(f"Video URL: {video_url}")
 
-    # 影片說明
+def run_video_job(job):
+    # 分段下載到媒體庫，不把整部影片讀進記憶體；超過上限不重試，直接告知使用者
     try:
-        from io import BytesIO
-        video_bytes = BytesIO(video_data)
-        response = client.models.generate_content(
-            model="gemini-2.5-flash-preview-05-20",
-            config=types.GenerateContentConfig(
-                system_instruction="你是一個專業的影片解說員，請用繁體中文簡要說明這段影片的內容。",
-                response_modalities=["TEXT"],
-                tools=[google_search_tool],
-            ),
-            contents=[video_bytes, "用繁體中文描述這段影片"],
-        )
+        with media_store.incoming(".mp4") as video:
+            line_client.download_message_content(job["message_id"], video, max_bytes=VIDEO_MAX_BYTES)
+    except ContentTooLarge:
+        deliver_job_result(job, [TextMessage(text=f"抱歉，影片超過 {VIDEO_MAX_BYTES // (1024 * 1024)} MB，無法處理。")])
+        return
+
+    video_url = f"https://{base_url}/images/{video.filename}"
+    app.logger.info(f"Video URL: {video_url} ({video.size} bytes)")
+
+    # 影片說明：同一部影片（內容雜湊相同）直接使用上次的說明，連上傳都省下
+    description = media_cache.get(video.filename, video_fingerprint) if MEDIA_CACHE else None
+    if description is None:
+        with acting_for(job["user_id"]):
+            # 由磁碟上傳到 Files API，contents 只帶檔案參照（主要與備援模型可共用同一份）
+            with file_uploader.upload(video.path, "video/mp4") as video_file:
+                response = client.models.generate_content(
+                    model=VIDEO_MODEL,
+                    config=video_config,
+                    contents=[video_file, "用繁體中文描述這段影片"],
+                )
         description = response.text
-    except Exception as e:
-        app.logger.error(f"Gemini API error (video): {e}")
-        description = "抱歉，無法解釋這段影片內容。"
+        if MEDIA_CACHE and description:
+            media_cache.put(video.filename, video_fingerprint, description)
 
     # 回傳影片連結與說明
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[
-                    TextMessage(text=f"影片連結：{video_url}"),
-                    TextMessage(text=description),
+    deliver_job_result(
+        job,
+        [
+            TextMessage(text=f"影片連結：{video_url}"),
+            *text_messages(render(description)),
+        ],
+    )
+
+
+def run_image_set_job(job):
+    # 同一組的多張圖片一次送給 Gemini，回覆一則綜合說明（不另外回傳圖片，避免超過單次 5 則訊息）
+    with acting_for(job["user_id"]):
+        prepared = [image_pipeline.prepare(line_client.get_message_content(mid)) for mid in job["message_ids"]]
+        # 多張圖片只接受每一張內容都完全相同
+        set_key = ",".join(image.content_hash for image in prepared)
+        description = media_cache.get(set_key, image_fingerprint) if MEDIA_CACHE else None
+        if description is None:
+            response = client.models.generate_content(
+                model=IMAGE_MODEL,
+                config=image_config,
+                contents=[
+                    *(types.Part.from_bytes(data=image.model_bytes, mime_type=image.mime_type) for image in prepared),
+                    f"這是同時上傳的 {len(prepared)} 張圖片，請用繁體中文依序描述每一張",
                 ],
             )
-        )
+            description = response.text
+            if MEDIA_CACHE and description:
+                media_cache.put(set_key, image_fingerprint, description)
+        app.logger.info(description)
+
+    deliver_job_result(job, text_messages(render(description)))
+
+
+MEDIA_JOB_FAILURE_TEXT = {
+    "image": "抱歉，無法解釋這張圖片。",
+    "image_set": "抱歉，無法解釋這些圖片。",
+    "video": "抱歉，無法解釋這段影片內容。",
+}
+
+
+def media_job_failed(kind, job, error):
+    deliver_job_result(job, [TextMessage(text=MEDIA_JOB_FAILURE_TEXT.get(kind, "抱歉，處理時發生錯誤。"))])
+
+
+media_jobs = MediaJobQueue(
+    os.getenv("MEDIA_JOB_DB", os.path.join(default_db_dir, "media_jobs.db")),
+    {"image": run_image_job, "image_set": run_image_set_job, "video": run_video_job},
+    on_failure=media_job_failed,
+    workers=int(os.getenv("MEDIA_JOB_WORKERS", "4")),
+    max_attempts=int(os.getenv("MEDIA_JOB_MAX_ATTEMPTS", "3")),
+    backoff=float(os.getenv("MEDIA_JOB_BACKOFF", "5")),
+)
+media_jobs.start()
+atexit.register(media_jobs.shutdown)
+
+
+def enqueue_image_set(set_id, items):
+    """Coalescer 的 flush：依圖片順序排成一個工作，使用最晚收到的 reply token（剩餘時間最長）。"""
+    payloads = {}
+    for index, payload in sorted(items, key=lambda item: item[0]):
+        payloads.setdefault(payload["message_id"], payload)
+    ordered = list(payloads.values())
+    if len(ordered) == 1:
+        media_jobs.enqueue("image", ordered[0], dedupe_key=ordered[0]["message_id"])
+        return
+    latest = max(ordered, key=lambda payload: payload["received_at"])
+    job = {**latest, "message_ids": [payload["message_id"] for payload in ordered]}
+    media_jobs.enqueue("image_set", job, dedupe_key=f"set:{set_id}:{ordered[0]['message_id']}")
+
+
+# 一次傳多張圖片時 LINE 會逐張送出事件（imageSet.id 相同）：收齊 total 張或 IMAGE_SET_WINDOW 秒內沒有下一張就合併成一個工作
+image_sets = Coalescer(
+    enqueue_image_set,
+    window=float(os.getenv("IMAGE_SET_WINDOW", "3")),
+    max_wait=float(os.getenv("IMAGE_SET_MAX_WAIT", "10")),
+    name="image-set",
+)
+atexit.register(image_sets.flush_all)
+
+
+# === 處理圖片與影片訊息 ===
+# 只顯示「輸入中」動畫並排入工作（不會用掉 reply token），webhook 立即回應
+@handler.add(MessageEvent, message=ImageMessageContent)
+def handle_image_message(event):
+    image_set = event.message.image_set
+    if image_set is None:
+        reply_scheduler.show_loading(event)
+        media_jobs.enqueue("image", media_job_payload(event), dedupe_key=event.message.id)
+        return
+    if image_set.index in (None, 1):
+        reply_scheduler.show_loading(event)
+    image_sets.add(image_set.id, (image_set.index or 0, media_job_payload(event)), expected=image_set.total)
+
+
+@handler.add(MessageEvent, message=VideoMessageContent)
+def handle_video_message(event):
+    reply_scheduler.show_loading(event)
+    media_jobs.enqueue("video", media_job_payload(event), dedupe_key=event.message.id)
 
 
 # base_url 檢查
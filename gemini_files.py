@@ -0,0 +1,68 @@
+"""
+東吳大學資料系 2025 LINEBOT
+Gemini Files API 上傳：影片等大型檔案由磁碟分段上傳，generate_content 只帶檔案參照，用完即刪除
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+
+from google.genai import types
+
+from metrics import Counters, LatencyStats
+
+logger = logging.getLogger(__name__)
+
+
+class GeminiFileUploader:
+    """files 為 genai.Client 的 files（需有 upload / get / delete），本機測試可換成假的物件。
+
+    影片上傳後要等 Gemini 轉檔（state 由 PROCESSING 變成 ACTIVE）才能使用，最多等 timeout 秒。
+    """
+
+    def __init__(self, files, poll_interval=2.0, timeout=300.0):
+        self._files = files
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.counters = Counters("uploads", "failed", "timeouts", "deleted", "delete_errors")
+        self.upload_time = LatencyStats()
+        self.processing_time = LatencyStats()
+
+    @contextmanager
+    def upload(self, path, mime_type):
+        """上傳 path 並等待可用，with 區塊內取得的 File 可直接放進 contents；離開後刪除遠端檔案。"""
+        started = time.monotonic()
+        file = self._files.upload(file=path, config=types.UploadFileConfig(mime_type=mime_type))
+        uploaded = time.monotonic()
+        self.upload_time.record(uploaded - started)
+        self.counters.incr("uploads")
+        try:
+            while file.state == types.FileState.PROCESSING:
+                if time.monotonic() - uploaded > self.timeout:
+                    self.counters.incr("timeouts")
+                    raise TimeoutError(f"{file.name} still processing after {self.timeout:.0f}s")
+                time.sleep(self.poll_interval)
+                file = self._files.get(name=file.name)
+            self.processing_time.record(time.monotonic() - uploaded)
+            if file.state == types.FileState.FAILED:
+                self.counters.incr("failed")
+                raise RuntimeError(f"{file.name} processing failed: {file.error}")
+            yield file
+        finally:
+            self._delete(file.name)
+
+    def _delete(self, name):
+        # 檔案 48 小時後也會自動刪除，這裡失敗只記錄不影響回覆
+        try:
+            self._files.delete(name=name)
+            self.counters.incr("deleted")
+        except Exception as e:
+            self.counters.incr("delete_errors")
+            logger.warning(f"[GeminiFileUploader] Failed to delete {name}: {e}")
+
+    def stats(self):
+        return {
+            **self.counters.snapshot(),
+            "upload": self.upload_time.snapshot(),
+            "processing": self.processing_time.snapshot(),
+        }
@@ -1,26 +1,27 @@
 # ===東吳大學資料系 2025 年 LINEBOT ===
+import atexit
 import base64
 import logging
 import os
 import tempfile
 
-import markdown
-from bs4 import BeautifulSoup
-from flask import Flask, abort, request, send_from_directory
+from flask import Flask, abort, request
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
-    ApiClient,
     Configuration,
     ImageMessage,
-    MessagingApi,
-    MessagingApiBlob,
-    ReplyMessageRequest,
     TextMessage,
 )
 from linebot.v3.webhooks import ImageMessageContent, MessageEvent, TextMessageContent
 from openai import OpenAI
 
+from image_pipeline import ImagePipeline
+from line_client import LineClient
+from line_text import render_messages
+from media_store import MediaStore, send_media
+from reply_scheduler import ReplyScheduler
+
 # === 初始化OpenAI模型 ===
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 client = OpenAI(api_key=OPENAI_API_KEY)
@@ -35,8 +36,18 @@ response = client.responses.create(
 message_id = response.id
 
 # === 初始設定 ===
-static_tmp_path = tempfile.gettempdir()
-os.makedirs(static_tmp_path, exist_ok=True)
+# 上傳與生成的媒體檔以內容雜湊命名存放，超過容量或天數時自動清除
+media_store = MediaStore(
+    os.getenv("MEDIA_DIR", os.path.join(tempfile.gettempdir(), "linebot-media")),
+    max_bytes=int(os.getenv("MEDIA_MAX_MB", "1024")) * 1024 * 1024,
+    max_age=int(os.getenv("MEDIA_MAX_AGE_DAYS", "30")) * 86400,
+)
+# 圖片只解碼一次：縮小後送模型，另存小縮圖給 LINE 聊天室預覽
+image_pipeline = ImagePipeline(
+    model_max_edge=int(os.getenv("IMAGE_MAX_EDGE", "1024")),
+    model_quality=int(os.getenv("IMAGE_QUALITY", "85")),
+    preview_max_edge=int(os.getenv("IMAGE_PREVIEW_EDGE", "240")),
+)
 base_url = os.getenv("SPACE_HOST")  # e.g., "your-space-name.hf.space"
 
 # === Flask 應用初始化 ===
@@ -52,6 +63,13 @@ channel_access_token = os.environ.get("YOUR_CHANNEL_ACCESS_TOKEN")
 configuration = Configuration(access_token=channel_access_token)
 handler = WebhookHandler(channel_secret)
 
+# reply token 快過期時先回「處理中」，結果改用 push 送出
+line_client = LineClient(configuration, pool_size=int(os.getenv("LINE_POOL_SIZE", "10")))
+atexit.register(line_client.close)
+reply_scheduler = ReplyScheduler(
+    line_client, budget=float(os.getenv("REPLY_TOKEN_BUDGET", "40"))
+)
+
 
 # === AI Query 包裝 ===
 def query(payload, previous_response_id):
@@ -66,7 +84,7 @@ def query(payload, previous_response_id):
 # === 靜態圖檔路由 ===
 @app.route("/images/<filename>")
 def serve_image(filename):
-    return send_from_directory(static_tmp_path, filename)
+    return send_media(media_store, filename)
 
 
 # === LINE Webhook 接收端點 ===
@@ -92,6 +110,7 @@ def callback():
 
 # === 處理文字訊息 ===
 @handler.add(MessageEvent, message=TextMessageContent)
+@reply_scheduler.watch
 def handle_text_message(event):
     global message_id
     user_input = event.message.text.strip()
@@ -107,71 +126,46 @@ def handle_text_message(event):
             )
             image_url = response.data[0].url
             app.logger.info(image_url)
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[
-                            ImageMessage(
-                                original_content_url=image_url,
-                                preview_image_url=image_url,
-                            )
-                        ],
+            reply_scheduler.reply(
+                event,
+                [
+                    ImageMessage(
+                        original_content_url=image_url,
+                        preview_image_url=image_url,
                     )
-                )
+                ],
+            )
         except Exception as e:
             app.logger.error(f"DALL·E 3 API error: {e}")
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="抱歉，生成圖像時發生錯誤。")],
-                    )
-                )
+            reply_scheduler.reply(event, [TextMessage(text="抱歉，生成圖像時發生錯誤。")])
     else:
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            response = query(event.message.text, previous_response_id=message_id)
-            message_id = response.id
-            html_msg = markdown.markdown(response.output_text)
-            soup = BeautifulSoup(html_msg, "html.parser")
-
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=soup.get_text())],
-                )
-            )
+        response = query(event.message.text, previous_response_id=message_id)
+        message_id = response.id
+        reply_scheduler.reply(
+            event, [TextMessage(text=chunk) for chunk in render_messages(response.output_text)]
+        )
 
 
 # === 處理圖片訊息 ===
 @handler.add(MessageEvent, message=ImageMessageContent)
+@reply_scheduler.watch
 def handle_image_message(event):
 
     # === 以下是處理圖片回傳部分 === #
 
-    with ApiClient(configuration) as api_client:
-        blob_api = MessagingApiBlob(api_client)
-        content = blob_api.get_message_content(message_id=event.message.id)
-        image_bytes = content
+    image_bytes = line_client.get_message_content(event.message.id)
 
-    # Step 2：轉成 base64 字串
-    base64_string = base64.b64encode(image_bytes).decode("utf-8")
+    # Step 2：縮小並重新壓縮成 JPEG，再轉成 base64 字串
+    prepared = image_pipeline.prepare(image_bytes)
+    base64_string = base64.b64encode(prepared.model_bytes).decode("utf-8")
 
     # Step 3：組成 OpenAI 的 data URI 格式
-    data_uri = f"data:image/png;base64,{base64_string}"
-    app.logger.info(f"Data URI: {data_uri}")
+    data_uri = f"data:{prepared.mime_type};base64,{base64_string}"
+    app.logger.info(f"Data URI: {len(data_uri)} chars ({prepared.model_size[0]}x{prepared.model_size[1]})")
 
-    # Step 4：將圖片存到本地端
-    with tempfile.NamedTemporaryFile(
-        dir=static_tmp_path, suffix=".jpg", delete=False
-    ) as tf:
-        tf.write(content)
-        filename = os.path.basename(tf.name)
-
-    image_url = f"https://{base_url}/images/{filename}"
+    # Step 4：原圖存到媒體庫，另存預覽用的小縮圖
+    image_url = f"https://{base_url}/images/{media_store.put(image_bytes, prepared.original_ext)}"
+    preview_url = f"https://{base_url}/images/{media_store.put(prepared.preview_bytes, '.jpg')}"
 
     app.logger.info(f"Image URL: {image_url}")
 
@@ -198,16 +192,12 @@ def handle_image_message(event):
 
     # === 以下是回傳圖片部分 === #
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[
-                    ImageMessage(
-                        original_content_url=image_url, preview_image_url=image_url
-                    ),
-                    TextMessage(text=response.output_text),
-                ],
-            )
-        )
\ No newline at end of file
+    reply_scheduler.reply(
+        event,
+        [
+            ImageMessage(
+                original_content_url=image_url, preview_image_url=preview_url
+            ),
+            TextMessage(text=response.output_text),
+        ],
+    )
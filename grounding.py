@@ -0,0 +1,84 @@
+"""
+東吳大學資料系 2025 LINEBOT
+Google 搜尋工具的取捨：只有需要即時資料（天氣、價格、日期、營業時間等）的提問才帶搜尋工具，其餘直接由模型回答
+"""
+
+import re
+import unicodedata
+
+from metrics import Counters, LatencyStats
+
+# 各類需要即時資料的線索，命中任一類就帶 Google 搜尋工具；名稱同時是 /metrics 裡的計數項目
+FRESHNESS_RULES = {
+    "date": (
+        r"今天|今日|今晚|明天|明日|後天|昨天|現在|目前|最新|最近|近期|即時"
+        r"|這週|本週|下週|週末|這個月|下個月|今年|明年"
+        r"|\d{1,2} ?月 ?\d{1,2} ?[日號]|\d{1,2}/\d{1,2}"
+        r"|today|tonight|tomorrow|right now|latest|this (?:week|weekend|month)|next (?:week|month)"
+    ),
+    "weather": r"天氣|氣溫|溫度|下雨|降雨|颱風|氣象|預報|weather|forecast|typhoon",
+    "price": (
+        r"價格|價錢|票價|多少錢|幾塊|匯率|機票|特價|優惠|折扣|漲價"
+        r"|price|fare|exchange rate|how much|flight"
+    ),
+    "hours": (
+        r"營業時間|開放時間|營業到|開到幾點|幾點開|幾點關|公休|休館|有開嗎"
+        r"|opening hours|open now|closing time"
+    ),
+    "transit": r"時刻表|班次|首班|末班|航班|停駛|誤點|timetable|schedule",
+    "events": r"新聞|活動|展覽|演唱會|祭典|花火|煙火|花況|開花|罷工|封閉|施工|news|festival|concert|exhibition",
+    "rules": r"簽證|免簽|入境|規定|visa|entry requirement",
+}
+
+
+class GroundingSelector:
+    """grounded / ungrounded 是預先建好的兩份 GenerateContentConfig（只差在有沒有 tools），每次呼叫不必重建。
+
+    mode 為 auto 時依提問內容判斷；always / never 固定使用其中一份（例如比較兩者的品質）。
+    只看關鍵字，判斷錯誤的代價是多一次搜尋或少一次搜尋，不影響回覆能否產生。
+    """
+
+    def __init__(self, grounded, ungrounded, mode="auto", rules=FRESHNESS_RULES):
+        self.configs = {True: grounded, False: ungrounded}
+        self.mode = mode
+        self._pattern = re.compile("|".join(f"(?P<{name}>{pattern})" for name, pattern in rules.items()))
+        self.counters = Counters("grounded", "ungrounded", *rules)
+        self.latency = {True: LatencyStats(), False: LatencyStats()}
+
+    def needs_search(self, text):
+        """回傳這個提問是否要帶搜尋工具，並記錄判斷結果與命中的類別。"""
+        if self.mode == "always":
+            grounded = True
+        elif self.mode == "never":
+            grounded = False
+        else:
+            found = self._pattern.search(unicodedata.normalize("NFKC", text or "").lower())
+            grounded = found is not None
+            if grounded:
+                self.counters.incr(found.lastgroup)
+        self.counters.incr("grounded" if grounded else "ungrounded")
+        return grounded
+
+    def select(self, text):
+        """回傳 (grounded, config)。"""
+        grounded = self.needs_search(text)
+        return grounded, self.configs[grounded]
+
+    def record(self, grounded, seconds):
+        self.latency[grounded].record(seconds)
+
+    def stats(self):
+        counters = self.counters.snapshot()
+        grounded = counters.pop("grounded")
+        ungrounded = counters.pop("ungrounded")
+        total = grounded + ungrounded
+        return {
+            "mode": self.mode,
+            "grounded": grounded,
+            "ungrounded": ungrounded,
+            "grounded_ratio": round(grounded / total, 3) if total else 0.0,
+            # 觸發搜尋的線索類別（每個提問只計第一個命中的類別）
+            "reasons": counters,
+            "grounded_latency": self.latency[True].snapshot(),
+            "ungrounded_latency": self.latency[False].snapshot(),
+        }
@@ -0,0 +1,185 @@
+"""
+東吳大學資料系 2025 LINEBOT
+Gemini 避險請求（hedged request）：主要模型超過近期延遲百分位數仍未回應時，改向備援模型再送一次，取先完成者
+"""
+
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from metrics import Counters, LatencyStats
+
+logger = logging.getLogger(__name__)
+
+
+def parse_fallbacks(spec):
+    """解析「主要模型=備援模型,主要模型=備援模型」格式的設定字串。"""
+    fallbacks = {}
+    for pair in spec.split(","):
+        primary, sep, fallback = pair.partition("=")
+        if sep and primary.strip() and fallback.strip():
+            fallbacks[primary.strip()] = fallback.strip()
+    return fallbacks
+
+
+def is_client_error(error):
+    """4xx（參數錯誤、配額用完 429 等）換模型重送也不會成功，只會增加負擔。"""
+    code = getattr(error, "code", None)
+    return isinstance(code, int) and 400 <= code < 500
+
+
+class HedgedModels:
+    """與 client.models 相同介面的 generate_content()，其餘方法直接轉給原本的 models。
+
+    - 主要模型在 hedge_delay() 秒內沒有回應：送出備援請求，先成功者勝出，另一個能取消就取消，否則忽略結果
+    - 主要模型直接失敗（4xx 除外）：改用備援模型重送一次
+    - 避險與失敗重送都受 budget 限制：每個請求累積 budget 個額度，每次花掉 1 個，最多存 burst 個；
+      服務過載時大量失敗的請求不會讓流量加倍
+    沒有設定備援模型時，避險請求送往同一個模型。
+    """
+
+    def __init__(self, models, fallbacks=None, enabled=True, percentile=95, min_delay=1.0,
+                 max_delay=15.0, min_samples=20, budget=0.1, burst=5, max_workers=16):
+        self._models = models
+        self.fallbacks = dict(fallbacks or {})
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self.budget = budget
+        self.burst = burst
+        self._tokens = float(burst)
+        self._lock = threading.Lock()
+        self._latency = {}
+        # observer(model, seconds)：每次成功的 generate_content 整體耗時（含避險、重送與限流等待）
+        self.observers = []
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gemini-hedge")
+        self.counters = Counters(
+            "requests", "hedges", "hedge_wins", "budget_denied", "fallbacks", "cancelled", "errors"
+        )
+
+    def __getattr__(self, name):
+        return getattr(self._models, name)
+
+    def latency(self, model):
+        with self._lock:
+            stats = self._latency.get(model)
+            if stats is None:
+                stats = self._latency[model] = LatencyStats()
+        return stats
+
+    def hedge_delay(self, model):
+        """等待主要模型多久才送出避險請求；樣本不足時用 max_delay，避免冷啟動時大量避險。"""
+        stats = self.latency(model)
+        if stats.count < self.min_samples:
+            return self.max_delay
+        delay = stats.percentile(self.percentile, self.max_delay)
+        return min(self.max_delay, max(self.min_delay, delay))
+
+    def generate_content(self, *, model, contents, config=None):
+        started = time.monotonic()
+        response = self._generate(model, contents, config)
+        elapsed = time.monotonic() - started
+        for observer in self.observers:
+            observer(model, elapsed)
+        return response
+
+    def _generate(self, model, contents, config):
+        self.counters.incr("requests")
+        if not self.enabled:
+            return self._call(model, contents, config)
+
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.budget)
+        fallback_model = self.fallbacks.get(model, model)
+        primary = self._submit(model, contents, config)
+        done, _ = wait([primary], timeout=self.hedge_delay(model))
+        if done:
+            error = primary.exception()
+            if error is None:
+                return primary.result()
+            if is_client_error(error):
+                raise error
+            if not self._take_token():
+                self.counters.incr("budget_denied")
+                raise error
+            logger.warning(f"[HedgedModels] {model} failed, falling back to {fallback_model}: {error}")
+            self.counters.incr("fallbacks")
+            return self._call(fallback_model, contents, config)
+
+        if not self._take_token():
+            self.counters.incr("budget_denied")
+            return primary.result()
+        logger.info(f"[HedgedModels] {model} is slow, hedging with {fallback_model}")
+        self.counters.incr("hedges")
+        backup = self._submit(fallback_model, contents, config)
+        pending = {primary, backup}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        if loser.cancel():
+                            self.counters.incr("cancelled")
+                    if future is backup:
+                        self.counters.incr("hedge_wins")
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _submit(self, model, contents, config):
+        # 帶著呼叫端的 contextvars（例如限流用的使用者）到執行緒池中執行
+        context = contextvars.copy_context()
+        return self._executor.submit(context.run, self._call, model, contents, config)
+
+    def _take_token(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def _call(self, model, contents, config):
+        started = time.monotonic()
+        try:
+            response = self._models.generate_content(model=model, contents=contents, config=config)
+        except Exception:
+            self.counters.incr("errors")
+            raise
+        # 輸掉的請求也記錄延遲，百分位數才不會只剩較快的樣本
+        self.latency(model).record(time.monotonic() - started)
+        return response
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def stats(self):
+        counters = self.counters.snapshot()
+        with self._lock:
+            models = list(self._latency)
+            tokens = self._tokens
+        return {
+            "enabled": self.enabled,
+            "hedge_rate": round(counters["hedges"] / counters["requests"], 3) if counters["requests"] else 0.0,
+            "budget_tokens": round(tokens, 2),
+            **counters,
+            "models": {
+                model: {"hedge_delay_ms": round(self.hedge_delay(model) * 1000, 1), **self.latency(model).snapshot()}
+                for model in models
+            },
+        }
+
+
+class HedgedClient:
+    """把 genai.Client 的 models 換成 HedgedModels，其他屬性（files、chats 等）照舊使用原本的 client。"""
+
+    def __init__(self, client, **options):
+        self._client = client
+        self.models = HedgedModels(client.models, **options)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
@@ -0,0 +1,199 @@
+"""
+東吳大學資料系 2025 LINEBOT
+行程歷史全文索引：產生行程時就建立倒排索引，「我要瀏覽歷史紀錄」查詢時不必再呼叫 Gemini
+"""
+
+import logging
+import math
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter as TermCounter
+
+from conversation_store import decode, encode
+from itinerary import parse_itinerary, record_title
+from metrics import Counters, LatencyStats
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS itineraries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    date TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    record BLOB,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_itineraries_user ON itineraries (user_id, id);
+CREATE TABLE IF NOT EXISTS postings (
+    user_id TEXT NOT NULL,
+    term TEXT NOT NULL,
+    doc_id INTEGER NOT NULL,
+    tf INTEGER NOT NULL,
+    PRIMARY KEY (user_id, term, doc_id)
+) WITHOUT ROWID;
+"""
+
+# 中日文（漢字、平假名、片假名）連續字串切成 bigram，英數字則以單字為單位
+TOKEN_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[a-z0-9]+")
+CJK_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+DATE_RE = re.compile(r"\d{4}[-/]\d{1,2}[-/]\d{1,2}|\d{1,2}/\d{1,2}|\d{1,2}月\d{1,2}日")
+ITINERARY_HINTS = ("行程", "第一天", "Day", "早上", "上午", "下午", "晚上")
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text):
+    tokens = []
+    for run in TOKEN_RE.findall(text.lower()):
+        if CJK_RE.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def is_itinerary(text, min_length=150):
+    """粗略判斷一段回覆是否為行程規劃，只有行程才需要建立索引。"""
+    return len(text) >= min_length and any(hint in text for hint in ITINERARY_HINTS)
+
+
+def extract_title(text, max_length=30):
+    for line in text.splitlines():
+        line = line.strip(" #*-\t")
+        if line:
+            return line[:max_length]
+    return "旅遊行程"
+
+
+def extract_date(text, created_at):
+    match = DATE_RE.search(text)
+    if match:
+        return match.group(0)
+    return time.strftime("%Y/%m/%d", time.localtime(created_at))
+
+
+class HistoryIndex:
+    """以 SQLite 儲存的倒排索引，依 BM25 排序，並以 user_id 區隔每位使用者的資料。"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.counters = Counters("indexed", "searches", "hits", "misses")
+        self.search_time = LatencyStats()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(itineraries)")}
+        if "record" not in columns:
+            # 早期版本的資料表沒有結構化行程欄位
+            conn.execute("ALTER TABLE itineraries ADD COLUMN record BLOB")
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def add(self, user_id, text):
+        """解析行程並建立索引，回傳 doc_id。"""
+        tokens = tokenize(text)
+        record = parse_itinerary(text)
+        now = time.time()
+        title = record_title(record, extract_title(text))
+        date = record["dates"] or extract_date(text, now)
+        conn = self._conn()
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO itineraries (user_id, title, date, length, data, record, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, title, date, len(tokens), encode(text), encode(record), now),
+            )
+            doc_id = cursor.lastrowid
+            conn.executemany(
+                "INSERT INTO postings (user_id, term, doc_id, tf) VALUES (?, ?, ?, ?)",
+                [(user_id, term, doc_id, tf) for term, tf in TermCounter(tokens).items()],
+            )
+        self.counters.incr("indexed")
+        return doc_id
+
+    def search(self, user_id, keyword, limit=10):
+        """回傳依相關度排序的行程：[{"id", "title", "date", "record", "score"}]，不含原文。"""
+        started = time.monotonic()
+        self.counters.incr("searches")
+        conn = self._conn()
+        terms = set(tokenize(keyword))
+        doc_count, avg_length = conn.execute(
+            "SELECT COUNT(*), AVG(length) FROM itineraries WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        scores = {}
+        if terms and doc_count:
+            idf = {}
+            for term in terms:
+                postings = self._postings(conn, user_id, term)
+                df = len(postings)
+                idf[term] = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+                for doc_id, tf, length in postings:
+                    scores.setdefault(doc_id, {})[term] = (tf, length)
+            for doc_id, matched in scores.items():
+                score = 0.0
+                for term, (tf, length) in matched.items():
+                    norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / (avg_length or 1))
+                    score += idf[term] * tf * (BM25_K1 + 1) / norm
+                scores[doc_id] = score
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))[:limit]
+        results = []
+        for doc_id, score in ranked:
+            title, date, record = conn.execute(
+                "SELECT title, date, record FROM itineraries WHERE id = ?", (doc_id,)
+            ).fetchone()
+            results.append({
+                "id": doc_id, "title": title, "date": date,
+                "record": decode(record) if record else None, "score": score,
+            })
+        self.counters.incr("hits" if results else "misses")
+        self.search_time.record(time.monotonic() - started)
+        return results
+
+    def get(self, user_id, doc_id):
+        """取出單筆行程（原文與結構化資料）；doc_id 不屬於該使用者時回傳 None。"""
+        row = self._conn().execute(
+            "SELECT title, date, data, record FROM itineraries WHERE id = ? AND user_id = ?",
+            (doc_id, user_id),
+        ).fetchone()
+        if row is None:
+            return None
+        title, date, data, record = row
+        text = decode(data)
+        return {
+            "id": doc_id, "title": title, "date": date, "text": text,
+            "record": decode(record) if record else parse_itinerary(text),
+        }
+
+    def _postings(self, conn, user_id, term):
+        if len(term) == 1 and CJK_RE.match(term):
+            # 單一個中日文字：比對所有以此字開頭的 bigram
+            return conn.execute(
+                "SELECT p.doc_id, SUM(p.tf), i.length FROM postings p JOIN itineraries i ON i.id = p.doc_id"
+                " WHERE p.user_id = ? AND p.term >= ? AND p.term < ? GROUP BY p.doc_id",
+                (user_id, term, term + "\uffff"),
+            ).fetchall()
+        return conn.execute(
+            "SELECT p.doc_id, p.tf, i.length FROM postings p JOIN itineraries i ON i.id = p.doc_id"
+            " WHERE p.user_id = ? AND p.term = ?",
+            (user_id, term),
+        ).fetchall()
+
+    def stats(self):
+        return {**self.counters.snapshot(), "search": self.search_time.snapshot()}
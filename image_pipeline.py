@@ -0,0 +1,142 @@
+"""
+東吳大學資料系 2025 LINEBOT
+圖片前處理：由下載的 bytes 解碼一次，在記憶體中產生給 Gemini 的縮小版與給 LINE 的預覽縮圖，不必寫暫存檔再讀回
+"""
+
+import hashlib
+import logging
+import time
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from metrics import Counters, LatencyStats
+
+logger = logging.getLogger(__name__)
+
+
+# 原圖依實際格式存檔，媒體庫才會以正確的 Content-Type 提供（PNG 不會被當成 image/jpeg）
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "GIF": ".gif", "WEBP": ".webp", "BMP": ".bmp", "TIFF": ".tiff"}
+
+# 感知雜湊的邊長：16 → 256 位元，8×8 的 64 位元太粗，版面相同的截圖常常完全一樣
+HASH_SIZE = 16
+
+
+class PreparedImage:
+    """content_hash 為原始檔案的 sha256；dhash 與 colors 用來比對重新壓縮、縮放過的同一張圖片。
+
+    model_bytes 與 preview_bytes 一律是 JPEG；original_ext 為原始檔案格式的副檔名（無法辨識時為空字串）。
+    """
+
+    def __init__(self, model_bytes, preview_bytes, size, model_size, content_hash, dhash, colors, original_ext=""):
+        self.model_bytes = model_bytes
+        self.preview_bytes = preview_bytes
+        self.size = size
+        self.model_size = model_size
+        self.content_hash = content_hash
+        self.dhash = dhash
+        self.colors = colors
+        self.mime_type = "image/jpeg"
+        self.original_ext = original_ext
+
+
+def dhash(image, hash_size=HASH_SIZE):
+    """差異雜湊（dHash）：縮成 (hash_size+1)×hash_size 灰階後比較左右相鄰像素，得到 hash_size² 位元的整數。
+
+    重新壓縮、縮放或加上 LINE 轉傳的輕微失真後，漢明距離通常只差幾個位元。
+    """
+    pixels = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR).tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def color_signature(image, grid=4):
+    """縮成 grid×grid 的 RGB 平均色；dHash 只看明暗變化，純色或配色不同的圖片要靠它區分。"""
+    return image.convert("RGB").resize((grid, grid), Image.BOX).tobytes()
+
+
+def _to_rgb(image):
+    # 透明背景（PNG、GIF）轉成白底，直接 convert("RGB") 會變成黑底
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+
+def _encode_jpeg(image, quality):
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def prepare_image(data, model_max_edge, model_quality, preview_max_edge, preview_quality):
+    """解碼、縮圖、重新壓縮的 CPU 工作；只用參數與回傳值溝通，可以交給 ProcessPoolExecutor 執行。"""
+    with Image.open(BytesIO(data)) as image:
+        size = image.size
+        original_ext = FORMAT_EXTENSIONS.get(image.format, "")
+        # JPEG 可在解碼時直接以 1/2、1/4、1/8 縮小，大圖省下大部分解碼時間
+        image.draft("RGB", (model_max_edge, model_max_edge))
+        image = _to_rgb(ImageOps.exif_transpose(image))
+    image.thumbnail((model_max_edge, model_max_edge), Image.LANCZOS)
+    model_bytes = _encode_jpeg(image, model_quality)
+    model_size = image.size
+    image_hash = dhash(image)
+    colors = color_signature(image)
+    image.thumbnail((preview_max_edge, preview_max_edge), Image.LANCZOS)
+    preview_bytes = _encode_jpeg(image, preview_quality)
+    content_hash = hashlib.sha256(data).hexdigest()
+    return PreparedImage(model_bytes, preview_bytes, size, model_size, content_hash, image_hash, colors, original_ext)
+
+
+class ImagePipeline:
+    """model_max_edge / preview_max_edge 為長邊像素上限；比上限小的圖片不會放大。
+
+    給 executor（ProcessPoolExecutor）時，解碼與壓縮在子行程執行，不佔用這個行程的 GIL；
+    行程池損壞（子行程被殺掉）後改在目前的執行緒處理。
+    """
+
+    def __init__(self, model_max_edge=1024, model_quality=85, preview_max_edge=240, preview_quality=70, executor=None):
+        self.model_max_edge = model_max_edge
+        self.model_quality = model_quality
+        self.preview_max_edge = preview_max_edge
+        self.preview_quality = preview_quality
+        self.executor = executor
+        self.counters = Counters("images", "original_bytes", "model_bytes", "preview_bytes", "in_process")
+        self.process_time = LatencyStats()
+
+    def prepare(self, data):
+        started = time.monotonic()
+        args = (data, self.model_max_edge, self.model_quality, self.preview_max_edge, self.preview_quality)
+        prepared = None
+        if self.executor is not None:
+            try:
+                prepared = self.executor.submit(prepare_image, *args).result()
+            except BrokenProcessPool as e:
+                logger.error(f"[ImagePipeline] Process pool is broken, preparing images in-process: {e}")
+                self.executor = None
+        if prepared is None:
+            prepared = prepare_image(*args)
+            self.counters.incr("in_process")
+
+        self.process_time.record(time.monotonic() - started)
+        self.counters.incr("images")
+        self.counters.incr("original_bytes", len(data))
+        self.counters.incr("model_bytes", len(prepared.model_bytes))
+        self.counters.incr("preview_bytes", len(prepared.preview_bytes))
+        return prepared
+
+    def stats(self):
+        counters = self.counters.snapshot()
+        return {
+            **counters,
+            "model_ratio": round(counters["model_bytes"] / counters["original_bytes"], 3) if counters["original_bytes"] else 0.0,
+            "process_pool": self.executor is not None,
+            "process": self.process_time.snapshot(),
+        }
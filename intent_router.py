@@ -0,0 +1,92 @@
+"""
+東吳大學資料系 2025 LINEBOT
+本地意圖比對：選單指令、別名、問候、感謝、使用說明等固定回應以規則表比對，不必送給 Gemini
+"""
+
+import re
+import threading
+import time
+
+from metrics import Counters
+from response_cache import normalize
+
+# 只有 emoji（含膚色、國旗、ZWJ 組合）與空白的訊息，通常等同傳貼圖
+EMOJI_ONLY = r"[\U0001F000-\U0001FAFF☀-➿⬀-⯿️‍\s]+"
+
+
+class Intent:
+    """phrases 為完整比對的字串（比對前會正規化）；patterns 為需完整符合的正規表示式。
+
+    command：把別名換成既有的標準指令字串，交回 handler 原本的流程處理。
+    reply：直接回覆的固定文字。
+    """
+
+    def __init__(self, name, phrases=(), patterns=(), command=None, reply=None):
+        self.name = name
+        self.phrases = phrases
+        self.patterns = patterns
+        self.command = command
+        self.reply = reply
+
+
+class IntentRouter:
+    """phrases 放進 dict 查表；所有 patterns 編譯成一個以具名群組區分的正規表示式，每則訊息只做一次 fullmatch。
+
+    超過 max_length 字的訊息一定是真正的提問，直接略過。
+    """
+
+    def __init__(self, intents, max_length=30):
+        self.max_length = max_length
+        self._phrases = {}
+        self._groups = {}
+        alternatives = []
+        for i, intent in enumerate(intents):
+            for phrase in intent.phrases:
+                self._phrases[normalize(phrase)] = intent
+            if intent.patterns:
+                group = f"i{i}"
+                self._groups[group] = intent
+                alternatives.append(f"(?P<{group}>{'|'.join(f'(?:{p})' for p in intent.patterns)})")
+        self._pattern = re.compile("|".join(alternatives), re.IGNORECASE) if alternatives else None
+        self.counters = Counters("lookups", "misses", *(intent.name for intent in intents))
+        self._reply_intents = [intent.name for intent in intents if intent.reply]
+        self._match_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def match(self, text, commands_only=False):
+        """回傳符合的 Intent，沒有時回傳 None。
+
+        commands_only 時只比對指令別名（例如搜尋模式下不做本地回覆），固定回應的 Intent 視為沒有命中、不計入 hits。
+        """
+        started = time.perf_counter()
+        intent = None
+        if len(text) <= self.max_length:
+            key = normalize(text)
+            intent = self._phrases.get(key)
+            if intent is None and self._pattern is not None and key:
+                found = self._pattern.fullmatch(key)
+                if found is not None:
+                    intent = self._groups[found.lastgroup]
+        if intent is not None and commands_only and not intent.command:
+            intent = None
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._match_seconds += elapsed
+        self.counters.incr("lookups")
+        self.counters.incr(intent.name if intent is not None else "misses")
+        return intent
+
+    def stats(self):
+        counters = self.counters.snapshot()
+        lookups = counters.pop("lookups")
+        misses = counters.pop("misses")
+        with self._lock:
+            match_seconds = self._match_seconds
+        return {
+            "lookups": lookups,
+            "misses": misses,
+            # 直接在本地回覆、省下的 Gemini 呼叫次數（指令別名原本就不會呼叫 Gemini，不計入）
+            "llm_calls_avoided": sum(counters[name] for name in self._reply_intents),
+            "avg_match_us": round(match_seconds / lookups * 1e6, 2) if lookups else 0.0,
+            "hits": counters,
+        }
@@ -0,0 +1,216 @@
+"""
+東吳大學資料系 2025 LINEBOT
+行程結構化：Gemini 產生行程時就解析成 {目的地、日期、每日早中晚、預算、其他段落}，之後查看細節不需再問 Gemini
+
+執行方式：python itinerary.py（以 SAMPLE 這份 Gemini 實際回覆格式的行程印出解析結果）
+"""
+
+import re
+
+from line_text import TABLE_SEPARATOR_RE, render_inline
+
+DAY_HEADER_RE = re.compile(
+    r"^(?:\d{1,2}/\d{1,2}\s*)?[\(（]?\s*(?:第[一二三四五六七八九十\d]+天|day\s*\d+)\s*[\)）]?"
+    r"|^\d{1,2}/\d{1,2}\s*[\(（]",
+    re.IGNORECASE,
+)
+SLOT_PREFIXES = (
+    ("morning", ("早上", "上午", "清晨", "morning")),
+    ("afternoon", ("下午", "中午", "午餐", "afternoon")),
+    ("evening", ("晚上", "傍晚", "夜晚", "晚餐", "evening", "night")),
+)
+SLOT_LABELS = {"morning": "早上", "afternoon": "下午", "evening": "晚上"}
+SECTION_RE = re.compile(r"^[^\s：:]{1,12}\s*[\(（][^\)）]*[\)）]\s*[：:]$|^[^\s：:]{1,12}[：:]$")
+BUDGET_HEADER_RE = re.compile(r"預算|費用|花費|budget", re.IGNORECASE)
+BUDGET_ITEM_RE = re.compile(r"^([^：:]{1,12})[：:]\s*(.*\d.*)$")
+DATE_RANGE_RE = re.compile(
+    r"(\d{1,2}月\d{1,2}日|\d{1,2}/\d{1,2})\s*(?:至|到|~|～|-)\s*(\d{1,2}月\d{1,2}日|\d{1,2}/\d{1,2})"
+)
+# 標題式寫法，例如「東京5天4夜行程」「為您規劃的大阪三日遊」；地名取「的／是／去／到」等字之後的部分
+DESTINATION_TITLE_RE = re.compile(r"([\u4e00-\u9fff]{2,12}?)(?:\d+|[一二三四五六七八九十]+)[天日]")
+DESTINATION_PREFIX_RE = re.compile(r"^.*(?:規劃|前往|[的是去到往在為])")
+DESTINATION_RE = re.compile(r"(?:(?:規劃|前往|去|到)的?)+([^\s，,。的玩]{2,10}?)(?:的|玩|旅|之旅|\d)")
+SHORT_DATE_RE = re.compile(r"\d{1,2}/\d{1,2}")
+EMPHASIS_RE = re.compile(r"\*\*|__")
+DIGIT_RE = re.compile(r"\d")
+# 標題井號、引言、清單符號（含 line_text.render() 輸出的 •）與編號
+LIST_MARKER_RE = re.compile(r"^(?:#{1,6}|>|[-*+•]|\d{1,2}[.)])\s+")
+HEADING_RE = re.compile(r"^\s{0,3}#{1,6}\s")
+
+
+def _clean(line):
+    """去掉標題井號、清單符號與粗體等行內記號，只留下內容文字。"""
+    if TABLE_SEPARATOR_RE.match(line):
+        return ""
+    line = LIST_MARKER_RE.sub("", line.strip())
+    if line.startswith("|") and line.endswith("|"):
+        line = "｜".join(cell.strip() for cell in line.strip("|").split("|"))
+    line = EMPHASIS_RE.sub("", render_inline(line))
+    return line.strip().strip("*#-•").strip()
+
+
+def _destination(text):
+    for match in DESTINATION_TITLE_RE.finditer(text):
+        name = DESTINATION_PREFIX_RE.sub("", match.group(1))
+        if len(name) >= 2 and not name.startswith("第"):
+            return name
+    match = DESTINATION_RE.search(text)
+    return match.group(1) if match else ""
+
+
+def _is_section(line, heading, has_days):
+    """「注意事項：」等段落標題；Markdown 標題或 render() 後沒有冒號的「預算分配」也算。"""
+    if SECTION_RE.match(line):
+        return True
+    if heading and has_days:
+        return True
+    return len(line) <= 12 and BUDGET_HEADER_RE.search(line) is not None and not DIGIT_RE.search(line)
+
+
+def _slot_of(line):
+    lowered = line.lower()
+    for slot, prefixes in SLOT_PREFIXES:
+        for prefix in prefixes:
+            if lowered.startswith(prefix):
+                return slot, line[len(prefix):].lstrip("：: ").strip()
+    return None, line
+
+
+def parse_itinerary(text):
+    """把行程文字（Gemini 的 Markdown 或 render() 後的純文字）解析成 dict；解析不出每日行程時 days 為空串列。
+
+    每日行程之後、不是預算的段落（注意事項、交通建議等）原樣放進 sections，查看細節時一併顯示。
+    """
+    record = {"destination": "", "dates": "", "days": [], "budget": [], "sections": []}
+    lines = [(_clean(raw_line), bool(HEADING_RE.match(raw_line))) for raw_line in text.splitlines()]
+    plain = "\n".join(line for line, _ in lines)
+    record["destination"] = _destination(plain)
+    match = DATE_RANGE_RE.search(plain)
+    if match:
+        record["dates"] = f"{match.group(1)}至{match.group(2)}"
+
+    day = None
+    slot = None
+    section = None
+    in_budget = False
+    for line, heading in lines:
+        if not line:
+            continue
+        if DAY_HEADER_RE.match(line):
+            day = {"label": line.rstrip("：:"), "morning": "", "afternoon": "", "evening": ""}
+            record["days"].append(day)
+            slot = None
+            section = None
+            in_budget = False
+            continue
+        if _is_section(line, heading, bool(record["days"])):
+            # 遇到「預算分配：」、「注意事項：」等段落標題，每日行程就結束了
+            day = None
+            section = None
+            in_budget = bool(BUDGET_HEADER_RE.search(line))
+            if not in_budget and record["days"]:
+                section = {"title": line.rstrip("：:"), "lines": []}
+                record["sections"].append(section)
+            continue
+        if in_budget:
+            item = BUDGET_ITEM_RE.match(line)
+            if item:
+                record["budget"].append({"item": item.group(1).strip(), "amount": item.group(2).strip()})
+            else:
+                record["budget"].append({"item": "", "amount": line})
+            continue
+        if section is not None:
+            section["lines"].append(line)
+            continue
+        if day is not None:
+            found, content = _slot_of(line)
+            slot = found or slot or "morning"
+            day[slot] = f"{day[slot]} {content}".strip() if day[slot] else content
+
+    if not record["dates"] and record["days"]:
+        # 沒有明寫日期區間時，改用第一天與最後一天標題中的日期
+        dates = [SHORT_DATE_RE.search(day["label"]) for day in record["days"]]
+        dates = [d.group(0) for d in dates if d]
+        if dates:
+            record["dates"] = dates[0] if dates[0] == dates[-1] else f"{dates[0]}至{dates[-1]}"
+    return record
+
+
+def record_title(record, fallback):
+    if record["destination"] and record["days"]:
+        return f"{record['destination']}{len(record['days'])}日遊"
+    return record["destination"] or fallback
+
+
+def render_summary(record, max_length=24):
+    """每日早中晚只取第一天，作為搜尋清單的簡短摘要。"""
+    if not record["days"]:
+        return ""
+    first_day = record["days"][0]
+    lines = []
+    for slot, label in SLOT_LABELS.items():
+        if first_day[slot]:
+            content = first_day[slot]
+            if len(content) > max_length:
+                content = content[:max_length] + "…"
+            lines.append(f"   - {label}：{content}")
+    return "\n".join(lines)
+
+
+def render_detail(record, fallback_text):
+    """由結構化資料組出完整行程（含預算與其他段落）；沒有解析出每日行程時直接回傳原文。"""
+    if not record["days"]:
+        return fallback_text
+    header = "｜".join(part for part in (record["destination"], record["dates"]) if part)
+    lines = [f"📍 {header}"] if header else []
+    for day in record["days"]:
+        lines.append("")
+        lines.append(day["label"])
+        for slot, label in SLOT_LABELS.items():
+            if day[slot]:
+                lines.append(f"{label}：{day[slot]}")
+    if record["budget"]:
+        lines.append("")
+        lines.append("預算分配：")
+        lines.extend(
+            f"{entry['item']}：{entry['amount']}" if entry["item"] else entry["amount"] for entry in record["budget"]
+        )
+    # 舊版解析結果沒有 sections
+    for section in record.get("sections", ()):
+        lines.append("")
+        lines.append(f"{section['title']}：")
+        lines.extend(f"• {line}" for line in section["lines"])
+    return "\n".join(lines).strip()
+
+
+# Gemini 實際回覆的行程格式：粗體時段、* 清單、巢狀項目、Markdown 標題與行程後的注意事項
+SAMPLE = """好的！以下是為您規劃的**東京5天4夜**動漫美食之旅（3/1至3/5），預算約 NT$30,000：
+
+### **第一天（3/1）：抵達東京、淺草**
+* **早上：** 抵達成田機場，搭乘 Skyliner 前往上野
+* **下午：** 淺草寺、仲見世通，品嚐人形燒
+* **晚上：** 東京晴空塔夜景
+
+### **第二天（3/2）：秋葉原**
+* **早上：** 秋葉原動漫街巡禮
+    * 推薦：Animate、Radio會館
+* **下午：** 神田明神，午餐吃咖哩
+* **晚上：** 築地場外市場壽司
+
+**預算分配：**
+* **住宿：** NT$12,000
+* **交通：** NT$5,000
+* 總計約 NT$30,000
+
+**注意事項：**
+* 建議購買 Suica 卡，搭車較方便
+* 3月早晚溫差大，請攜帶外套
+"""
+
+
+if __name__ == "__main__":
+    import json
+
+    parsed = parse_itinerary(SAMPLE)
+    print(json.dumps(parsed, ensure_ascii=False, indent=2))
+    print(render_detail(parsed, SAMPLE))
@@ -0,0 +1,139 @@
+"""
+東吳大學資料系 2025 LINEBOT
+共用的 LINE Messaging API 用戶端：每個 worker 只建立一次，所有 handler 共用同一個保持連線的 HTTP 連線池
+"""
+
+import logging
+import threading
+import time
+from urllib.parse import quote
+
+from linebot.v3.messaging import ApiClient, MessagingApi, MessagingApiBlob
+from linebot.v3.messaging.exceptions import ApiException
+
+from metrics import Counters, LatencyStats
+
+logger = logging.getLogger(__name__)
+
+# 取得使用者上傳內容的 API 主機（與 MessagingApiBlob 相同）
+BLOB_HOST = "https://api-data.line.me"
+CHUNK_SIZE = 256 * 1024
+
+
+class ContentTooLarge(Exception):
+    """下載的內容超過 max_bytes。"""
+
+
+class LineClient:
+    """包裝單一 ApiClient（底層為 thread-safe 的 urllib3 PoolManager），MessagingApi 與 MessagingApiBlob 共用連線。
+
+    每個 gunicorn worker 在 import 時各自建立一個；不要在 fork 前（--preload）建立。
+    """
+
+    def __init__(self, configuration, pool_size=10):
+        configuration.connection_pool_maxsize = pool_size
+        self.pool_size = pool_size
+        self.api_client = ApiClient(configuration)
+        self.messaging = MessagingApi(self.api_client)
+        self.blob = MessagingApiBlob(self.api_client)
+        self._latency = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self.download_counters = Counters("downloads", "downloaded_bytes", "too_large")
+
+    def reply_message(self, request):
+        return self._timed("reply_message", self.messaging.reply_message, request)
+
+    def push_message(self, request):
+        return self._timed("push_message", self.messaging.push_message, request)
+
+    def show_loading_animation(self, request):
+        return self._timed("show_loading_animation", self.messaging.show_loading_animation, request)
+
+    def get_message_content(self, message_id):
+        return self._timed("get_message_content", self.blob.get_message_content, message_id=message_id)
+
+    def download_message_content(self, message_id, file, max_bytes=None, timeout=60.0):
+        """把影片等大型內容分段寫入 file（需有 write 方法），記憶體用量固定為一個 chunk；回傳寫入的位元組數。
+
+        SDK 的 get_message_content 會把整個內容讀進記憶體，這裡改用同一個連線池直接串流。
+        超過 max_bytes 時中斷連線並拋出 ContentTooLarge，已寫入的部分由呼叫端丟棄。
+        """
+        return self._timed("download_message_content", self._download, message_id, file, max_bytes, timeout)
+
+    def _download(self, message_id, file, max_bytes, timeout):
+        configuration = self.api_client.configuration
+        url = f"{configuration.host or BLOB_HOST}/v2/bot/message/{quote(str(message_id), safe='')}/content"
+        headers = {
+            "Authorization": f"Bearer {configuration.access_token}",
+            "User-Agent": self.api_client.user_agent,
+        }
+        response = self.api_client.rest_client.pool_manager.request(
+            "GET", url, headers=headers, preload_content=False, timeout=timeout
+        )
+        try:
+            if not 200 <= response.status <= 299:
+                response.drain_conn()
+                raise ApiException(status=response.status, reason=response.reason)
+            length = response.headers.get("Content-Length")
+            if max_bytes and length and int(length) > max_bytes:
+                raise ContentTooLarge(f"{length} bytes > {max_bytes}")
+            size = 0
+            for chunk in response.stream(CHUNK_SIZE):
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise ContentTooLarge(f"more than {max_bytes} bytes")
+                file.write(chunk)
+        except ContentTooLarge:
+            self.download_counters.incr("too_large")
+            # 沒讀完的連線不能再重用，直接關閉
+            response.close()
+            raise
+        finally:
+            response.release_conn()
+        self.download_counters.incr("downloads")
+        self.download_counters.incr("downloaded_bytes", size)
+        return size
+
+    def _timed(self, name, func, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                stats = self._latency.get(name)
+                if stats is None:
+                    stats = self._latency[name] = LatencyStats()
+            stats.record(time.monotonic() - started)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.api_client.close()
+
+    def _pool_stats(self):
+        """urllib3 每個連線池的連線數與請求數；requests 遠多於 connections 代表連線有被重用。"""
+        pool_manager = getattr(getattr(self.api_client, "rest_client", None), "pool_manager", None)
+        if pool_manager is None:
+            return {"connections": 0, "requests": 0, "reuse_rate": 0.0}
+        connections = requests = 0
+        for key in list(pool_manager.pools.keys()):
+            pool = pool_manager.pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests += pool.num_requests
+        return {
+            "connections": connections,
+            "requests": requests,
+            "reuse_rate": round(1 - connections / requests, 3) if requests else 0.0,
+        }
+
+    def stats(self):
+        with self._lock:
+            latency = dict(self._latency)
+        return {
+            "pool_size": self.pool_size,
+            **self._pool_stats(),
+            "downloads": self.download_counters.snapshot(),
+            "latency": {name: stats.snapshot() for name, stats in latency.items()},
+        }
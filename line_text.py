@@ -0,0 +1,172 @@
+"""
+東吳大學資料系 2025 LINEBOT
+Markdown 轉 LINE 純文字：逐行處理一次就完成，不需先轉 HTML 再用 BeautifulSoup 取文字；保留清單符號與編號
+"""
+
+import re
+
+# LINE 文字訊息上限 5000 字，單次 reply / push 最多 5 則
+MAX_MESSAGE_CHARS = 5000
+MAX_MESSAGES = 5
+
+FENCE_RE = re.compile(r"^\s*(```|~~~)")
+HEADING_RE = re.compile(r"^\s{0,3}#{1,6}\s+(.*?)\s*#*\s*$")
+SETEXT_RE = re.compile(r"^\s{0,3}(=+|-+)\s*$")
+RULE_RE = re.compile(r"^\s{0,3}([-*_])(\s*\1){2,}\s*$")
+BULLET_RE = re.compile(r"^(\s*)[-*+]\s+(.*)$")
+ORDERED_RE = re.compile(r"^(\s*)(\d{1,9})[.)]\s+(.*)$")
+QUOTE_RE = re.compile(r"^\s{0,3}>\s?(.*)$")
+TABLE_SEPARATOR_RE = re.compile(r"^\s*\|?\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)*\|?\s*$")
+
+IMAGE_RE = re.compile(r"!\[([^\]]*)\]\(([^)\s]+)(?:\s+\"[^\"]*\")?\)")
+LINK_RE = re.compile(r"\[([^\]]+)\]\(([^)\s]+)(?:\s+\"[^\"]*\")?\)")
+AUTOLINK_RE = re.compile(r"<(https?://[^>\s]+)>")
+CODE_RE = re.compile(r"`+([^`]+)`+")
+# 粗體／斜體不套用 CommonMark 的左右側規則，「**重點**」緊鄰中文標點時也能正確移除
+STRONG_RE = re.compile(r"(\*\*|__)(?=\S)(.+?)(?<=\S)\1")
+EM_STAR_RE = re.compile(r"\*(?=\S)([^*]+?)(?<=\S)\*")
+# 底線斜體只在前後不是英數字時才算，避免吃掉 snake_case
+EM_UNDERSCORE_RE = re.compile(r"(?<![0-9A-Za-z])_(?=\S)([^_]+?)(?<=\S)_(?![0-9A-Za-z])")
+STRIKE_RE = re.compile(r"~~(?=\S)(.+?)(?<=\S)~~")
+ESCAPE_RE = re.compile(r"\\([\\`*_{}\[\]()#+\-.!|>~])")
+INLINE_MARK_RE = re.compile(r"[\\`*_\[<~]")
+HELD_RE = re.compile(r"\0(\d+)\0")
+HTML_TAG_RE = re.compile(r"</?(?:br|b|i|strong|em|u|p|span|div)\b[^>]*>", re.IGNORECASE)
+
+BULLET = "•"
+INDENT = "  "
+
+
+def render_inline(text):
+    """移除行內標記：強調、刪除線、行內程式碼、連結（保留網址）與簡單的 HTML 標籤。"""
+    if not INLINE_MARK_RE.search(text):
+        return text
+    held = []
+
+    def hold(value):
+        # 跳脫字元與程式碼內容先暫存起來，避免被當成標記處理
+        held.append(value)
+        return f"\0{len(held) - 1}\0"
+
+    text = ESCAPE_RE.sub(lambda m: hold(m.group(1)), text)
+    text = CODE_RE.sub(lambda m: hold(m.group(1).strip()), text)
+    text = IMAGE_RE.sub(lambda m: f"{m.group(1)} {m.group(2)}".strip(), text)
+    text = LINK_RE.sub(lambda m: m.group(1) if m.group(1) == m.group(2) else f"{m.group(1)} ({m.group(2)})", text)
+    text = AUTOLINK_RE.sub(r"\1", text)
+    text = HTML_TAG_RE.sub("", text)
+    text = STRONG_RE.sub(r"\2", text)
+    text = STRIKE_RE.sub(r"\1", text)
+    text = EM_STAR_RE.sub(r"\1", text)
+    text = EM_UNDERSCORE_RE.sub(r"\1", text)
+    if held:
+        text = HELD_RE.sub(lambda m: held[int(m.group(1))], text)
+    return text
+
+
+def iter_lines(lines):
+    """逐行產生轉換後的文字；連續空行合併成一行。"""
+    in_code = False
+    blank = True
+    previous = None
+    for raw in lines:
+        line = raw.rstrip()
+        if FENCE_RE.match(line):
+            in_code = not in_code
+            continue
+        if in_code:
+            yield raw.rstrip("\n")
+            blank = False
+            continue
+
+        match = QUOTE_RE.match(line)
+        if match:
+            line = match.group(1)
+
+        if previous is not None and SETEXT_RE.match(line):
+            # 上一行是 setext 標題（底下一排 === 或 ---），標題本身已輸出
+            previous = None
+            continue
+        if not line.strip() or RULE_RE.match(line):
+            if not blank:
+                yield ""
+            blank = True
+            previous = None
+            continue
+        if TABLE_SEPARATOR_RE.match(line) and "|" in line:
+            continue
+
+        match = HEADING_RE.match(line)
+        if match:
+            text = render_inline(match.group(1))
+        elif BULLET_RE.match(line):
+            indent, body = BULLET_RE.match(line).groups()
+            text = f"{INDENT * (len(indent.expandtabs(4)) // 2)}{BULLET} {render_inline(body)}"
+        elif ORDERED_RE.match(line):
+            indent, number, body = ORDERED_RE.match(line).groups()
+            text = f"{INDENT * (len(indent.expandtabs(4)) // 2)}{number}. {render_inline(body)}"
+        elif line.lstrip().startswith("|") and line.rstrip().endswith("|"):
+            cells = [render_inline(cell.strip()) for cell in line.strip().strip("|").split("|")]
+            text = "｜".join(cells)
+        else:
+            text = render_inline(line.strip())
+        yield text
+        blank = False
+        previous = text
+
+
+def render(markdown_text):
+    """把 Gemini / GPT 回覆的 Markdown 轉成適合 LINE 顯示的純文字。"""
+    if not markdown_text:
+        return ""
+    return "\n".join(iter_lines(markdown_text.splitlines())).strip()
+
+
+def message_length(text):
+    """LINE 以 UTF-16 計算字數：中日文一字算 1，emoji 等補充平面字元算 2。"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _cut(text, limit):
+    """找出不超過 limit 的最長前綴長度。"""
+    cut = min(len(text), limit)
+    while message_length(text[:cut]) > limit:
+        cut -= max(1, (message_length(text[:cut]) - limit) // 2)
+    return cut
+
+
+def split_messages(text, limit=MAX_MESSAGE_CHARS, max_messages=MAX_MESSAGES):
+    """依段落、行、字元的順序切成每則不超過 limit 字的訊息；超過 max_messages 則時最後一則截斷並加上「…」。"""
+    chunks = []
+    current = ""
+    for paragraph in text.split("\n\n"):
+        candidate = f"{current}\n\n{paragraph}" if current else paragraph
+        if message_length(candidate) <= limit:
+            current = candidate
+            continue
+        if current:
+            chunks.append(current)
+        current = ""
+        for line in paragraph.split("\n"):
+            candidate = f"{current}\n{line}" if current else line
+            if message_length(candidate) <= limit:
+                current = candidate
+                continue
+            if current:
+                chunks.append(current)
+            while message_length(line) > limit:
+                cut = _cut(line, limit)
+                chunks.append(line[:cut])
+                line = line[cut:]
+            current = line
+    if current:
+        chunks.append(current)
+    if len(chunks) > max_messages:
+        chunks = chunks[:max_messages]
+        last = chunks[-1]
+        chunks[-1] = last[:_cut(last, limit - 1)] + "…"
+    return chunks
+
+
+def render_messages(markdown_text, limit=MAX_MESSAGE_CHARS, max_messages=MAX_MESSAGES):
+    """render() 後再 split_messages()，回傳可直接包成 TextMessage 的字串串列。"""
+    return split_messages(render(markdown_text), limit, max_messages) or [""]
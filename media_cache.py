@@ -0,0 +1,128 @@
+"""
+東吳大學資料系 2025 LINEBOT
+圖片／影片說明快取：完全相同的內容以 sha256 比對；可選擇讓同一位使用者重新壓縮、縮放過的圖片以感知雜湊（dHash）加上配色比對，相同的轉傳內容不必再呼叫 Gemini
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import Counters
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+def color_distance(a, b):
+    """兩組 color_signature 每個色版的平均差（0～255）。"""
+    return sum(abs(x - y) for x, y in zip(a, b)) / len(a)
+
+
+class MediaResponseCache:
+    """有 TTL 與筆數上限（LRU）的快取；fingerprint 為 config_fingerprint()，系統提示或模型改變時舊結果不再命中。
+
+    內容雜湊完全相同時不分使用者都可命中（同一個檔案的說明不含其他人的資訊）。
+    相近比對預設關閉（threshold=0）：版面相同、只有小字不同的截圖在任何縮圖層級都與重新壓縮的同一張圖差不多，
+    無法可靠區分。開啟時只在同一個 scope（使用者）內比對，且須同時符合：
+    - dHash 漢明距離 ≤ threshold
+    - 配色平均差 ≤ color_threshold
+    - dHash 不是低資訊量的雜湊（純色、漸層的 1 位元過少或過多，不同圖片也會得到幾乎相同的雜湊）
+    筆數上限不大，查詢時直接掃過同一個 fingerprint 的所有圖片。
+    """
+
+    def __init__(self, max_entries=512, ttl=86400, threshold=0, color_threshold=12.0, hash_bits=256, min_bits=0.1):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.color_threshold = color_threshold
+        self.hash_bits = hash_bits
+        self.min_bits = int(hash_bits * min_bits)
+        self._entries = OrderedDict()  # key -> (expires_at, fingerprint, signature, value)；signature 為 (scope, dhash, colors) 或 None
+        self._lock = threading.Lock()
+        self.counters = Counters("hits", "near_hits", "misses", "stores", "evictions", "expired", "low_entropy")
+
+    def _informative(self, image_hash):
+        bits = image_hash.bit_count()
+        return self.min_bits <= bits <= self.hash_bits - self.min_bits
+
+    def get_image(self, content_hash, image_hash, colors, fingerprint, scope):
+        """先以內容雜湊完全比對，再找同一個 scope 中最相近且通過配色確認的圖片；沒有時回傳 None。"""
+        now = time.monotonic()
+        key = f"image:{fingerprint}:{content_hash}"
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return self._hit(key, near=False)
+            near = self.threshold > 0 and self._informative(image_hash)
+            if self.threshold > 0 and not near:
+                self.counters.incr("low_entropy")
+            best_key, best_distance = None, self.threshold + 1
+            expired = []
+            for entry_key, (expires_at, entry_fingerprint, signature, _) in self._entries.items():
+                if expires_at <= now:
+                    expired.append(entry_key)
+                    continue
+                if not near or signature is None or entry_fingerprint != fingerprint:
+                    continue
+                entry_scope, entry_hash, entry_colors = signature
+                if entry_scope != scope:
+                    continue
+                distance = hamming(image_hash, entry_hash)
+                if distance < best_distance and color_distance(colors, entry_colors) <= self.color_threshold:
+                    best_key, best_distance = entry_key, distance
+            for entry_key in expired:
+                del self._entries[entry_key]
+            if expired:
+                self.counters.incr("expired", len(expired))
+            return self._hit(best_key, near=True)
+
+    def put_image(self, content_hash, image_hash, colors, fingerprint, scope, value):
+        signature = (scope, image_hash, colors) if self._informative(image_hash) else None
+        self._put(f"image:{fingerprint}:{content_hash}", fingerprint, signature, value)
+
+    def get(self, content_hash, fingerprint):
+        """以內容雜湊完全比對，用於影片、多張圖片等不做感知比對的內容。"""
+        key = f"content:{fingerprint}:{content_hash}"
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                self.counters.incr("expired")
+                entry = None
+            return self._hit(key if entry is not None else None, near=False)
+
+    def put(self, content_hash, fingerprint, value):
+        self._put(f"content:{fingerprint}:{content_hash}", fingerprint, None, value)
+
+    def _hit(self, key, near):
+        if key is None:
+            self.counters.incr("misses")
+            return None
+        self._entries.move_to_end(key)
+        self.counters.incr("near_hits" if near else "hits")
+        return self._entries[key][3]
+
+    def _put(self, key, fingerprint, signature, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, fingerprint, signature, value)
+            self._entries.move_to_end(key)
+            self.counters.incr("stores")
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters.incr("evictions")
+
+    def stats(self):
+        counters = self.counters.snapshot()
+        hits = counters["hits"] + counters["near_hits"]
+        lookups = hits + counters["misses"]
+        with self._lock:
+            size = len(self._entries)
+        return {
+            "size": size,
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "color_threshold": self.color_threshold,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            **counters,
+        }
@@ -0,0 +1,295 @@
+"""
+東吳大學資料系 2025 LINEBOT
+媒體分析工作佇列（SQLite）：webhook 只負責排入工作，背景 worker 下載、分析並推播結果；失敗會延遲重試，重啟後繼續處理
+"""
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from metrics import Counters, LatencyStats
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS media_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    dedupe_key TEXT UNIQUE,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    lease_until REAL,
+    worker TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_media_jobs_ready ON media_jobs (status, available_at);
+"""
+
+# 完成或放棄的工作保留多久（秒）供查詢，之後由 worker 順手清除
+RETENTION = 86400
+
+
+class MediaJobQueue:
+    """handlers 為 {kind: func(payload)}；func 拋出例外就在 backoff × 2^(attempts-1) 秒後重試，最多 max_attempts 次。
+
+    多個 gunicorn worker 共用同一個資料庫檔，各自的 worker 執行緒以 BEGIN IMMEDIATE 搶工作，不會重複執行。
+    執行中的工作由背景執行緒每 lease/3 秒續約；行程被重啟或終止、超過 lease 秒沒有續約的工作會重新排入，
+    不必等到工作本身可能的最長執行時間；已用完 max_attempts 次的（例如每次都讓行程當掉的工作）直接標記失敗。
+    只有領到工作的 worker（status 仍是 running 且 worker 相同）能寫回結果，lease 過期被接手後不會覆寫新的狀態。
+    最終失敗時呼叫 on_failure(kind, payload, error)，例如推播道歉訊息。
+    """
+
+    def __init__(self, path, handlers, on_failure=None, workers=2, max_attempts=3, backoff=5.0,
+                 lease=60.0, poll_interval=1.0):
+        self.path = path
+        self._handlers = handlers
+        self._on_failure = on_failure
+        self._workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._local = threading.local()
+        self._wakeup = threading.Condition()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._running = set()
+        self._running_lock = threading.Lock()
+        self._last_cleanup = 0.0
+        self.counters = Counters("enqueued", "duplicates", "succeeded", "retried", "failed", "recovered", "lost_lease")
+        self.wait_time = LatencyStats()
+        self.run_time = LatencyStats()
+        self.total_time = LatencyStats()
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None：交易由這裡自行以 BEGIN IMMEDIATE 控制
+            conn = sqlite3.connect(self.path, timeout=10.0, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def start(self):
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._run, name=f"media-job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        heartbeat = threading.Thread(target=self._heartbeat, name="media-job-heartbeat", daemon=True)
+        heartbeat.start()
+        self._threads.append(heartbeat)
+        logger.info(f"[MediaJobQueue] Started {self._workers} workers")
+
+    def enqueue(self, kind, payload, dedupe_key=None):
+        """排入工作並回傳 id；dedupe_key 重複（例如 LINE 重送同一個 webhook）時不重複排入，回傳 None。"""
+        now = time.time()
+        cursor = self._conn().execute(
+            "INSERT OR IGNORE INTO media_jobs (kind, dedupe_key, payload, available_at, created_at)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (kind, dedupe_key, json.dumps(payload, ensure_ascii=False), now, now),
+        )
+        if cursor.rowcount == 0:
+            self.counters.incr("duplicates")
+            return None
+        self.counters.incr("enqueued")
+        with self._wakeup:
+            self._wakeup.notify()
+        return cursor.lastrowid
+
+    def _claim(self):
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            exhausted = conn.execute(
+                "SELECT id, kind, payload, attempts FROM media_jobs"
+                " WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            ).fetchall()
+            for job_id, _, _, attempts in exhausted:
+                conn.execute(
+                    "UPDATE media_jobs SET status = 'failed', lease_until = NULL, finished_at = ?, error = ? WHERE id = ?",
+                    (now, f"lease expired after {attempts} attempts", job_id),
+                )
+            recovered = conn.execute(
+                "UPDATE media_jobs SET status = 'queued', lease_until = NULL"
+                " WHERE status = 'running' AND lease_until < ?",
+                (now,),
+            ).rowcount
+            row = conn.execute(
+                "SELECT id, kind, payload, attempts, created_at FROM media_jobs"
+                " WHERE status = 'queued' AND available_at <= ? ORDER BY available_at, id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE media_jobs SET status = 'running', attempts = attempts + 1, lease_until = ?,"
+                    " worker = ?, started_at = ? WHERE id = ?",
+                    (now + self.lease, self._worker_id, now, row[0]),
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if recovered:
+            self.counters.incr("recovered", recovered)
+            logger.warning(f"[MediaJobQueue] Re-queued {recovered} job(s) with expired lease")
+        for job_id, kind, payload, attempts in exhausted:
+            self.counters.incr("failed")
+            logger.error(f"[MediaJobQueue] Job {job_id} ({kind}) lease expired after {attempts} attempts, giving up")
+            self._notify_failure(job_id, kind, json.loads(payload), TimeoutError("lease expired"))
+        return row
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                logger.error(f"[MediaJobQueue] Failed to claim job: {e}")
+                job = None
+            if job is None:
+                self._cleanup()
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+                continue
+            self._execute(*job)
+
+    def _heartbeat(self):
+        while not self._stopping.wait(self.lease / 3):
+            with self._running_lock:
+                running = list(self._running)
+            if not running:
+                continue
+            try:
+                self._conn().execute(
+                    f"UPDATE media_jobs SET lease_until = ? WHERE status = 'running' AND worker = ?"
+                    f" AND id IN ({','.join('?' * len(running))})",
+                    (time.time() + self.lease, self._worker_id, *running),
+                )
+            except sqlite3.Error as e:
+                logger.warning(f"[MediaJobQueue] Failed to renew leases: {e}")
+
+    def _execute(self, job_id, kind, payload, attempts, created_at):
+        with self._running_lock:
+            self._running.add(job_id)
+        try:
+            self._execute_job(job_id, kind, payload, attempts, created_at)
+        finally:
+            with self._running_lock:
+                self._running.discard(job_id)
+
+    def _execute_job(self, job_id, kind, payload, attempts, created_at):
+        attempts += 1
+        started = time.time()
+        self.wait_time.record(started - created_at)
+        payload = json.loads(payload)
+        try:
+            handler = self._handlers[kind]
+            handler(payload)
+        except Exception as e:
+            self.run_time.record(time.time() - started)
+            self._fail(job_id, kind, payload, attempts, e)
+            return
+        finished = time.time()
+        self.run_time.record(finished - started)
+        self.total_time.record(finished - created_at)
+        updated = self._conn().execute(
+            "UPDATE media_jobs SET status = 'done', lease_until = NULL, error = NULL, finished_at = ?"
+            " WHERE id = ? AND status = 'running' AND worker = ?",
+            (finished, job_id, self._worker_id),
+        ).rowcount
+        if not updated:
+            self._lost_lease(job_id, kind)
+            return
+        self.counters.incr("succeeded")
+
+    def _lost_lease(self, job_id, kind):
+        # lease 過期後已被重新排入或由其他 worker 接手，結果以目前的狀態為準
+        self.counters.incr("lost_lease")
+        logger.warning(f"[MediaJobQueue] Job {job_id} ({kind}) lost its lease, not updating its status")
+
+    def _fail(self, job_id, kind, payload, attempts, error):
+        now = time.time()
+        if attempts < self.max_attempts:
+            delay = self.backoff * 2 ** (attempts - 1)
+            updated = self._conn().execute(
+                "UPDATE media_jobs SET status = 'queued', lease_until = NULL, available_at = ?, error = ?"
+                " WHERE id = ? AND status = 'running' AND worker = ?",
+                (now + delay, str(error), job_id, self._worker_id),
+            ).rowcount
+            if not updated:
+                self._lost_lease(job_id, kind)
+                return
+            self.counters.incr("retried")
+            logger.warning(f"[MediaJobQueue] Job {job_id} ({kind}) attempt {attempts} failed, retrying in {delay:g}s: {error}")
+            return
+        updated = self._conn().execute(
+            "UPDATE media_jobs SET status = 'failed', lease_until = NULL, finished_at = ?, error = ?"
+            " WHERE id = ? AND status = 'running' AND worker = ?",
+            (now, str(error), job_id, self._worker_id),
+        ).rowcount
+        if not updated:
+            self._lost_lease(job_id, kind)
+            return
+        self.counters.incr("failed")
+        logger.error(f"[MediaJobQueue] Job {job_id} ({kind}) failed after {attempts} attempts: {error}")
+        self._notify_failure(job_id, kind, payload, error)
+
+    def _notify_failure(self, job_id, kind, payload, error):
+        if self._on_failure is not None:
+            try:
+                self._on_failure(kind, payload, error)
+            except Exception as e:
+                logger.error(f"[MediaJobQueue] on_failure for job {job_id} raised: {e}")
+
+    def _cleanup(self):
+        now = time.time()
+        if now - self._last_cleanup < 600:
+            return
+        self._last_cleanup = now
+        try:
+            self._conn().execute(
+                "DELETE FROM media_jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+                (now - RETENTION,),
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"[MediaJobQueue] Cleanup failed: {e}")
+
+    def shutdown(self, timeout=10.0):
+        """停止領取新工作；執行中的工作在 timeout 內做完，沒做完的會在 lease 到期後由其他 worker 接手。"""
+        self._stopping.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+    def stats(self):
+        conn = self._conn()
+        backlog = dict(conn.execute("SELECT status, COUNT(*) FROM media_jobs GROUP BY status").fetchall())
+        oldest = conn.execute("SELECT MIN(created_at) FROM media_jobs WHERE status = 'queued'").fetchone()[0]
+        return {
+            "workers": self._workers,
+            "queued": backlog.get("queued", 0),
+            "running": backlog.get("running", 0),
+            "oldest_queued_seconds": round(time.time() - oldest, 1) if oldest else 0.0,
+            **self.counters.snapshot(),
+            "wait": self.wait_time.snapshot(),
+            "run": self.run_time.snapshot(),
+            "total": self.total_time.snapshot(),
+        }
@@ -0,0 +1,216 @@
+"""
+東吳大學資料系 2025 LINEBOT
+媒體檔儲存：以內容雜湊命名（相同檔案只存一份），SQLite 記錄大小與最後使用時間，依總容量與存放天數自動清除
+"""
+
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import abort, send_file
+
+from metrics import Counters
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS media (
+    filename TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_media_last_access ON media (last_access);
+"""
+
+# 只接受 put() 產生的檔名，其他路徑一律視為不存在
+FILENAME_RE = re.compile(r"^[0-9a-f]{32}(?:\.[a-z0-9]{1,5})?$")
+# 檔名就是內容雜湊，同一個網址的內容永遠不變，可以讓瀏覽器與 LINE 快取一年
+CACHE_MAX_AGE = 365 * 86400
+# 最後使用時間最多每隔幾秒寫回一次，避免每次讀取都寫資料庫
+TOUCH_INTERVAL = 60
+
+
+class IncomingFile:
+    """MediaStore.incoming() 的寫入端：邊寫邊算雜湊，離開 with 區塊後才有 filename 與 path。"""
+
+    def __init__(self, file):
+        self.file = file
+        self.size = 0
+        self.filename = None
+        self.path = None
+        self._hash = hashlib.sha256()
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+
+class MediaStore:
+    """檔名為 sha256 前 32 碼加副檔名；index_path 預設放在 root 旁邊，不會被 /images/ 路由存取到。"""
+
+    def __init__(self, root, max_bytes=1024 ** 3, max_age=30 * 86400, index_path=None):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.index_path = index_path or f"{self.root}.db"
+        os.makedirs(self.root, exist_ok=True)
+        self._local = threading.local()
+        self._evict_lock = threading.Lock()
+        self.counters = Counters("stored", "deduplicated", "evicted", "evicted_bytes", "lookups", "not_found")
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.index_path, timeout=5.0)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def filename_for(data, ext):
+        return f"{hashlib.sha256(data).hexdigest()[:32]}{ext.lower()}"
+
+    def put(self, data, ext=""):
+        """存入 bytes 並回傳檔名；相同內容已存在時只更新最後使用時間。"""
+        filename = self.filename_for(data, ext)
+        path = os.path.join(self.root, filename)
+        if os.path.exists(path):
+            self._record(filename, len(data), stored=False)
+            return filename
+        # 先寫到暫存檔再改名，其他 worker 不會讀到寫一半的檔案
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._record(filename, len(data), stored=True)
+        return filename
+
+    @contextmanager
+    def incoming(self, ext=""):
+        """逐段寫入大型檔案（例如影片），不必整份放在記憶體；正常離開 with 區塊時依內容雜湊存入，發生例外則丟棄。"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".tmp-")
+        incoming = IncomingFile(os.fdopen(fd, "wb"))
+        try:
+            with incoming.file:
+                yield incoming
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        filename = f"{incoming._hash.hexdigest()[:32]}{ext.lower()}"
+        path = os.path.join(self.root, filename)
+        stored = not os.path.exists(path)
+        if stored:
+            os.replace(tmp_path, path)
+        else:
+            os.remove(tmp_path)
+        incoming.filename = filename
+        incoming.path = path
+        self._record(filename, incoming.size, stored=stored)
+
+    def _record(self, filename, size, stored):
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            if stored:
+                conn.execute(
+                    "INSERT OR REPLACE INTO media (filename, size, created_at, last_access) VALUES (?, ?, ?, ?)",
+                    (filename, size, now, now),
+                )
+            else:
+                conn.execute(
+                    "INSERT INTO media (filename, size, created_at, last_access) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT(filename) DO UPDATE SET last_access = excluded.last_access",
+                    (filename, size, now, now),
+                )
+        if stored:
+            self.counters.incr("stored")
+            self.evict()
+        else:
+            self.counters.incr("deduplicated")
+
+    def path(self, filename):
+        """回傳檔案的完整路徑（並更新最後使用時間）；不存在或檔名不合法時回傳 None。"""
+        self.counters.incr("lookups")
+        if not FILENAME_RE.match(filename):
+            self.counters.incr("not_found")
+            return None
+        path = os.path.join(self.root, filename)
+        if not os.path.exists(path):
+            self.counters.incr("not_found")
+            return None
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "UPDATE media SET last_access = ? WHERE filename = ? AND last_access < ?",
+                (now, filename, now - TOUCH_INTERVAL),
+            )
+        return path
+
+    def evict(self):
+        """刪除超過 max_age 未使用的檔案，總容量仍超過 max_bytes 時再從最久未使用的開始刪。"""
+        if not self._evict_lock.acquire(blocking=False):
+            return
+        try:
+            conn = self._conn()
+            victims = conn.execute(
+                "SELECT filename, size FROM media WHERE last_access < ?", (time.time() - self.max_age,)
+            ).fetchall()
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM media").fetchone()[0]
+            total -= sum(size for _, size in victims)
+            if total > self.max_bytes:
+                expired = {filename for filename, _ in victims}
+                for filename, size in conn.execute("SELECT filename, size FROM media ORDER BY last_access"):
+                    if total <= self.max_bytes:
+                        break
+                    if filename not in expired:
+                        victims.append((filename, size))
+                        total -= size
+            for filename, size in victims:
+                try:
+                    os.remove(os.path.join(self.root, filename))
+                except FileNotFoundError:
+                    pass
+                self.counters.incr("evicted")
+                self.counters.incr("evicted_bytes", size)
+            if victims:
+                with conn:
+                    conn.executemany("DELETE FROM media WHERE filename = ?", [(f,) for f, _ in victims])
+                logger.info(f"[MediaStore] Evicted {len(victims)} file(s)")
+        finally:
+            self._evict_lock.release()
+
+    def stats(self):
+        files, total = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM media").fetchone()
+        return {"files": files, "bytes": total, "max_bytes": self.max_bytes, **self.counters.snapshot()}
+
+
+def send_media(store, filename):
+    """以強 ETag（內容雜湊）回應條件式 GET，支援影片拖曳需要的 Range 請求。
+
+    整檔回應交給 WSGI server 的 file_wrapper，gunicorn 會用 sendfile() 直接由核心傳送。
+    """
+    path = store.path(filename)
+    if path is None:
+        abort(404)
+    response = send_file(path, conditional=True, etag=filename.split(".", 1)[0], max_age=CACHE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
@@ -0,0 +1,66 @@
+"""
+東吳大學資料系 2025 LINEBOT
+共用的輕量統計工具（延遲分佈、計數器），各元件的 /metrics 資料都由此產生
+"""
+
+import threading
+from collections import deque
+
+
+class LatencyStats:
+    """執行緒安全的延遲統計，只保留最近 window 筆資料計算百分位數。"""
+
+    def __init__(self, window=1000):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, pct, default=None):
+        """回傳最近樣本的第 pct 百分位數（秒），沒有樣本時回傳 default。"""
+        with self._lock:
+            if not self._samples:
+                return default
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def snapshot(self):
+        """以毫秒為單位輸出摘要，方便直接放進 /metrics。"""
+        avg = self.total / self.count if self.count else 0.0
+        return {
+            "count": self.count,
+            "avg_ms": round(avg * 1000, 1),
+            "p50_ms": round(self.percentile(50, 0.0) * 1000, 1),
+            "p95_ms": round(self.percentile(95, 0.0) * 1000, 1),
+            "max_ms": round(self.max * 1000, 1),
+        }
+
+
+class Counters:
+    """執行緒安全的具名計數器。"""
+
+    def __init__(self, *names):
+        self._values = {name: 0 for name in names}
+        self._lock = threading.Lock()
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def get(self, name):
+        with self._lock:
+            return self._values.get(name, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
@@ -2,11 +2,10 @@
 東吳大學資料系 2025 LINEBOT
 """
 
+import atexit
 import os
 
 from flask import Flask, abort, request
-from bs4 import BeautifulSoup
-import markdown
 
 from google import genai
 from google.genai import types # 加入system prompot所需的types模組
@@ -14,21 +13,24 @@ from google.genai import types # 加入system prompot所需的types模組
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
-    ApiClient,
     Configuration,
-    MessagingApi,
     ReplyMessageRequest,
     TextMessage,
 )
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
 
+from chat_sessions import SessionManager
+from line_client import LineClient
+from line_text import render_messages
+
 
 # Initialize Google Gemini
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 client = genai.Client(api_key=GOOGLE_API_KEY)
-chat = client.chats.create(model="gemini-2.0-flash",
+# 每位使用者各自一段對話，閒置或超過上限時自動回收
+sessions = SessionManager(client, model="gemini-2.0-flash",
     config=types.GenerateContentConfig(
-        system_instruction="你是一個中文的AI助手，請用繁體中文回答"    
+        system_instruction="你是一個中文的AI助手，請用繁體中文回答"
     )
 )
 
@@ -38,11 +40,13 @@ channel_secret = os.getenv("YOUR_CHANNEL_SECRET")
 channel_access_token = os.getenv("YOUR_CHANNEL_ACCESS_TOKEN")
 configuration = Configuration(access_token=channel_access_token)
 handler = WebhookHandler(channel_secret)
+line_client = LineClient(configuration)
+atexit.register(line_client.close)
 
 
-def query(payload: str) -> str:
-    """Send a prompt to Gemini and return the response text."""
-    response = chat.send_message(message=payload)
+def query(payload: str, user_id: str = None) -> str:
+    """Send a prompt to the user's own Gemini session and return the response text."""
+    response = sessions.send(user_id, payload)
     return response.text
 
 
@@ -74,15 +78,11 @@ def callback():
 def handle_text_message(event):
     """Handle incoming text message event."""
     user_input = event.message.text.strip()
-    response_text = query(user_input)
-    html_msg = markdown.markdown(response_text)
-    soup = BeautifulSoup(html_msg, "html.parser")
-
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=soup.get_text())],
-            )
-        )
\ No newline at end of file
+    user_id = getattr(event.source, "user_id", None)
+    response_text = query(user_input, user_id)
+    line_client.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=chunk) for chunk in render_messages(response_text)],
+        )
+    )
\ No newline at end of file
@@ -0,0 +1,88 @@
+"""
+東吳大學資料系 2025 LINEBOT
+搜尋結果預先載入：列出摘要後就在背景抓前幾筆的完整內容，使用者選擇時直接由記憶體回覆
+"""
+
+import logging
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from metrics import Counters
+
+logger = logging.getLogger(__name__)
+
+
+class DetailPrefetcher:
+    """每位使用者一組預先載入的工作，以摘要文字對應結果；執行緒池大小即為同時進行的上限。
+
+    結果只存在這個 worker 的記憶體中，查不到時由呼叫端照常同步取得。
+    """
+
+    def __init__(self, fetch, max_workers=2, top_n=3):
+        self._fetch = fetch
+        self.top_n = top_n
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._jobs = {}  # user_id -> {summary: Future}
+        self._lock = threading.Lock()
+        self.counters = Counters("submitted", "hits", "waited", "misses", "cancelled", "errors")
+
+    def start(self, user_id, items):
+        """為前 top_n 筆尚未有完整內容的結果排入背景工作，並取消這位使用者先前的工作。"""
+        self.cancel(user_id)
+        targets = [item for item in items if self._needs_fetch(item)][:self.top_n]
+        if not targets:
+            return
+        jobs = {}
+        for item in targets:
+            jobs[item["summary"]] = self._executor.submit(self._run, user_id, item)
+        with self._lock:
+            self._jobs[user_id] = jobs
+        self.counters.incr("submitted", len(jobs))
+
+    @staticmethod
+    def _needs_fetch(item):
+        return not item.get("full") and not item.get("doc_id")
+
+    def _run(self, user_id, item):
+        try:
+            return self._fetch(user_id, item)
+        except Exception as e:
+            self.counters.incr("errors")
+            logger.warning(f"[DetailPrefetcher] Prefetch failed for {user_id}: {e}")
+            raise
+
+    def get(self, user_id, item, timeout=0):
+        """回傳已預先載入的內容；仍在進行中時最多等 timeout 秒，沒有或失敗時回傳 None。"""
+        with self._lock:
+            future = self._jobs.get(user_id, {}).get(item["summary"])
+        if future is None:
+            self.counters.incr("misses")
+            return None
+        already_done = future.done()
+        try:
+            result = future.result(timeout=timeout)
+        except (FutureTimeout, CancelledError):
+            self.counters.incr("misses")
+            return None
+        except Exception:
+            return None
+        self.counters.incr("hits" if already_done else "waited")
+        return result
+
+    def cancel(self, user_id):
+        """取消尚未開始的工作；已在執行中的 Gemini 呼叫無法中斷，完成後結果直接丟棄。"""
+        with self._lock:
+            jobs = self._jobs.pop(user_id, {})
+        cancelled = sum(1 for future in jobs.values() if future.cancel())
+        if cancelled:
+            self.counters.incr("cancelled", cancelled)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self._lock:
+            users = len(self._jobs)
+            pending = sum(1 for jobs in self._jobs.values() for future in jobs.values() if not future.done())
+        return {"users": users, "pending": pending, "top_n": self.top_n, **self.counters.snapshot()}
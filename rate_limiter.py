@@ -0,0 +1,218 @@
+"""
+東吳大學資料系 2025 LINEBOT
+Gemini 呼叫限流：全域與各模型的 token bucket，等待中的請求依使用者輪流放行，避免單一使用者用光配額
+"""
+
+import contextvars
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from metrics import Counters, LatencyStats
+
+logger = logging.getLogger(__name__)
+
+SHARED_USER_KEY = "_shared"
+
+# 目前這次 Gemini 呼叫是替哪位使用者送出的，由 acting_for() 設定
+current_user = contextvars.ContextVar("gemini_user", default=None)
+
+
+@contextmanager
+def acting_for(user_id):
+    token = current_user.set(user_id)
+    try:
+        yield
+    finally:
+        current_user.reset(token)
+
+
+def acts_for_sender(func):
+    """handler 裝飾器：處理事件期間的 Gemini 呼叫都算在發訊者的額度裡。"""
+    @functools.wraps(func)
+    def wrapper(event, *args, **kwargs):
+        with acting_for(getattr(event.source, "user_id", None)):
+            return func(event, *args, **kwargs)
+    return wrapper
+
+
+def parse_rates(spec):
+    """解析「模型=每分鐘次數,模型=每分鐘次數」格式的設定字串。"""
+    rates = {}
+    for pair in spec.split(","):
+        model, sep, rpm = pair.partition("=")
+        if sep and model.strip() and rpm.strip():
+            rates[model.strip()] = float(rpm)
+    return rates
+
+
+class RateLimitExceeded(Exception):
+    """等待超過 max_wait 仍拿不到額度。"""
+
+    # 與 API 的 429 相同，HedgedModels 不會因此改用備援模型重送
+    code = 429
+
+
+class TokenBucket:
+    def __init__(self, per_minute, burst):
+        self.rate = per_minute / 60.0
+        self.capacity = float(max(1, burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """還要等幾秒才有 1 個額度（呼叫前需先 refill）。"""
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class _Lane:
+    """同一個模型的等待佇列：每位使用者一個 deque，order 為輪到誰。"""
+
+    def __init__(self):
+        self.queues = {}  # user key -> deque of tickets
+        self.order = deque()  # 有請求在等的使用者
+
+
+class FairRateLimiter:
+    """所有 bucket 都有額度才放行；等待中的請求依使用者輪流（round-robin），同一使用者內先到先出。
+
+    每個模型各有一條輪流順序：只在等某個模型額度的請求，不會擋住其他模型已有額度的請求。
+    沒有設定的限制（global_rpm 為 0、模型不在 model_rpm 中）視為不限。
+    """
+
+    def __init__(self, global_rpm=0, model_rpm=None, burst=5, max_wait=20.0):
+        self.burst = burst
+        self.max_wait = max_wait
+        self._global = TokenBucket(global_rpm, burst) if global_rpm > 0 else None
+        self._models = {
+            model: TokenBucket(rpm, burst) for model, rpm in (model_rpm or {}).items() if rpm > 0
+        }
+        self._lanes = {}  # model -> _Lane
+        self._cond = threading.Condition()
+        self.counters = Counters("granted", "waited", "rejected")
+        self.wait_time = LatencyStats()
+
+    def acquire(self, user_id, model):
+        """取得一次呼叫額度；超過 max_wait 時丟出 RateLimitExceeded。"""
+        key = user_id or SHARED_USER_KEY
+        buckets = [bucket for bucket in (self._global, self._models.get(model)) if bucket is not None]
+        if not buckets:
+            self.counters.incr("granted")
+            return
+        started = time.monotonic()
+        deadline = started + self.max_wait
+        ticket = object()
+        with self._cond:
+            lane = self._lanes.get(model)
+            if lane is None:
+                lane = self._lanes[model] = _Lane()
+            queue = lane.queues.get(key)
+            if queue is None:
+                queue = lane.queues[key] = deque()
+                lane.order.append(key)
+            queue.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = deadline - now
+                    if lane.order[0] == key and queue[0] is ticket:
+                        for bucket in buckets:
+                            bucket.refill(now)
+                        needed = max(bucket.wait_time() for bucket in buckets)
+                        if needed == 0:
+                            for bucket in buckets:
+                                bucket.tokens -= 1
+                            self._grant(model, lane, key, queue)
+                            break
+                        delay = min(delay, needed)
+                    if deadline <= now:
+                        self.counters.incr("rejected")
+                        raise RateLimitExceeded(f"rate limit wait exceeded {self.max_wait}s for {model}")
+                    self._cond.wait(delay)
+            finally:
+                if ticket in queue:
+                    queue.remove(ticket)
+                    if not queue:
+                        del lane.queues[key]
+                        lane.order.remove(key)
+                        if not lane.order:
+                            del self._lanes[model]
+                    self._cond.notify_all()
+
+        waited = time.monotonic() - started
+        self.wait_time.record(waited)
+        self.counters.incr("granted")
+        if waited > 0.01:
+            self.counters.incr("waited")
+
+    def _grant(self, model, lane, key, queue):
+        queue.popleft()
+        # 放行後換下一位使用者；這位使用者還有請求在等就排到最後
+        lane.order.popleft()
+        if queue:
+            lane.order.append(key)
+        else:
+            del lane.queues[key]
+            if not lane.order:
+                del self._lanes[model]
+        self._cond.notify_all()
+
+    def stats(self):
+        now = time.monotonic()
+        with self._cond:
+            buckets = {"global": self._global, **self._models}
+            tokens = {}
+            for name, bucket in buckets.items():
+                if bucket is not None:
+                    bucket.refill(now)
+                    tokens[name] = round(bucket.tokens, 2)
+            waiting_users = len({key for lane in self._lanes.values() for key in lane.queues})
+            waiting_by_model = {
+                model: sum(len(queue) for queue in lane.queues.values()) for model, lane in self._lanes.items()
+            }
+        return {
+            "max_wait_seconds": self.max_wait,
+            "tokens": tokens,
+            "waiting": sum(waiting_by_model.values()),
+            "waiting_by_model": waiting_by_model,
+            "waiting_users": waiting_users,
+            **self.counters.snapshot(),
+            "wait": self.wait_time.snapshot(),
+        }
+
+
+class RateLimitedModels:
+    """與 client.models 相同介面；每次 generate_content / generate_content_stream 前先向 limiter 取得額度。"""
+
+    def __init__(self, models, limiter):
+        self._models = models
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        return getattr(self._models, name)
+
+    def generate_content(self, *, model, **kwargs):
+        self.limiter.acquire(current_user.get(), model)
+        return self._models.generate_content(model=model, **kwargs)
+
+    def generate_content_stream(self, *, model, **kwargs):
+        self.limiter.acquire(current_user.get(), model)
+        return self._models.generate_content_stream(model=model, **kwargs)
+
+
+class RateLimitedClient:
+    """把 client 的 models 換成 RateLimitedModels，其他屬性照舊使用原本的 client。"""
+
+    def __init__(self, client, limiter):
+        self._client = client
+        self.models = RateLimitedModels(client.models, limiter)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
@@ -0,0 +1,169 @@
+"""
+東吳大學資料系 2025 LINEBOT
+回覆排程：追蹤每個事件 reply token 的年齡，快過期時先用 token 回一則「處理中」，完成後改用 push 送出結果
+"""
+
+import functools
+import logging
+import threading
+import time
+
+from linebot.v3.messaging import (
+    PushMessageRequest,
+    ReplyMessageRequest,
+    ShowLoadingAnimationRequest,
+    TextMessage,
+)
+
+from metrics import Counters
+
+logger = logging.getLogger(__name__)
+
+# LINE 單次 reply / push 最多 5 則訊息
+MAX_MESSAGES_PER_REQUEST = 5
+
+
+def source_id(event):
+    """push 的對象：群組、聊天室或個人。"""
+    source = event.source
+    return getattr(source, "group_id", None) or getattr(source, "room_id", None) or getattr(source, "user_id", None)
+
+
+def event_time(event):
+    timestamp = getattr(event, "timestamp", None)
+    return timestamp / 1000 if timestamp else time.time()
+
+
+class _Tracked:
+    def __init__(self, deadline, timer):
+        self.deadline = deadline
+        self.timer = timer
+        self.used = False
+        self.acked = False
+
+
+class ReplyScheduler:
+    """handler 以 watch() 包裝後，統一用 reply() 送出訊息；超過 budget 秒時自動改走 push。"""
+
+    def __init__(self, line_client, budget=40.0, ack_text="小花正在努力整理中，完成後馬上傳給您喔！"):
+        self.line = line_client
+        self.budget = budget
+        self.ack_text = ack_text
+        self._tracked = {}
+        self._lock = threading.Lock()
+        self.counters = Counters("reply", "reply_failed", "push", "ack", "expiry_saves", "loading", "errors")
+
+    def watch(self, func):
+        """handler 裝飾器：事件開始處理時啟動計時，結束時停止。"""
+        @functools.wraps(func)
+        def wrapper(event, *args, **kwargs):
+            self._start(event)
+            try:
+                return func(event, *args, **kwargs)
+            finally:
+                self._finish(event)
+        return wrapper
+
+    def _start(self, event):
+        token = getattr(event, "reply_token", None)
+        if not token:
+            return
+        deadline = event_time(event) + self.budget
+        timer = threading.Timer(max(0.0, deadline - time.time()), self._on_deadline, args=(token,))
+        timer.daemon = True
+        with self._lock:
+            self._tracked[token] = _Tracked(deadline, timer)
+        timer.start()
+
+    def _finish(self, event):
+        with self._lock:
+            tracked = self._tracked.pop(getattr(event, "reply_token", None), None)
+        if tracked is not None:
+            tracked.timer.cancel()
+
+    def _on_deadline(self, token):
+        with self._lock:
+            tracked = self._tracked.get(token)
+            if tracked is None or tracked.used:
+                return
+            tracked.used = True
+            tracked.acked = True
+        logger.info("[ReplyScheduler] Reply token about to expire, sending acknowledgement")
+        try:
+            self._reply(token, [TextMessage(text=self.ack_text)])
+            self.counters.incr("ack")
+        except Exception as e:
+            self.counters.incr("errors")
+            logger.error(f"[ReplyScheduler] Failed to send acknowledgement: {e}")
+
+    def reply(self, event, messages):
+        """reply token 仍可用就用 reply，否則改用 push 送到同一個聊天。"""
+        token = event.reply_token
+        with self._lock:
+            tracked = self._tracked.get(token)
+            if tracked is not None:
+                use_reply = not tracked.used and time.time() < tracked.deadline
+                acked = tracked.acked
+                tracked.used = True
+                tracked.timer.cancel()
+            else:
+                use_reply = time.time() < event_time(event) + self.budget
+                acked = False
+        if use_reply and self._try_reply(token, messages, source_id(event)):
+            return
+        self.push(event, messages)
+        if acked:
+            self.counters.incr("expiry_saves")
+
+    def push(self, event, messages):
+        self.push_to(source_id(event), messages)
+
+    def deliver(self, to, reply_token, received_at, messages):
+        """給 watch() 以外的背景工作使用：reply token 還在 budget 內就用 reply，否則（排隊太久、重啟後重試）改用 push。"""
+        if reply_token and time.time() < received_at + self.budget and self._try_reply(reply_token, messages, to):
+            return
+        self.push_to(to, messages)
+
+    def _try_reply(self, token, messages, to):
+        """用 reply 送出（超過 5 則的部分以 push 補送），成功回傳 True。
+
+        token 可能已失效（例如被用過、或本機時鐘與 LINE 的事件時間有落差），失敗時回傳 False 由呼叫端改用 push，回覆不會遺失。
+        """
+        try:
+            self._reply(token, messages[:MAX_MESSAGES_PER_REQUEST])
+        except Exception as e:
+            self.counters.incr("reply_failed")
+            logger.warning(f"[ReplyScheduler] Reply failed, falling back to push: {e}")
+            return False
+        self.counters.incr("reply")
+        if len(messages) > MAX_MESSAGES_PER_REQUEST:
+            self.push_to(to, messages[MAX_MESSAGES_PER_REQUEST:])
+        return True
+
+    def push_to(self, to, messages):
+        for i in range(0, len(messages), MAX_MESSAGES_PER_REQUEST):
+            self.line.push_message(
+                PushMessageRequest(to=to, messages=messages[i:i + MAX_MESSAGES_PER_REQUEST])
+            )
+            self.counters.incr("push")
+
+    def show_loading(self, event, seconds=60):
+        """一對一聊天顯示「輸入中」動畫，不會用掉 reply token。"""
+        user_id = getattr(event.source, "user_id", None)
+        if getattr(event.source, "type", "user") != "user" or not user_id:
+            return
+        try:
+            self.line.show_loading_animation(
+                ShowLoadingAnimationRequest(chat_id=user_id, loading_seconds=seconds)
+            )
+            self.counters.incr("loading")
+        except Exception as e:
+            logger.warning(f"[ReplyScheduler] show_loading_animation failed: {e}")
+
+    def _reply(self, token, messages):
+        self.line.reply_message(ReplyMessageRequest(reply_token=token, messages=messages))
+
+    def stats(self):
+        with self._lock:
+            watching = len(self._tracked)
+        return {"budget_seconds": self.budget, "watching": watching, **self.counters.snapshot()}
@@ -2,24 +2,24 @@
 東吳大學資料系 2025 LINEBOT
 """
 
+import atexit
 import os
 
 from flask import Flask, abort, request
-from bs4 import BeautifulSoup
-import markdown
 
 from google import genai
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
-    ApiClient,
     Configuration,
-    MessagingApi,
     ReplyMessageRequest,
     TextMessage,
 )
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
 
+from line_client import LineClient
+from line_text import render_messages
+
 
 # Initialize Google Gemini
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
@@ -31,6 +31,8 @@ channel_secret = os.getenv("YOUR_CHANNEL_SECRET")
 channel_access_token = os.getenv("YOUR_CHANNEL_ACCESS_TOKEN")
 configuration = Configuration(access_token=channel_access_token)
 handler = WebhookHandler(channel_secret)
+line_client = LineClient(configuration)
+atexit.register(line_client.close)
 
 
 def query(payload: str) -> str:
@@ -71,14 +73,9 @@ def handle_text_message(event):
     """Handle incoming text message event."""
     user_input = event.message.text.strip()
     response_text = query(user_input)
-    html_msg = markdown.markdown(response_text)
-    soup = BeautifulSoup(html_msg, "html.parser")
-
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=soup.get_text())],
-            )
-        )
\ No newline at end of file
+    line_client.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=chunk) for chunk in render_messages(response_text)],
+        )
+    )
\ No newline at end of file
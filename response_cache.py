@@ -0,0 +1,119 @@
+"""
+東吳大學資料系 2025 LINEBOT
+Gemini 回應快取：相同（正規化後）的提問直接回傳，並讓同時進行的相同提問共用同一次 Gemini 呼叫
+"""
+
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from metrics import Counters
+
+TRAILING_PUNCTUATION = "?？!！。.~～ "
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize(text):
+    """全形半形統一、轉小寫、合併空白，並去掉句尾標點。"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = WHITESPACE_RE.sub(" ", text).strip()
+    return text.rstrip(TRAILING_PUNCTUATION)
+
+
+def config_fingerprint(model, config):
+    """系統提示、模型、工具設定任一改變時，舊的快取就不再命中。"""
+    parts = [
+        model,
+        str(getattr(config, "system_instruction", "")),
+        repr(getattr(config, "tools", None)),
+        repr(getattr(config, "response_modalities", None)),
+    ]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResponseCache:
+    """有 TTL 與筆數上限（LRU）的快取，並支援 single-flight。"""
+
+    def __init__(self, max_entries=256, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.counters = Counters("hits", "misses", "coalesced", "evictions", "expired")
+
+    @staticmethod
+    def make_key(text, fingerprint):
+        return hashlib.sha256(f"{fingerprint}\0{normalize(text)}".encode("utf-8")).hexdigest()
+
+    def get_or_compute(self, key, compute, cacheable=lambda value: value is not None, ttl=None):
+        """命中時直接回傳；否則由第一個請求呼叫 compute()，其餘相同請求等待同一個結果。
+
+        ttl 覆寫這筆結果的有效秒數（預設 self.ttl）；ttl <= 0 時只合併同時進行的呼叫，結果不保留。
+        """
+        ttl = self.ttl if ttl is None else ttl
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.counters.incr("hits")
+                    return entry[1]
+                del self._entries[key]
+                self.counters.incr("expired")
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[key] = flight
+                self.counters.incr("misses")
+            else:
+                self.counters.incr("coalesced")
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+                if flight.error is None and ttl > 0 and cacheable(flight.value):
+                    self._entries[key] = (time.monotonic() + ttl, flight.value)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                        self.counters.incr("evictions")
+            flight.done.set()
+        return flight.value
+
+    def stats(self):
+        counters = self.counters.snapshot()
+        lookups = counters["hits"] + counters["misses"] + counters["coalesced"]
+        with self._lock:
+            size = len(self._entries)
+            inflight = len(self._inflight)
+        return {
+            "size": size,
+            "max_entries": self.max_entries,
+            "inflight": inflight,
+            "hit_rate": round((counters["hits"] + counters["coalesced"]) / lookups, 3) if lookups else 0.0,
+            **counters,
+        }
@@ -0,0 +1,25 @@
+"""
+東吳大學資料系 2025 LINEBOT
+串流回覆：把 Gemini 的串流輸出切成完整段落（或一天的行程），第一段先回覆，其餘以 push 依序送出
+"""
+
+BLOCK_SEPARATOR = "\n\n"
+
+
+def iter_blocks(chunks, min_chars=20):
+    """將串流文字片段組成以空行分隔的完整段落；太短的段落會與下一段合併。"""
+    buffer = ""
+    pending = ""
+    for chunk in chunks:
+        buffer += chunk
+        while BLOCK_SEPARATOR in buffer:
+            block, buffer = buffer.split(BLOCK_SEPARATOR, 1)
+            if not block.strip():
+                continue
+            pending = f"{pending}{BLOCK_SEPARATOR}{block}" if pending else block
+            if len(pending.strip()) >= min_chars:
+                yield pending.strip()
+                pending = ""
+    rest = f"{pending}{BLOCK_SEPARATOR}{buffer}" if pending else buffer
+    if rest.strip():
+        yield rest.strip()
@@ -2,12 +2,11 @@
 東吳大學資料系 2025 LINEBOT
 """
 
+import atexit
 import logging
 import os
 
 from flask import Flask, abort, request
-from bs4 import BeautifulSoup
-import markdown
 
 from google import genai
 from google.genai import types # 加入system prompot所需的types模組
@@ -20,24 +19,30 @@ google_search_tool = Tool(
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
-    ApiClient,
     Configuration,
-    MessagingApi,
     ReplyMessageRequest,
     TextMessage,
 )
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
 
+from chat_sessions import SessionManager
+from grounding import GroundingSelector
+from line_client import LineClient
+from line_text import render_messages
+
 
 # Initialize Google Gemini
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 client = genai.Client(api_key=GOOGLE_API_KEY)
-chat = client.chats.create(model="gemini-2.0-flash",
-    config=GenerateContentConfig(
-        system_instruction="你是一個中文的AI助手，請用繁體中文回答",
-        tools=[google_search_tool],
-        response_modalities=["TEXT"], 
-    ))
+chat_config = GenerateContentConfig(
+    system_instruction="你是一個中文的AI助手，請用繁體中文回答",
+    tools=[google_search_tool],
+    response_modalities=["TEXT"],
+)
+# 每位使用者各自一段對話，閒置或超過上限時自動回收
+sessions = SessionManager(client, model="gemini-2.0-flash", config=chat_config)
+# 只有需要即時資料（天氣、價格、日期等）的提問才帶 Google 搜尋工具
+grounding = GroundingSelector(chat_config, chat_config.model_copy(update={"tools": None}))
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -50,11 +55,14 @@ channel_secret = os.getenv("YOUR_CHANNEL_SECRET")
 channel_access_token = os.getenv("YOUR_CHANNEL_ACCESS_TOKEN")
 configuration = Configuration(access_token=channel_access_token)
 handler = WebhookHandler(channel_secret)
+line_client = LineClient(configuration)
+atexit.register(line_client.close)
 
 
-def query(payload: str) -> str:
-    """Send a prompt to Gemini and return the response text."""
-    response = chat.send_message(message=payload)
+def query(payload: str, user_id: str = None) -> str:
+    """Send a prompt to the user's own Gemini session and return the response text."""
+    _, config = grounding.select(payload)
+    response = sessions.send(user_id, payload, config=config)
     return response.text
 
 
@@ -86,15 +94,11 @@ def callback():
 def handle_text_message(event):
     """Handle incoming text message event."""
     user_input = event.message.text.strip()
-    response_text = query(user_input)
-    html_msg = markdown.markdown(response_text)
-    soup = BeautifulSoup(html_msg, "html.parser")
-
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=soup.get_text())],
-            )
-        )
\ No newline at end of file
+    user_id = getattr(event.source, "user_id", None)
+    response_text = query(user_input, user_id)
+    line_client.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=chunk) for chunk in render_messages(response_text)],
+        )
+    )
\ No newline at end of file